@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+
+
+# below this many moves the pure Python pass is faster than setting up arrays
+NUMPY_THRESHOLD = 32
+
+
+
+def compensate(moves, axes, slack, direction, position, relative=True):
+	"""Backlash compensation for a whole sequence of moves in one pass
+
+	moves: list of {axis: value}, target positions (absolute moves) or distances (relative
+		moves); axes left out of a move don't move
+	axes: the axes to compensate, eg. ['X','Y','Z','A','B','C']
+	slack: {axis: slack}
+	direction: {axis: 1 if the axis last moved in the positive direction, else 0}
+	position: {axis: position}, where the sequence starts (only needed for absolute moves)
+	relative: True or False for the whole sequence, or a list with one flag per move
+
+	The device's coordinates lag the actual position by the slack until an axis has moved in
+	the positive direction, ie. device = actual + slack * (direction - 1). So a relative move gets
+	slack * (new direction - previous direction) added, and an absolute move to target goes to
+	target + slack * (direction - 1). An axis keeps its direction while it doesn't move.
+
+	returns (compensated moves, final direction, final position), moves in the same form as given
+	"""
+	if isinstance(relative, bool):
+		relative = [relative] * len(moves)
+	if numpy is not None and len(moves) >= NUMPY_THRESHOLD:
+		return _compensate_numpy(moves, axes, slack, direction, position, relative)
+	return _compensate_python(moves, axes, slack, direction, position, relative)
+
+
+
+def _compensate_python(moves, axes, slack, direction, position, relative):
+	direction = {axis:direction.get(axis, 0) for axis in axes}
+	position = {axis:position.get(axis, 0.0) for axis in axes}
+	compensated = []
+	for move, is_relative in zip(moves, relative):
+		result = {}
+		for axis, value in move.items():
+			if axis not in direction:
+				result[axis] = value
+				continue
+			previous = direction[axis]
+			if is_relative:
+				delta = value
+				position[axis] += value
+			else:
+				delta = value - position[axis]
+				position[axis] = value
+			if delta > 0:
+				direction[axis] = 1
+			elif delta < 0:
+				direction[axis] = 0
+			if is_relative:
+				result[axis] = value + slack.get(axis, 0.0) * (direction[axis] - previous)
+			else:
+				result[axis] = value + slack.get(axis, 0.0) * (direction[axis] - 1)
+		compensated.append(result)
+	return compensated, direction, position
+
+
+
+def _forward_fill(values, initial):
+	"""Replaces every NaN with the last value before it (initial at the start), per column
+	"""
+	rows = numpy.arange(values.shape[0])[:, None]
+	last = numpy.where(numpy.isnan(values), -1, rows)
+	last = numpy.maximum.accumulate(last, axis=0)
+	filled = values[numpy.maximum(last, 0), numpy.arange(values.shape[1])]
+	return numpy.where(last < 0, initial, filled)
+
+
+def _compensate_numpy(moves, axes, slack, direction, position, relative):
+	count = len(moves)
+	values = numpy.full((count, len(axes)), numpy.nan)
+	for row, move in enumerate(moves):
+		for column, axis in enumerate(axes):
+			if axis in move:
+				values[row, column] = move[axis]
+	present = ~numpy.isnan(values)
+	is_relative = numpy.array(relative, dtype=bool)[:, None]
+	start = numpy.array([float(position.get(axis, 0.0)) for axis in axes])
+	start_direction = numpy.array([float(direction.get(axis, 0)) for axis in axes])
+	axis_slack = numpy.array([float(slack.get(axis, 0.0)) for axis in axes])
+
+	# position after each move: the last absolute target (or the start) plus the relative moves since
+	steps = numpy.where(present & is_relative, values, 0.0)
+	travelled = numpy.cumsum(steps, axis=0)
+	targets = numpy.where(present & ~is_relative, values - travelled, numpy.nan)
+	positions = _forward_fill(targets, start) + travelled
+	previous_positions = numpy.vstack([start[None, :], positions[:-1]])
+	delta = numpy.where(present, positions - previous_positions, 0.0)
+
+	# direction after each move, unchanged where an axis stood still
+	changes = numpy.where(delta > 0, 1.0, numpy.where(delta < 0, 0.0, numpy.nan))
+	directions = _forward_fill(changes, start_direction)
+	previous_directions = numpy.vstack([start_direction[None, :], directions[:-1]])
+
+	adjusted = numpy.where(
+		is_relative,
+		values + axis_slack * (directions - previous_directions),
+		values + axis_slack * (directions - 1.0))
+
+	compensated = []
+	for row, move in enumerate(moves):
+		result = {}
+		for axis, value in move.items():
+			if axis in axes:
+				result[axis] = float(adjusted[row, axes.index(axis)])
+			else:
+				result[axis] = value
+		compensated.append(result)
+	final_direction = {axis:int(directions[-1, column]) for column, axis in enumerate(axes)}
+	final_position = {axis:float(positions[-1, column]) for column, axis in enumerate(axes)}
+	return compensated, final_direction, final_position
+
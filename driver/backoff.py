@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+import random
+
+
+
+class Backoff():
+    """Exponential backoff with jitter, for reconnect loops
+
+    next() returns the delay before the next attempt: initial, then multiplied by factor
+    after every attempt, up to maximum. Each delay is randomly shortened by up to jitter
+    (a fraction), so processes that lost the same peer don't all retry at once.
+    Call reset() once connected.
+    """
+
+    def __init__(self, initial=0.05, maximum=5.0, factor=2.0, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+        self.current = initial
+
+
+    def next(self):
+        delay = self.current
+        self.attempts += 1
+        self.current = min(self.current * self.factor, self.maximum)
+        return delay * (1.0 - random.uniform(0, self.jitter))
+
+
+    def reset(self):
+        self.attempts = 0
+        self.current = self.initial
+
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+from collections import deque
+
+
+
+LANES = ('emergency', 'interactive', 'normal')
+
+
+
+class QueueFull(Exception):
+	"""Raised when lines don't fit in a CommandQueue's max_size, they can be sent again once it drained
+	"""
+
+	def __init__(self, size, max_size, count=1):
+		Exception.__init__(self, size, max_size, count)
+		self.size = size
+		self.max_size = max_size
+		self.count = count
+
+	def __str__(self):
+		return 'command queue full: %d lines queued, %d more do not fit in %d' % (self.size, self.count, self.max_size)
+
+
+
+class CommandQueue(object):
+	"""
+	Command queue made up of FIFO lanes that are drained in priority order:
+
+		'emergency' -> 'interactive' -> 'normal'
+
+	'normal' carries protocols, 'interactive' carries jogs and status queries so they can
+	overtake a long protocol, and 'emergency' holds halt/reset lines that could not be written
+	straight to the device (eg. no transport yet).
+
+	Each lane is a deque, so appending and popping stay O(1) however many lines are queued.
+
+	max_size (0 is unlimited) bounds what clients can queue: check(count) raises QueueFull if
+	count more lines don't fit, and is called before lines from clients are queued. append and
+	requeue don't check, so the driver's own lines (eg. the position query on connecting),
+	emergency lines and lines put back after a lost connection always get in.
+	"""
+
+
+	def __init__(self, max_size=0):
+		self.lanes = {lane:deque() for lane in LANES}
+		self.max_size = max_size
+
+
+	def __len__(self):
+		return len(self.lanes['emergency']) + len(self.lanes['interactive']) + len(self.lanes['normal'])
+
+
+	def append(self, message, lane='normal'):
+		if lane not in self.lanes:
+			raise ValueError('unknown lane: '+str(lane))
+		self.lanes[lane].append(message)
+
+
+	def room(self):
+		"""Returns how many more lines fit, or None if there is no max_size
+		"""
+		if self.max_size <= 0:
+			return None
+		return max(0, self.max_size - len(self))
+
+
+	def check(self, count):
+		"""Raises QueueFull if count more lines don't fit
+		"""
+		room = self.room()
+		if room is not None and count > room:
+			raise QueueFull(len(self), self.max_size, count)
+
+
+	def requeue(self, messages):
+		"""Puts messages back at the head of their lanes (message['lane'], default 'normal'), in order
+
+		For lines that were sent but never acknowledged, so they go out again before anything queued since
+		"""
+		for message in reversed(messages):
+			lane = message.get('lane', 'normal')
+			if lane not in self.lanes:
+				raise ValueError('unknown lane: '+str(lane))
+			self.lanes[lane].appendleft(message)
+
+
+	def peek(self):
+		"""Returns the message that popleft() would return, or None if the queue is empty
+		"""
+		for lane in LANES:
+			if len(self.lanes[lane]) > 0:
+				return self.lanes[lane][0]
+		return None
+
+
+	def popleft(self):
+		for lane in LANES:
+			if len(self.lanes[lane]) > 0:
+				return self.lanes[lane].popleft()
+		raise IndexError('pop from an empty CommandQueue')
+
+
+	def clear(self):
+		for lane in LANES:
+			self.lanes[lane].clear()
+
+
+	def sizes(self):
+		return {lane:len(self.lanes[lane]) for lane in LANES}
+
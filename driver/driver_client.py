@@ -1,21 +1,28 @@
 #!/usr/bin/env python3
 
 import asyncio
-import time
-import json
 import uuid
 import datetime
 import sys
-import collections
 import copy
 import os
 
 from smoothie_driver import SmoothieDriver
+from command_queue import QueueFull
+from driver_worker import WorkerDriver
+from position_stream import PositionStream
+from backoff import Backoff
+from serializer import EnvelopeEncoder, MsgpackEnvelopeEncoder
+import serializer
+import driver_log
 
 from autobahn.asyncio import wamp, websocket
 from autobahn.asyncio.wamp import ApplicationSession, ApplicationRunner 
 
 
+log = driver_log.get_logger('client')
+wamp_log = driver_log.get_logger('wamp')
+
 
 class WampComponent(wamp.ApplicationSession):
     """WAMP application session for OTOne (Overrides protocol.ApplicationSession - WAMP endpoint session)
@@ -35,36 +42,37 @@ class WampComponent(wamp.ApplicationSession):
 
         Starts instatiation of robot objects by calling :meth:`otone_client.instantiate_objects`.
         """
-        print(datetime.datetime.now(),' - driver_client : WampComponent.onJoin:')
-        print('\n\targs: ',locals(),'\n')
+        wamp_log.info('onJoin: %s', details)
         if not self.factory._myAppSession:
             self.factory._myAppSession = self
         try:
             self.factory._crossbar_connected = True
         except AttributeError:
-            print('ERROR: factory does not have "crossbar_connected" attribute')
+            wamp_log.error('factory does not have "crossbar_connected" attribute')
+        try:
+            self.factory._on_join()
+        except AttributeError:
+            wamp_log.error('factory does not have "_on_join" attribute')
 
 
         def handshake(client_data):
             """Hook for factory to call _handshake()
             """
-            print(datetime.datetime.now(),' - driver_client : WampComponent.handshake:')
-            print('\n\targs: ',locals(),'\n')
+            wamp_log.debug('handshake: %s', client_data)
             try:
                 self.factory._handshake(client_data)
             except AttributeError:
-                print('ERROR: factory does not have "_handshake" attribute')
+                wamp_log.error('factory does not have "_handshake" attribute')
 
 
         def dispatch_message(client_data):
             """Hook for factory to call dispatch_message()
             """
-            print(datetime.datetime.now(),' - driver_client : WampComponent.dispatch_message:')
-            print('\n\targs: ',locals(),'\n')
+            wamp_log.debug('dispatch_message: %s', client_data)
             try:
                 self.factory._dispatch_message(client_data)
             except AttributeError:
-                print('ERROR: factory does not have "_dispatch_message" attribute')
+                wamp_log.error('factory does not have "_dispatch_message" attribute')
 
 
         yield from self.subscribe(handshake, 'com.opentrons.driver_handshake')
@@ -76,8 +84,7 @@ class WampComponent(wamp.ApplicationSession):
         """Callback fired when WAMP session has been closed.
         :param details: Close information.
         """
-        print('driver_client : WampComponent.onLeave:')
-        print('\n\targs: ',locals(),'\n')
+        wamp_log.info('onLeave: %s', details)
         if self.factory._myAppSession == self:
             self.factory._myAppSession = None
         try:
@@ -89,21 +96,29 @@ class WampComponent(wamp.ApplicationSession):
     def onDisconnect(self):
         """Callback fired when underlying transport has been closed.
         """
-        print(datetime.datetime.now(),' - driver_client : WampComponent.onDisconnect:')
-        asyncio.get_event_loop().stop()
+        wamp_log.info('onDisconnect')
         crossbar_connected = False
         try:
             self.factory._crossbar_connected = False
         except AttributeError:
-            print('ERROR: outer does not have "crossbar_connected" attribute')
+            wamp_log.error('outer does not have "crossbar_connected" attribute')
+        try:
+            self.factory._on_disconnect()
+        except AttributeError:
+            wamp_log.error('outer does not have "_on_disconnect" attribute')
 
 
 class DriverClient():
 
-    def __init__(self):
+    def __init__(self, position_rate=30, batch_window=None, job_dir=None):
+        """
+        position_rate: maximum position updates per second published to each client, 0 publishes every update
+        batch_window: None publishes every message as its own event, otherwise messages are batched per
+            topic for batch_window microseconds (0 batches everything published in one event loop tick)
+        job_dir: the directory 'run_file' may run files from, None refuses every 'run_file'
+        """
         #__init__ VARIABLES FROM HARNESS
-        print(datetime.datetime.now(),' - DriverClient.__init__:')
-        print('\n\targs: ',locals(),'\n')
+        log.debug('__init__')
         self.driver_dict = {}
         self.meta_dict = {
             'drivers' : lambda from_,session_id,name,param: self.drivers(from_,session_id,name,param),
@@ -121,11 +136,18 @@ class DriverClient():
             'commands' : lambda from_,session_id,name,param: self.commands(from_,session_id,name,param),
             'configs' : lambda from_,session_id,name,param: self.configs(from_,session_id,name,param),
             'set_config' : lambda from_,session_id,name,param: self.set_config(from_,session_id,name,param),
-            'meta_commands' : lambda from_,session_id,name,param: self.meta_commands(from_,session_id,name,param)
+            'meta_commands' : lambda from_,session_id,name,param: self.meta_commands(from_,session_id,name,param),
+            'logs' : lambda from_,session_id,name,param: self.logs(from_,session_id,name,param),
+            'set_log_level' : lambda from_,session_id,name,param: self.set_log_level(from_,session_id,name,param),
+            'position_rate' : lambda from_,session_id,name,param: self.position_rate(from_,session_id,name,param),
+            'precompile' : lambda from_,session_id,name,param: self.precompile(from_,session_id,name,param),
+            'run_precompiled' : lambda from_,session_id,name,param: self.run_precompiled(from_,session_id,name,param),
+            'run_file' : lambda from_,session_id,name,param: self.run_file(from_,session_id,name,param)
         }
 
         self.in_dispatcher = {
             'command': lambda from_,session_id,data: self.send_command(from_,session_id,data),
+            'commands': lambda from_,session_id,data: self.send_commands(from_,session_id,data),
             'meta': lambda from_,session_id,data: self.meta_command(from_,session_id,data)
         }
 
@@ -139,9 +161,14 @@ class DriverClient():
         self.clients = {
             # uuid : 'com.opentrons.[uuid]'
         }
+        self.client_encodings = {
+            # uuid : 'msgpack', clients not listed get JSON
+        }
         self.max_clients = 4
 
         self.id = str(uuid.uuid4())
+        self.envelope_encoder = EnvelopeEncoder(self.id)
+        self.msgpack_encoder = MsgpackEnvelopeEncoder(self.id) if serializer.msgpack is not None else None
 
         self.session_factory = wamp.ApplicationSessionFactory()
         self.session_factory.session = WampComponent
@@ -151,53 +178,73 @@ class DriverClient():
 
         self.transport = None
         self.protocol = None
+        self._joined = None
+        self._disconnected = None
+        self._stopping = False
 
         self.loop = asyncio.get_event_loop()
 
+        self.position_stream = PositionStream(self.publish, position_rate, self.loop)
+
+        self.batch_window = batch_window
+        self.job_dir = job_dir
+        self.outbox = {}
+        self._flush_handle = None
+
 
     def dispatch_message(self, message):
-        print(datetime.datetime.now(),' - DriverClient.dispatch_message:')
+        log.debug('dispatch_message')
         #print('\n\targs: ',locals(),'\n')
         try:
-            dictum = collections.OrderedDict(json.loads(message.strip(), object_pairs_hook=collections.OrderedDict))
+            if isinstance(message, (bytes, bytearray)):
+                dictum = serializer.unpackb(message)
+            else:
+                dictum = serializer.loads(message.strip())
             if 'type' in dictum and 'from' in dictum and 'sessionID' in dictum and 'data' in dictum:
                 if dictum['type'] in self.in_dispatcher:
                     if self.client_check(dictum['from'],dictum['sessionID']):
                         #opportunity to filter, not actually used
-                        self.in_dispatcher[dictum['type']](dictum['from'],dictum['sessionID'],dictum['data'])
+                        asyncio.ensure_future(self.in_dispatcher[dictum['type']](dictum['from'],dictum['sessionID'],dictum['data']), loop=self.loop)
                     else:
-                        self.in_dispatcher[dictum['type']](dictum['from'],dictum['sessionID'],dictum['data'])
+                        asyncio.ensure_future(self.in_dispatcher[dictum['type']](dictum['from'],dictum['sessionID'],dictum['data']), loop=self.loop)
                 else:
-                    print(datetime.datetime.now(),' - ERROR:\n\r',sys.exc_info())
-                    print('type: ',dictum['type'])
+                    log.error('dispatch_message: unknown type: %s', dictum['type'])
             else:
-                print(datetime.datetime.now(),' - ERROR:\n\r',sys.exc_info())
+                log.error('dispatch_message: malformed message: %s', message)
                 
         except:
-            print(datetime.datetime.now(),' - ERROR:\n\r',sys.exc_info())
+            log.exception('dispatch_message: error')
+
+
+    @asyncio.coroutine
+    def _result(self, value):
+        """Returns what a driver method returned: a SmoothieDriver answers straight away, a
+        WorkerDriver with a Future of its worker's answer, waited for here without blocking the loop
+        """
+        if isinstance(value, asyncio.Future) or asyncio.iscoroutine(value):
+            value = yield from value
+        return value
 
 
     def handshake(self, data):
-        print(datetime.datetime.now(),' - DriverClient.handshake:')
+        log.debug('handshake')
         #print('\n\targs: ',locals(),'\n')
 
-        data_dict = json.loads(data)
+        data_dict = serializer.loads(data)
         if isinstance(data_dict, dict):
+            client_id = ''
             if 'from' in data:
-                print('* data has "from"')
                 client_id = data_dict['from']
-                print('client_id: ',client_id)
+                log.debug('handshake: client_id: %s', client_id)
                 if client_id in self.clients:
-                    print('* from is a client')
                     if 'data' in data_dict:
                         if 'message' in data_dict['data']:
                             if 'extend' in data_dict['data']['message']:
-                                print('handshake called again on client ',client_id,'. We could have done something here to repopulate data')
+                                log.info('handshake called again on client %s. We could have done something here to repopulate data', client_id)
                                 self.publish( client_id , client_id , client_id, 'handshake','driver','result','already_connected')
                             if 'shake' in data_dict['data']['message']:
                                 self.publish_client_ids(client_id,client_id)
                 else:
-                    print('* from is NOT a client')
                     if len(self.clients) > self.max_clients:
                         self.publish( 'frontend', '' , '' , 'handshake' , 'driver' , 'result' , 'fail' )
                     else:
@@ -205,10 +252,12 @@ class DriverClient():
                             self.clients[client_id] = 'com.opentrons.'+client_id
                             self.publish( 'frontend' , client_id , client_id, 'handshake', 'driver', 'result','success')
                         else:
-                            self.gen_client_id()
+                            client_id = self.gen_client_id()
             else:
-                print('* data does NOT have "from"')
-                self.gen_client_id()
+                client_id = self.gen_client_id()
+
+            if client_id in self.clients:
+                self.negotiate_encoding(client_id, data_dict)
 
             if 'get_ids' in data_dict:
                 publish_client_ids('','')
@@ -216,8 +265,29 @@ class DriverClient():
             self.gen_client_id()
 
 
+    def negotiate_encoding(self, client_id, data_dict):
+        """Selects the payload encoding for client_id's topic
+
+        A client asks for binary payloads with { 'encoding' : 'msgpack' } in the handshake's data.message.
+        The encoding actually used ('msgpack' only if msgpack is installed, 'json' otherwise) is
+        published on the frontend topic, which always stays JSON.
+        """
+        message = data_dict.get('data')
+        if isinstance(message, dict):
+            message = message.get('message')
+        if not isinstance(message, dict) or 'encoding' not in message:
+            return
+        if message['encoding'] == 'msgpack' and serializer.msgpack is not None:
+            self.client_encodings[client_id] = 'msgpack'
+        else:
+            self.client_encodings.pop(client_id, None)
+        encoding = self.client_encodings.get(client_id, 'json')
+        log.info('handshake: client %s uses %s', client_id, encoding)
+        self.publish('frontend', client_id, client_id, 'handshake', 'driver', 'encoding', encoding)
+
+
     def gen_client_id(self):
-        print(datetime.datetime.now(),' - DriverClient.gen_client_id:')
+        log.debug('gen_client_id')
         #print('\n\targs: ',locals(),'\n')
         ret_id = ''
         if len(self.clients) > self.max_clients:
@@ -231,7 +301,7 @@ class DriverClient():
 
 
     def client_check(self, id_, session_id):
-        print(datetime.datetime.now(),' - DriverClient.client_check:')
+        log.debug('client_check')
         #print('\n\targs: ',locals(),'\n')
         if id_ in self.clients:
             return True
@@ -240,7 +310,7 @@ class DriverClient():
 
 
     def publish_client_ids(self, id_, session_id):
-        print(datetime.datetime.now(),' - DriverClient.publish_client_ids:')
+        log.debug('publish_client_ids')
         #print('\n\targs: ',locals(),'\n')
         if id_ in self.clients:
             self.publish( id_ , id_ , session_id, 'handshake' , 'driver' , 'ids' , list(self.clients) )
@@ -251,8 +321,9 @@ class DriverClient():
 
     def publish(self,topic,to,session_id,type_,name,message,param):
         """
+        With batch_window set, the message is queued and sent with the rest of the batch for its topic
         """
-        print(datetime.datetime.now(),' - DriverClient.publish:')
+        log.debug('publish')
         #print('\n\targs: ',locals(),'\n')
         if self.session_factory is not None and topic is not None and type_ is not None:
             if name is None:
@@ -263,24 +334,96 @@ class DriverClient():
                 param = ''
             if self.session_factory is not None:
                 if self.session_factory._myAppSession is not None:
+                    encoding = 'json'
+                    if topic in self.topic:
+                        url = self.topic.get(topic)
+                    elif topic in self.clients:
+                        url = self.clients.get(topic)
+                        encoding = self.client_encodings.get(topic, 'json')
+                    else:
+                        return
+                    log.debug('publish: url topic: %s', url)
+                    if self.batch_window is not None:
+                        self._batch((url, encoding), (type_,to,session_id,name,message,param))
+                        return
                     time_string = str(datetime.datetime.now())
-                    msg = {'time':time_string, 'type':type_,'to':to,'from':self.id,'sessionID':session_id,'data':{'name':name,'message':{message:param}}}
                     try:
-                        if topic in self.topic:
-                            print('TOPIC: ',self.topic)
-                            print(datetime.datetime.now(),'url topic: ',self.topic.get(topic))
-                            self.session_factory._myAppSession.publish(self.topic.get(topic),json.dumps(msg))
-                        elif topic in self.clients:
-                            print('TO: ',to)
-                            url_topic = 'com.opentrons.'+to
-                            print(datetime.datetime.now(),'url topic: ',url_topic)
-                            self.session_factory._myAppSession.publish(self.clients.get(topic),json.dumps(msg))
+                        self.session_factory._myAppSession.publish(url,self._encode(encoding,time_string,(type_,to,session_id,name,message,param)))
                     except:
-                        print(datetime.datetime.now(),' - Error:\n\r',sys.exc_info())
+                        log.exception('publish: error')
             else:
-                print(datetime.datetime.now(),' - Error: caller._myAppSession is None')
+                log.warning('publish: caller._myAppSession is None')
         else:
-            print(datetime.datetime.now(),' - Error: calller, topic, or type_ is None')
+            log.error('publish: caller, topic, or type_ is None')
+
+
+    def _encode(self, encoding, time_string, item):
+        if encoding == 'msgpack':
+            return self.msgpack_encoder.encode(time_string,*item)
+        return self.envelope_encoder.encode(time_string,*item)
+
+
+    def _batch(self, destination, item):
+        self.outbox.setdefault(destination, []).append(item)
+        if self._flush_handle is None:
+            if self.batch_window > 0:
+                self._flush_handle = self.loop.call_later(self.batch_window/1000000.0, self.flush_outbox)
+            else:
+                self._flush_handle = self.loop.call_soon(self.flush_outbox)
+
+
+    def flush_outbox(self):
+        """Sends every batched message, one event per topic
+
+        A topic with a single message gets the message itself, otherwise it gets an array (JSON, or
+        msgpack for msgpack clients) of messages in the order they were published. All messages in a
+        flush share one timestamp, and a payload published to several topics (eg. frontend and
+        client) is only encoded once per encoding.
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        outbox = self.outbox
+        self.outbox = {}
+        if len(outbox) == 0:
+            return
+        session = self.session_factory._myAppSession
+        if session is None:
+            log.warning('flush_outbox: _myAppSession is None, dropping %s topics', len(outbox))
+            return
+        time_string = str(datetime.datetime.now())
+        encoded = {}
+        for (url, encoding), items in outbox.items():
+            parts = []
+            for item in items:
+                # params are kept alive by the outbox, so their id is a safe key
+                key = (encoding,) + item[:5] + (id(item[5]),)
+                part = encoded.get(key)
+                if part is None:
+                    try:
+                        part = encoded[key] = self._encode(encoding, time_string, item)
+                    except:
+                        # only the message that cannot be encoded is lost, not its batch
+                        log.exception('flush_outbox: error encoding %s %s', item[4], item[3])
+                        continue
+                parts.append(part)
+            if len(parts) == 0:
+                continue
+            try:
+                if len(parts) == 1:
+                    session.publish(url, parts[0])
+                elif encoding == 'msgpack':
+                    session.publish(url, serializer.pack_array(parts))
+                else:
+                    session.publish(url, '['+','.join(parts)+']')
+            except:
+                log.exception('flush_outbox: error')
+
+
+    def publish_position(self,topic,to,session_id,type_,name,message,param):
+        """Like publish, but coalesced through position_stream, for position updates
+        """
+        self.position_stream.update(topic,to,session_id,type_,name,message,param)
 
 
     # FUNCTIONS FROM HARNESS
@@ -289,7 +432,7 @@ class DriverClient():
         name: n/a
         param: n/a
         """
-        print(datetime.datetime.now(),'- DriverClient.drivers:')
+        log.debug('drivers')
         #print('\n\targs: ',locals(),'\n')
         return_list = list(self.driver_dict)
         if name is None:
@@ -306,7 +449,7 @@ class DriverClient():
         name: name of driver to add_driver
         param: driver object
         """
-        print(datetime.datetime.now(),' - DriverClient.add_driver:')
+        log.debug('add_driver')
         #print('\n\targs: ',locals(),'\n')
         self.driver_dict[name] = param
         return_list = list(self.driver_dict)
@@ -322,7 +465,7 @@ class DriverClient():
         name: name of driver to be driver
         param: n/a
         """
-        print(datetime.datetime.now(),' - DriverClient.remove_driver:')
+        log.debug('remove_driver')
         #print('\n\targs: ',locals(),'\n')
         del self.driver_dict[name]
         return_list = list(self.driver_dict)
@@ -337,7 +480,7 @@ class DriverClient():
         name: name of driver
         param: n/a
         """
-        print(datetime.datetime.now(),' - DriverClient.callbacks:')
+        log.debug('callbacks')
         #print('\n\targs: ',locals(),'\n')
         return_dict = self.driver_dict[name].callbacks()
         if from_ == "":
@@ -352,7 +495,7 @@ class DriverClient():
         name: name of driver
         param: n/a
         """
-        print(datetime.datetime.now(),' - DriverClient.meta_callbacks:')
+        log.debug('meta_callbacks')
         #print('\n\targs: ',locals(),'\n')
         return_dict = self.driver_dict[name].meta_callbacks()
         self.publish(from_,from_,session_id,'driver',name,'meta_callbacks',return_dict)
@@ -364,7 +507,7 @@ class DriverClient():
         name: name of driver
         param: { meta-callback-name : meta-callback-object }
         """
-        print(datetime.datetime.now(),' - DriverClient.set_meta_callback:')
+        log.debug('set_meta_callback')
         #print('\n\targs: ',locals(),'\n')
         if isinstance(param,dict):
             return_dict = self.driver_dict.get(name).set_meta_callback(list(param)[0],list(param.values())[0])
@@ -379,7 +522,7 @@ class DriverClient():
         name: name of driver
         param: { callback obj: [messages list] }
         """
-        print(datetime.datetime.now(),' - DriverClient.add_callback:')
+        log.debug('add_callback')
         #print('\n\targs: ',locals(),'\n')
         return_dict = self.driver_dict.get(name).add_callback(list(param)[0],list(param.values())[0])
         if from_ == "":
@@ -393,7 +536,7 @@ class DriverClient():
         name: name of driver
         param: name of callback to remove
         """
-        print(datetime.datetime.now(),' - DriverClient.remove_callback:')
+        log.debug('remove_callback')
         #print('\n\targs: ',locals(),'\n')
         return_dict = self.driver_dict[name].remove_callback(param)
         if from_ == "":
@@ -403,14 +546,19 @@ class DriverClient():
         return return_dict
 
 
+    @asyncio.coroutine
     def flow(self, from_, session_id, name, param):
         """
         name: name of driver
-        param: n/a
+        param: n/a, or the 'version' of the last flow received: if nothing has changed since,
+            only { 'version': version } is published
         """
-        print(datetime.datetime.now(),' - DriverClient.flow:')
+        log.debug('flow')
         #print('\n\targs: ',locals(),'\n')
-        return_dict = self.driver_dict.get(name).flow()
+        if isinstance(param, int):
+            return_dict = yield from self._result(self.driver_dict.get(name).flow(param))
+        else:
+            return_dict = yield from self._result(self.driver_dict.get(name).flow())
         if from_ == "":
             self.publish('frontend',from_,session_id,'driver',name,'flow',return_dict)
         else:
@@ -418,14 +566,15 @@ class DriverClient():
         return return_dict
 
 
+    @asyncio.coroutine
     def clear_queue(self, from_, session_id, name, param):
         """
         name: name of driver
         param: n/a
         """
-        print(datetime.datetime.now(),' - DriverClient.clear_queue:')
+        log.debug('clear_queue')
         #print('\n\targs: ',locals(),'\n')
-        return_dict = self.driver_dict.get(name).clear_queue()
+        return_dict = yield from self._result(self.driver_dict.get(name).clear_queue())
         if from_ == "":
             self.publish('frontend',from_,session_id,'labware',name,'clear_queue',return_dict)
         else:
@@ -436,33 +585,36 @@ class DriverClient():
     def driver_connect(self, from_, session_id, name, param):
         """
         name: name of driver
-        param: n/a
+        param: n/a, or { 'host': host, 'port': port } to connect to another endpoint
         """
-        print(datetime.datetime.now(),' - DriverClient.driver_connect:')
+        log.debug('driver_connect')
         #print('\n\targs: ',locals(),'\n')
-        print('self.driver_dict: ',self.driver_dict)
-        print('self.driver_dict[',name,']: ',self.driver_dict[name])
-        self.driver_dict[name].connect(from_,session_id)    # <--- This should lead to on_connection_made callback
+        log.info('driver_connect: %s', name)
+        if isinstance(param, dict):
+            self.driver_dict[name].connect(from_,session_id,param.get('host'),param.get('port'))
+        else:
+            self.driver_dict[name].connect(from_,session_id)    # <--- This should lead to on_connection_made callback
 
 
-    def driver_disconnect(self, from_, name, param):
+    def driver_disconnect(self, from_, session_id, name, param):
         """
         name: name of driver
         param: n/a
         """
-        print(datetime.datetime.now(),' - DriverClient.driver_disconnect:')
+        log.debug('driver_disconnect')
         #print('\n\targs: ',locals(),'\n')
         self.driver_dict.get(name).disconnect(from_,session_id) # <--- This should lead to on_connection_lost callback
 
 
+    @asyncio.coroutine
     def commands(self, from_, session_id, name, param):
         """
         name: name of driver
         param: n/a
         """
-        print(datetime.datetime.now(),' - DriverClient.commands:')
+        log.debug('commands')
         #print('\n\targs: ',locals(),'\n')
-        return_dict = self.driver_dict.get(name).commands()
+        return_dict = yield from self._result(self.driver_dict.get(name).commands())
         self.publish(from_,from_,session_id,'driver',name,'commands',return_dict)
         return return_dict
 
@@ -472,7 +624,7 @@ class DriverClient():
         name: name of driver
         param: n/a
         """
-        print(datetime.datetime.now(),' - DriverClient.meta_commands:')
+        log.debug('meta_commands')
         #print('\n\targs: ',locals(),'\n')
         return_list = list(self.meta_dict)
         if from_ == "":
@@ -482,14 +634,15 @@ class DriverClient():
         return return_list
 
 
+    @asyncio.coroutine
     def configs(self, from_, session_id, name, param):
         """
         name: name of driver
         param: n/a
         """
-        print(datetime.datetime.now(),' - DriverClient.configs:')
+        log.debug('configs')
         #print('\n\targs: ',locals(),'\n')
-        return_dict = self.driver_dict.get(name).configs()
+        return_dict = yield from self._result(self.driver_dict.get(name).configs())
         if from_ == "":
             self.publish('frontend',from_,session_id,'driver',name,'configs',return_dict)
         else:
@@ -497,16 +650,17 @@ class DriverClient():
         return return_dict
 
 
+    @asyncio.coroutine
     def set_config(self, from_, session_id, name, param):
         """
         name: name
         param: { config name : config value }
         """
-        print(datetime.datetime.now(),' - DriverClient.set_config:')
+        log.debug('set_config')
         #print('\n\targs: ',locals(),'\n')
         if isinstance(param,dict):
-            self.driver_dict.get(name).set_config(list(param)[0],list(param.values)[0])
-        return_dict = self.driver_dict.get(name).configs()
+            yield from self._result(self.driver_dict.get(name).set_config(list(param)[0],list(param.values())[0]))
+        return_dict = yield from self._result(self.driver_dict.get(name).configs())
         if from_ == "":
             self.publish('frontend',from_,session_id,'driver',name,'configs',return_dict)
         else:
@@ -514,6 +668,117 @@ class DriverClient():
         return return_dict
 
 
+    def logs(self, from_, session_id, name, param):
+        """
+        name: n/a
+        param: number of most recent log records to return, or None for the whole ring buffer
+        """
+        log.debug('logs')
+        return_list = driver_log.dump(param)
+        if from_ == "":
+            self.publish('frontend',from_,session_id,'driver',name,'logs',return_list)
+        else:
+            self.publish(from_,from_,session_id,'driver',name,'logs',return_list)
+        return return_list
+
+
+    def set_log_level(self, from_, session_id, name, param):
+        """
+        name: n/a
+        param: { subsystem : level }, eg. { 'flow' : 'DEBUG' }, 'all' sets every subsystem
+        """
+        log.debug('set_log_level')
+        if isinstance(param,dict):
+            for subsystem, level in param.items():
+                driver_log.set_level(subsystem, level)
+        return_dict = driver_log.levels()
+        if from_ == "":
+            self.publish('frontend',from_,session_id,'driver',name,'log_levels',return_dict)
+        else:
+            self.publish(from_,from_,session_id,'driver',name,'log_levels',return_dict)
+        return return_dict
+
+
+    def position_rate(self, from_, session_id, name, param):
+        """
+        name: n/a
+        param: maximum position updates per second published to each client (0 publishes every
+            update), or None to only read it
+        """
+        log.debug('position_rate')
+        if param is not None:
+            self.position_stream.flush()
+            self.position_stream.max_rate = float(param)
+        return_value = self.position_stream.max_rate
+        if from_ == "":
+            self.publish('frontend',from_,session_id,'driver',name,'position_rate',return_value)
+        else:
+            self.publish(from_,from_,session_id,'driver',name,'position_rate',return_value)
+        return return_value
+
+
+    @asyncio.coroutine
+    def precompile(self, from_, session_id, name, param):
+        """
+        name: name of driver
+        param: [ list of commands, as in a 'commands' message ]. Publishes { 'key', 'lines', 'bytes', 'cached' }
+        """
+        log.debug('precompile')
+        return_dict = yield from self._result(self.driver_dict.get(name).precompile(param))
+        if from_ == "":
+            self.publish('frontend',from_,session_id,'driver',name,'precompile',return_dict)
+        else:
+            self.publish(from_,from_,session_id,'driver',name,'precompile',return_dict)
+        return return_dict
+
+
+    @asyncio.coroutine
+    def run_precompiled(self, from_, session_id, name, param):
+        """
+        name: name of driver
+        param: the key 'precompile' published. Publishes { 'key', 'queued', 'queue_size', 'optimized' }
+        """
+        log.debug('run_precompiled')
+        return_dict = yield from self._result(self.driver_dict.get(name).run_precompiled(from_, session_id, param))
+        if from_ == "":
+            self.publish('frontend',from_,session_id,'driver',name,'run_precompiled',return_dict)
+        else:
+            self.publish(from_,from_,session_id,'driver',name,'run_precompiled',return_dict)
+        return return_dict
+
+
+    @asyncio.coroutine
+    def run_file(self, from_, session_id, name, param):
+        """
+        name: name of driver
+        param: path of a G-code file in job_dir, relative to it or not. Publishes the driver's 'stream'
+            state, progress follows as 'progress' messages (see the on_progress meta-callback)
+        """
+        log.debug('run_file')
+        path = self.job_path(param)
+        return_dict = yield from self._result(self.driver_dict.get(name).run_file(from_, session_id, path))
+        if from_ == "":
+            self.publish('frontend',from_,session_id,'driver',name,'run_file',return_dict)
+        else:
+            self.publish(from_,from_,session_id,'driver',name,'run_file',return_dict)
+        return return_dict
+
+
+    def job_path(self, path):
+        """Returns where path is once symlinks are resolved, raises ValueError unless that is inside job_dir
+        """
+        if self.job_dir is None:
+            raise ValueError('run_file is disabled, there is no job directory')
+        if not isinstance(path, str):
+            raise ValueError('run_file expects a path')
+        root = os.path.realpath(self.job_dir)
+        resolved = os.path.realpath(os.path.join(root, path))
+        if not resolved.startswith(root.rstrip(os.sep) + os.sep):
+            raise ValueError('not in the job directory: '+path)
+        return resolved
+
+
+    @asyncio.coroutine
     def meta_command(self, from_, session_id, data):
         """
 
@@ -535,7 +800,7 @@ class DriverClient():
 
 
         """
-        print(datetime.datetime.now(),' - DriverClient.meta_command:')
+        log.debug('meta_command')
         #print('\n\targs: ',locals(),'\n')
         if isinstance(data, dict):
             name = data['name']
@@ -545,95 +810,202 @@ class DriverClient():
                     command = list(value)[0]
                     params = value[command]
                     try:
-                        self.meta_dict[command](from_,session_id,name,params)
+                        yield from self._result(self.meta_dict[command](from_,session_id,name,params))
                     except:
                         if from_ == "":
-                            self.publish('frontend',from_,session_id,'driver',name,'error',sys.exc_info())
+                            self.publish('frontend',from_,session_id,'driver',name,'error',str(sys.exc_info()[1]))
                         else:
-                            self.publish(from_,from_,session_id,'driver',name,'error',sys.exc_info())
-                        print(datetime.datetime.now(),' - meta_command error: ',sys.exc_info())
+                            self.publish(from_,from_,session_id,'driver',name,'error',str(sys.exc_info()[1]))
+                        log.exception('meta_command error')
                 elif isinstance(value, str):
                     command = value
                     try:
-                        self.meta_dict[command](from_,session_id,name,None)
+                        yield from self._result(self.meta_dict[command](from_,session_id,name,None))
                     except:
                         if from_ == "":
-                            self.publish('frontend',from_,session_id,'driver',name,'error',sys.exc_info())
+                            self.publish('frontend',from_,session_id,'driver',name,'error',str(sys.exc_info()[1]))
                         else:
-                            self.publish(from_,from_,session_id,'driver',name,'error',sys.exc_info())
-                        print(datetime.datetime.now(),' - meta_command error: ',sys.exc_info())
+                            self.publish(from_,from_,session_id,'driver',name,'error',str(sys.exc_info()[1]))
+                        log.exception('meta_command error')
             else:
                 if isinstance(value, dict):
                     command = list(value)[0]
                     params = value[command]
                     try:
-                        self.meta_dict[command](from_,session_id,None, params)
+                        yield from self._result(self.meta_dict[command](from_,session_id,None, params))
                     except:
                         if from_ == "":
-                            self.publish('frontend',from_,session_id,'driver',name,'error',sys.exc_info())
+                            self.publish('frontend',from_,session_id,'driver',name,'error',str(sys.exc_info()[1]))
                         else:
-                            self.publish(from_,from_,session_id,'driver',name,'error',sys.exc_info())
-                        print(datetime.datetime.now(),' - meta_command error, name not in drivers: ',sys.exc_info())
+                            self.publish(from_,from_,session_id,'driver',name,'error',str(sys.exc_info()[1]))
+                        log.exception('meta_command error, name not in drivers')
                 elif isinstance(value, str):
                     command = value
                     try:
-                        self.meta_dict[command](from_,session_id,None,None)
+                        yield from self._result(self.meta_dict[command](from_,session_id,None,None))
                     except:
                         if from_ == "":
-                            self.publish('frontend',from_,session_id,'driver','None','error',sys.exc_info())
+                            self.publish('frontend',from_,session_id,'driver','None','error',str(sys.exc_info()[1]))
                         else:
-                            self.publish(from_,from_,session_id,'driver','None','error',sys.exc_info())
-                        print(datetime.datetime.now(),' - meta_command error, name not in drivers: ',sys.exc_info())
+                            self.publish(from_,from_,session_id,'driver','None','error',str(sys.exc_info()[1]))
+                        log.exception('meta_command error, name not in drivers')
 
 
+    @asyncio.coroutine
     def send_command(self, from_, session_id, data):
         """
         data:
         {
             'name': name of driver
             'message': string or { message : {param:values} } <--- the part the driver cares about
+            'lane': (optional) 'normal', 'interactive' or 'emergency', eg. 'interactive' for jogs
         }
+
+        If the driver's command queue is full the client gets 'retry_later' instead
         """
-        print(datetime.datetime.now(),' - DriverClient.send_command:')
+        log.debug('send_command')
         #print('\n\targs: ',locals(),'\n')
         if isinstance(data, dict):
             name = data['name']
             value = data['message']
+            lane = data.get('lane')
             if name in self.driver_dict:
                 try:
-                    self.driver_dict[name].send_command(from_, session_id, value)
+                    yield from self._result(self.driver_dict[name].send_command(from_, session_id, value, lane))
+                except QueueFull:
+                    self.retry_later(from_, session_id, name, sys.exc_info()[1])
                 except:
                     if from_ == "":
                         self.publish('frontend',from_,session_id,'driver',name,'error',sys.exc_info())
                     else:
                         self.publish(from_,from_,session_id,'driver',name,'error',sys.exc_info())
-                    print(datetime.datetime.now(),' - send_command error: '+sys.exc_info())
+                    log.exception('send_command error')
             else:
                 if from_ == "":
                     self.publish('frontend',from_,session_id,'driver','None','error',sys.exc_info())
                 else:
                     self.publish(from_,from_,session_id,'driver','None','error',sys.exc_info())
-                print(datetime.datetime.now(),' - send_command_error, name not in drivers: '+sys.exc_info())
+                log.error('send_command error, name not in drivers: %s', name)
+
 
+    @asyncio.coroutine
+    def send_commands(self, from_, session_id, data):
+        """
+        data:
+        {
+            'name': name of driver
+            'message': [ list of commands, each a string or { message : {param:values} } ]
+            'lane': (optional) 'normal', 'interactive' or 'emergency'
+        }
 
-    def _make_connection(self, url_protocol='ws', url_domain='0.0.0.0', url_port=8080, url_path='ws', debug=False, debug_wamp=False):
-        print(datetime.datetime.now(),' - DriverClient._make_connection:')
+        The whole list is queued in one pass (or rejected as a whole) and acknowledged
+        with a single 'commands' message, or 'retry_later' if it doesn't fit in the queue
+        """
+        log.debug('send_commands')
         #print('\n\targs: ',locals(),'\n')
-        if self.loop.is_running():
-            print('self.loop is running. stopping loop now')
-            self.loop.stop()
-        print(self.transport_factory)
-        coro = self.loop.create_connection(self.transport_factory, url_domain, url_port)
-        self.transport, self.protocol = self.loop.run_until_complete(coro)
-        #protocoler.set_outer(self)
-        if not self.loop.is_running():
-            print('about to call self.loop.run_forever()')
-            self.loop.run_forever()
+        if isinstance(data, dict):
+            name = data['name']
+            value = data['message']
+            lane = data.get('lane')
+            if name in self.driver_dict:
+                try:
+                    return_dict = yield from self._result(self.driver_dict[name].send_commands(from_, session_id, value, lane))
+                    if from_ == "":
+                        self.publish('frontend',from_,session_id,'driver',name,'commands',return_dict)
+                    else:
+                        self.publish(from_,from_,session_id,'driver',name,'commands',return_dict)
+                except QueueFull:
+                    self.retry_later(from_, session_id, name, sys.exc_info()[1])
+                except:
+                    if from_ == "":
+                        self.publish('frontend',from_,session_id,'driver',name,'error',str(sys.exc_info()[1]))
+                    else:
+                        self.publish(from_,from_,session_id,'driver',name,'error',str(sys.exc_info()[1]))
+                    log.exception('send_commands error')
+            else:
+                if from_ == "":
+                    self.publish('frontend',from_,session_id,'driver','None','error','name not in drivers')
+                else:
+                    self.publish(from_,from_,session_id,'driver','None','error','name not in drivers')
+                log.error('send_commands error, name not in drivers: %s', name)
+
+
+    def retry_later(self, from_, session_id, name, queue_full):
+        """
+        Tells a client its command(s) were refused because the driver's command queue is full,
+        { 'queue_size': lines queued, 'max_queue_size': limit, 'refused': lines refused }
+        """
+        log.info('retry_later: %s %s', name, queue_full)
+        return_dict = {'queue_size':queue_full.size, 'max_queue_size':queue_full.max_size, 'refused':queue_full.count}
+        if from_ == "":
+            self.publish('frontend',from_,session_id,'driver',name,'retry_later',return_dict)
+        else:
+            self.publish(from_,from_,session_id,'driver',name,'retry_later',return_dict)
+        return return_dict
+
+
+    @asyncio.coroutine
+    def supervise(self, url_domain='0.0.0.0', url_port=8080, keep_trying=True, backoff=None, join_timeout=10):
+        """Keeps the crossbar connection up, without ever stopping the event loop
+
+        Failed attempts are retried after backoff.next() seconds. Once connected, waits for the
+        session to join (closing the transport if it hasn't within join_timeout seconds, and
+        giving up on the attempt as soon as the connection drops) and then for it to disconnect,
+        and reconnects straight away. Device I/O carries on meanwhile.
+        Returns after the first disconnect or failure if keep_trying is False, or after disconnect().
+        """
+        log.debug('supervise')
+        if backoff is None:
+            backoff = Backoff()
+        self._stopping = False
+        while not self._stopping:
+            self._joined = asyncio.Event()
+            self._disconnected = asyncio.Event()
+            try:
+                log.info('Driver attempting crossbar connection')
+                self.transport, self.protocol = yield from self.loop.create_connection(self.transport_factory, url_domain, url_port)
+            except (OSError, asyncio.TimeoutError):
+                log.info('crossbar connection attempt failed: %s', sys.exc_info()[1])
+            else:
+                joined = asyncio.ensure_future(self._joined.wait(), loop=self.loop)
+                disconnected = asyncio.ensure_future(self._disconnected.wait(), loop=self.loop)
+                try:
+                    yield from asyncio.wait([joined, disconnected], timeout=join_timeout, return_when=asyncio.FIRST_COMPLETED)
+                    if disconnected.done():
+                        log.info('crossbar connection lost before the session joined')
+                    elif joined.done():
+                        backoff.reset()
+                        yield from disconnected
+                        log.info('crossbar connection lost')
+                    else:
+                        log.warning('crossbar session did not join within %s seconds', join_timeout)
+                        self.transport.close()
+                finally:
+                    joined.cancel()
+                    disconnected.cancel()
+            if not keep_trying or self._stopping:
+                break
+            delay = backoff.next()
+            log.info('Driver reconnecting to crossbar in %.3f seconds', delay)
+            yield from asyncio.sleep(delay)
+
+
+    def _on_join(self):
+        if self._joined is not None:
+            self._joined.set()
+
+
+    def _on_disconnect(self):
+        if self._disconnected is not None:
+            self._disconnected.set()
 
 
     def connect(self, url_protocol='ws', url_domain='0.0.0.0', url_port=8080, url_path='ws', debug=False, debug_wamp=False, keep_trying=True, period=5):
-        print(datetime.datetime.now(),' - DriverClient.connect:')
-        print('\n\targs: ',locals(),'\n')
+        """Connects to crossbar and runs the event loop
+
+        period: longest delay, in seconds, between reconnect attempts
+        """
+        log.debug('connect: %s:%s', url_domain, url_port)
         if self.transport_factory is None:
             url = url_protocol+"://"+url_domain+':'+str(url_port)+'/'+url_path
 
@@ -644,33 +1016,19 @@ class DriverClient():
 
         self.session_factory._handshake = self.handshake
         self.session_factory._dispatch_message = self.dispatch_message
+        self.session_factory._on_join = self._on_join
+        self.session_factory._on_disconnect = self._on_disconnect
+
+        try:
+            self.loop.run_until_complete(self.supervise(url_domain, url_port, keep_trying, Backoff(maximum=period)))
+        except KeyboardInterrupt:
+            pass
 
-        if not keep_trying:
-            try:
-                print('\nDriver attempting crossbar connection\n')
-                self._make_connection(url_domain=url_domain, url_port=url_port)
-            except:
-                print('crossbar connection attempt error:\n',sys.exc_info())
-                pass
-        else:
-            while True:
-                while (self.session_factory._crossbar_connected == False):
-                    try:
-                        print('\nDriver attempting crossbar connection\n')
-                        self._make_connection(url_domain=url_domain, url_port=url_port)
-                    except KeyboardInterrupt:
-                        self.session_factory._crossbar_connected = True
-                    except:
-                        print('crossbar connection attempt error:\n',sys.exc_info())
-                        pass
-                    finally:
-                        print('\nDriver connection failed, sleeping for 5 seconds\n')
-                        time.sleep(period)
-            
 
     def disconnect(self):
-        print(datetime.datetime.now(),' - DriverClient.disconnect:')
+        log.debug('disconnect')
         #print('\n\targs: ',locals(),'\n')
+        self._stopping = True
         self.transport.close()
         self.transport_factory = None
 
@@ -692,23 +1050,48 @@ if __name__ == '__main__':
         #                                                        debug_wamp=False)
         #loop = asyncio.get_event_loop()
 
-        print('\nBEGIN INIT...\n')
+        driver_log.configure()
+        log.info('BEGIN INIT...')
 
         # TRYING THE FOLLOWING IN INSTANTIATE OBJECTS vs here
         # INITIAL SETUP
-        print(datetime.datetime.now(),' - INITIAL SETUP - publisher, harness, subscriber ','* * '*10)
-        driver_client = DriverClient()
+        log.info('INITIAL SETUP - publisher, harness, subscriber')
+        batch_window = os.environ.get('PUBLISH_BATCH_WINDOW')
+        driver_client = DriverClient(
+            position_rate=float(os.environ.get('POSITION_RATE', '30')),
+            batch_window=(float(batch_window) if batch_window else None),
+            job_dir=os.environ.get('DRIVER_JOB_DIR')
+            )
         
 
         # INSTANTIATE DRIVERS
-        print(datetime.datetime.now(),' - INSTANTIATE DRIVERS - smoothie_driver ','* * '*10)
-        smoothie_driver = SmoothieDriver(simulate=(os.environ.get('SMOOTHIE_SIMULATE', 'true')=='true'))
+        #
+        #   SMOOTHIE_DEVICES lists the devices to drive, eg. "deck1=10.0.0.5:3333,deck2=10.0.0.6:3333",
+        #   otherwise there is one, 'smoothie', at SMOOTHIE_HOST:SMOOTHIE_PORT
+        #
+        log.info('INSTANTIATE DRIVERS - smoothie_driver')
+        simulate = (os.environ.get('SMOOTHIE_SIMULATE', 'true')=='true')
+        devices = []
+        for item in os.environ.get('SMOOTHIE_DEVICES', '').split(','):
+            if item.strip() == '':
+                continue
+            device_name, endpoint = item.strip().split('=', 1)
+            device_host, device_port = endpoint.rsplit(':', 1)
+            devices.append((device_name, device_host, int(device_port)))
+        if len(devices) == 0:
+            devices.append(('smoothie', None, None))
 
 
         # ADD DRIVERS
-        print(datetime.datetime.now(),' - ADD DRIVERS ','* * '*10)   
-        driver_client.add_driver(driver_client.id,'','smoothie',smoothie_driver)
-        print(driver_client.drivers(driver_client.id,'',None,None))
+        log.info('ADD DRIVERS')
+        #   DRIVER_WORKERS=true runs each driver in its own worker process (driver_worker.py)
+        for device_name, device_host, device_port in devices:
+            if os.environ.get('DRIVER_WORKERS', 'false') == 'true':
+                smoothie_driver = WorkerDriver(simulate=simulate, name=device_name, host=device_host, port=device_port)
+            else:
+                smoothie_driver = SmoothieDriver(simulate=simulate, name=device_name, host=device_host, port=device_port)
+            driver_client.add_driver(driver_client.id,'',device_name,smoothie_driver)
+        log.info('drivers: %s', driver_client.drivers(driver_client.id,'',None,None))
 
 
         # DEFINE CALLBACKS
@@ -719,98 +1102,115 @@ if __name__ == '__main__':
         #
         #
         #
-        print(datetime.datetime.now(),' - DEFINE CALLBACKS ','* * '*10)
+        log.info('DEFINE CALLBACKS')
         def none(name, from_, session_id, data_dict):
             """
             """
-            print(datetime.datetime.now(),' - driver_client.none:')
-            print('\n\targs: ',locals(),'\n')
+            log.debug('none: %s', data_dict)
             dd_name = list(data_dict)[0]
             dd_value = data_dict[dd_name]
-            driver_client.publish('frontend',from_,session_id,'driver',name,list(data_dict)[0],dd_value)
+            driver_client.publish_position('frontend',from_,session_id,'driver',name,list(data_dict)[0],dd_value)
             if from_ != session_id:
-                driver_client.publish(from_,from_,session_id,'driver',name,list(data_dict)[0],dd_value)
+                driver_client.publish_position(from_,from_,session_id,'driver',name,list(data_dict)[0],dd_value)
 
         def positions(name, from_, session_id, data_dict):
             """
             """
-            print(datetime.datetime.now(),' - driver_client.positions:')
-            print('\n\targs: ',locals(),'\n')
+            log.debug('positions: %s', data_dict)
             dd_name = list(data_dict)[0]
             dd_value = data_dict[dd_name]
-            driver_client.publish('frontend',from_,session_id,'driver',name,list(data_dict)[0],dd_value)
+            driver_client.publish_position('frontend',from_,session_id,'driver',name,list(data_dict)[0],dd_value)
             if from_ != session_id:
-                driver_client.publish(from_,from_,session_id,'driver',name,list(data_dict)[0],dd_value)
+                driver_client.publish_position(from_,from_,session_id,'driver',name,list(data_dict)[0],dd_value)
 
         def adjusted_pos(name, from_, session_id, data_dict):
             """
             """
-            print(datetime.datetime.now(),' - driver_client.adjusted_pos:')
-            print('\n\targs: ',locals(),'\n')
+            log.debug('adjusted_pos: %s', data_dict)
             dd_name = list(data_dict)[0]
             dd_value = data_dict[dd_name]
-            driver_client.publish('frontend',from_,session_id,'driver',name,list(data_dict)[0],dd_value)
+            driver_client.publish_position('frontend',from_,session_id,'driver',name,list(data_dict)[0],dd_value)
             if from_ != session_id:
-                driver_client.publish(from_,from_,session_id,'driver',name,list(data_dict)[0],dd_value)
+                driver_client.publish_position(from_,from_,session_id,'driver',name,list(data_dict)[0],dd_value)
 
         def smoothie_pos(name, from_, session_id, data_dict):
             """
             """
-            print(datetime.datetime.now(),' - driver_client.smoothie_pos:')
-            print('\n\targs: ',locals(),'\n')
+            log.debug('smoothie_pos: %s', data_dict)
             dd_name = list(data_dict)[0]
             dd_value = data_dict[dd_name]
-            driver_client.publish('frontend',from_,session_id,'driver',name,list(data_dict)[0],dd_value)
+            driver_client.publish_position('frontend',from_,session_id,'driver',name,list(data_dict)[0],dd_value)
             if from_ != session_id:
-                driver_client.publish(from_,from_,session_id,'driver',name,list(data_dict)[0],dd_value)
+                driver_client.publish_position(from_,from_,session_id,'driver',name,list(data_dict)[0],dd_value)
 
 
 
 
         # ADD CALLBACKS
-        print('*\t*\t* add callbacks via harness\t*\t*\t*')
-        driver_client.add_callback(driver_client.id,'','smoothie', {none:['None']})
-        driver_client.add_callback(driver_client.id,'','smoothie', {positions:['M114']})
-        driver_client.add_callback(driver_client.id,'','smoothie', {adjusted_pos:['adjusted_pos']})
-        driver_client.add_callback(driver_client.id,'','smoothie', {smoothie_pos:['smoothie_pos']})
+        log.info('add callbacks via harness')
+        for device_name, device_host, device_port in devices:
+            driver_client.add_callback(driver_client.id,'',device_name, {none:['None']})
+            driver_client.add_callback(driver_client.id,'',device_name, {positions:['M114']})
+            driver_client.add_callback(driver_client.id,'',device_name, {adjusted_pos:['adjusted_pos']})
+            driver_client.add_callback(driver_client.id,'',device_name, {smoothie_pos:['smoothie_pos']})
 
         for d in driver_client.drivers(driver_client.id,'',None,None):
-            print (driver_client.callbacks(driver_client.id,'',d, None))
+            log.info('callbacks: %s', driver_client.callbacks(driver_client.id,'',d, None))
 
 
         # ADD METACALLBACKS
-        print(datetime.datetime.now(),' - DEFINE AND ADD META-CALLBACKS ','* * '*10)
-        def on_connect(from_,session_id):
-            print(datetime.datetime.now(),' - driver_client.on_connect')
-            print('\n\targs: ',locals(),'\n')
-            driver_client.publish(from_,from_,session_id,'connect','driver','result','connected')
+        #
+        #   meta-callbacks aren't told which driver they belong to, so each driver gets its own,
+        #   publishing under the driver's name
+        #
+        log.info('DEFINE AND ADD META-CALLBACKS')
+        def add_meta_callbacks(device_name):
+
+            def on_connect(from_,session_id):
+                log.debug('on_connect: %s %s', device_name, from_)
+                driver_client.publish(from_,from_,session_id,'connect',device_name,'result','connected')
+
+            def on_disconnect(from_,session_id):
+                log.debug('on_disconnect: %s %s', device_name, from_)
+                driver_client.publish(from_,from_,session_id,'connect',device_name,'result','disconnected')
+
+            def on_empty_queue(from_,session_id):
+                log.debug('on_empty_queue: %s %s', device_name, from_)
+                driver_client.publish(from_,from_,session_id,'queue',device_name,'result','empty')
+
+            def on_raw_data(from_,session_id,data):
+                log.debug('on_raw_data: %s %r', device_name, data)
+                driver_client.publish(from_,from_,session_id,'raw',device_name,'data',data)
 
-        def on_disconnect(from_,session_id):
-            print(datetime.datetime.now(),' - driver_client.on_disconnect')
-            print('\n\targs: ',locals(),'\n')
-            driver_client.publish(from_,from_,session_id,'connect','driver','result','disconnected')
+            def on_queue_high(from_,session_id,queue_size):
+                log.debug('on_queue_high: %s %s %d', device_name, from_, queue_size)
+                driver_client.publish(from_,from_,session_id,'queue',device_name,'result','high')
 
-        def on_empty_queue(from_,session_id):
-            print(datetime.datetime.now(),' - driver_client.on_empty_queue')
-            print('\n\targs: ',locals(),'\n')
-            driver_client.publish(from_,from_,session_id,'queue','driver','result','empty')
+            def on_queue_low(from_,session_id,queue_size):
+                log.debug('on_queue_low: %s %s %d', device_name, from_, queue_size)
+                driver_client.publish(from_,from_,session_id,'queue',device_name,'result','low')
 
-        def on_raw_data(from_,session_id,data):
-            print(datetime.datetime.now(),' - driver_client.on_raw_data')
-            print('\n\targs: ',locals(),'\n')
-            driver_client.publish(from_,from_,session_id,'raw','driver','data',data)
+            def on_progress(from_,session_id,progress):
+                log.debug('on_progress: %s %s', device_name, progress)
+                driver_client.publish(from_,from_,session_id,'driver',device_name,'progress',progress)
 
+            driver_client.set_meta_callback(driver_client.id,'',device_name,{'on_connect':on_connect})
+            driver_client.set_meta_callback(driver_client.id,'',device_name,{'on_disconnect':on_disconnect})
+            driver_client.set_meta_callback(driver_client.id,'',device_name,{'on_empty_queue':on_empty_queue})
+            driver_client.set_meta_callback(driver_client.id,'',device_name,{'on_raw_data':on_raw_data})
+            driver_client.set_meta_callback(driver_client.id,'',device_name,{'on_progress':on_progress})
+            driver_client.set_meta_callback(driver_client.id,'',device_name,{'on_queue_high':on_queue_high})
+            driver_client.set_meta_callback(driver_client.id,'',device_name,{'on_queue_low':on_queue_low})
 
-        driver_client.set_meta_callback(driver_client.id,'','smoothie',{'on_connect':on_connect})
-        driver_client.set_meta_callback(driver_client.id,'','smoothie',{'on_disconnect':on_disconnect})
-        driver_client.set_meta_callback(driver_client.id,'','smoothie',{'on_empty_queue':on_empty_queue})
-        driver_client.set_meta_callback(driver_client.id,'','smoothie',{'on_raw_data':on_raw_data})
+        for device_name, device_host, device_port in devices:
+            add_meta_callbacks(device_name)
 
         # CONNECT TO DRIVERS:
-        print(datetime.datetime.now(),' - CONNECT TO DRIVERS ','* * '*10)
-        driver_client.driver_connect(driver_client.id,'','smoothie',None)
+        log.info('CONNECT TO DRIVERS')
+        for device_name, device_host, device_port in devices:
+            driver_client.driver_connect(driver_client.id,'',device_name,None)
 
-        print('END INIT')
+        log.info('END INIT')
 
         driver_client.connect(
             url_domain=os.environ.get('CROSSBAR_HOST', '0.0.0.0'),
@@ -820,7 +1220,7 @@ if __name__ == '__main__':
     except KeyboardInterrupt:
         pass
     finally:
-        print('ALL DONE!')
+        log.info('ALL DONE!')
 
 
 
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import collections
+import logging
+import os
+import sys
+
+
+ROOT = 'sandbox_driver'
+
+SUBSYSTEMS = {
+    'smoothie' : 'SmoothieDriver lifecycle, configuration and commands',
+    'flow' : 'flow control: locking, acknowledgements and the command queue',
+    'output' : 'device transport I/O',
+    'parser' : 'parsing device replies',
+    'client' : 'DriverClient',
+    'wamp' : 'WAMP session'
+}
+
+FORMAT = '%(asctime)s - %(name)s: %(message)s'
+
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last capacity log records in memory
+
+    Records are only formatted when they are dumped, so logging into the ring
+    costs no formatting and no I/O
+    """
+
+    def __init__(self, capacity=1000):
+        logging.Handler.__init__(self)
+        self.records = collections.deque(maxlen=capacity)
+        self.setFormatter(logging.Formatter(FORMAT))
+
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+    def dump(self, count=None):
+        records = list(self.records)
+        if count is not None:
+            records = records[-count:]
+        return [self.format(record) for record in records]
+
+
+
+_ring = None
+_stream_handler = None
+
+logging.getLogger(ROOT).addHandler(logging.NullHandler())
+logging.getLogger(ROOT).setLevel(logging.WARNING)
+
+
+def get_logger(subsystem):
+    """Returns the logger for subsystem, eg. get_logger('flow')
+
+    Log with lazy %-style arguments, eg. log.debug('sent %s', line), so nothing
+    is formatted unless the record is actually emitted
+    """
+    return logging.getLogger(ROOT+'.'+subsystem)
+
+
+def set_level(subsystem, level):
+    """Sets the level of subsystem ('all' or None for every subsystem)
+
+    level is a logging level or its name, eg. 'DEBUG'
+    """
+    if isinstance(level, str):
+        level = logging.getLevelName(level.upper())
+        if not isinstance(level, int):
+            raise ValueError('unknown log level')
+    if subsystem in (None, 'all'):
+        logging.getLogger(ROOT).setLevel(level)
+        for name in SUBSYSTEMS:
+            get_logger(name).setLevel(logging.NOTSET)
+    elif subsystem in SUBSYSTEMS:
+        get_logger(subsystem).setLevel(level)
+    else:
+        raise ValueError('unknown log subsystem: '+str(subsystem))
+    return levels()
+
+
+def levels():
+    """Returns { subsystem: effective level name }
+    """
+    return_dict = {'all':logging.getLevelName(logging.getLogger(ROOT).getEffectiveLevel())}
+    for name in SUBSYSTEMS:
+        return_dict[name] = logging.getLevelName(get_logger(name).getEffectiveLevel())
+    return return_dict
+
+
+def configure(spec=None, ring_size=None, stream=sys.stdout, stream_level=None):
+    """Sets up logging for the driver processes
+
+    spec is a comma separated list of levels, eg. 'WARNING,flow=DEBUG,client=INFO', where a
+    bare level applies to every subsystem. Defaults to the DRIVER_LOG environment variable.
+
+    ring_size keeps that many records in memory for dump(). Defaults to the DRIVER_LOG_RING
+    environment variable, 0 turns the ring off.
+
+    stream gets every record at or above stream_level (by default, whatever the subsystem
+    levels let through), None turns stream output off. stream_level defaults to the
+    DRIVER_LOG_STREAM environment variable, so eg. DRIVER_LOG=DEBUG DRIVER_LOG_STREAM=WARNING
+    keeps full diagnostics in the ring while only warnings reach stdout.
+    """
+    global _ring, _stream_handler
+    root = logging.getLogger(ROOT)
+    root.propagate = False
+
+    if spec is None:
+        spec = os.environ.get('DRIVER_LOG', 'INFO')
+    if stream_level is None:
+        stream_level = os.environ.get('DRIVER_LOG_STREAM')
+    if isinstance(stream_level, str):
+        stream_level = stream_level.upper()
+    for item in spec.split(','):
+        item = item.strip()
+        if item == '':
+            continue
+        if '=' in item:
+            subsystem, level = item.split('=', 1)
+            set_level(subsystem.strip(), level.strip())
+        else:
+            set_level('all', item)
+
+    if _stream_handler is not None:
+        root.removeHandler(_stream_handler)
+        _stream_handler = None
+    if stream is not None:
+        _stream_handler = logging.StreamHandler(stream)
+        _stream_handler.setFormatter(logging.Formatter(FORMAT))
+        if stream_level is not None:
+            _stream_handler.setLevel(stream_level)
+        root.addHandler(_stream_handler)
+
+    if ring_size is None:
+        ring_size = int(os.environ.get('DRIVER_LOG_RING', '1000'))
+    if _ring is not None:
+        root.removeHandler(_ring)
+        _ring = None
+    if ring_size > 0:
+        _ring = RingBufferHandler(ring_size)
+        root.addHandler(_ring)
+
+
+def dump(count=None):
+    """Returns the last count (default all) records in the ring buffer, formatted
+    """
+    if _ring is None:
+        return []
+    return _ring.dump(count)
+
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+
+import asyncio
+import itertools
+import multiprocessing
+import queue
+import sys
+import threading
+from collections import Callable
+from multiprocessing.reduction import ForkingPickler
+
+import driver_log
+
+
+log = driver_log.get_logger('client')
+
+
+AXES = ('X', 'Y', 'Z', 'A', 'B', 'C')
+
+# layout of the shared-memory block, after the sequence number at index 0
+SHARED_FIELDS = (
+    ('version',),
+    ('connected',),
+    ('locked',),
+    ('queue_size',),
+    ('in_flight',)
+) + tuple(('smoothie_pos', axis) for axis in AXES) + tuple(('adjusted_pos', axis) for axis in AXES)
+
+# SmoothieDriver methods a WorkerDriver forwards to its worker process
+REMOTE_METHODS = (
+    'flow', 'clear_queue', 'connect', 'disconnect', 'commands', 'configs', 'set_config',
+    'set_command', 'unlock', 'send_command', 'send_commands', 'precompile', 'run_precompiled',
+    'run_file'
+)
+
+# methods with nothing to return, sent without waiting for the worker (send_command waits, it
+# can be refused with QueueFull)
+ONE_WAY_METHODS = ('connect', 'disconnect')
+
+
+
+def write_shared(shared, state_dict):
+    """Copies state_dict's SHARED_FIELDS into shared, as a seqlock writer
+
+    shared[0] is odd while the block is being written, readers retry until they see the same
+    even value before and after reading
+    """
+    shared[0] += 1
+    for index, field in enumerate(SHARED_FIELDS, 1):
+        if field[0] == 'version':
+            value = state_dict.version
+        elif len(field) == 1:
+            value = state_dict[field[0]]
+        else:
+            value = state_dict[field[0]].get(field[1], 0)
+        shared[index] = float(value)
+    shared[0] += 1
+
+
+def read_shared(shared, attempts=100):
+    """Returns a consistent copy of the shared-memory block as a dict, or None if it kept changing
+    """
+    for attempt in range(attempts):
+        before = shared[0]
+        if before % 2 == 1:
+            continue
+        values = shared[1:len(SHARED_FIELDS)+1]
+        if shared[0] != before:
+            continue
+        return_dict = {'smoothie_pos':{}, 'adjusted_pos':{}}
+        for field, value in zip(SHARED_FIELDS, values):
+            if field[0] in ('connected', 'locked'):
+                return_dict[field[0]] = bool(value)
+            elif len(field) == 1:
+                return_dict[field[0]] = int(value)
+            else:
+                return_dict[field[0]][field[1]] = value
+        return return_dict
+    return None
+
+
+
+class DriverWorker():
+    """Runs a SmoothieDriver in a worker process, on the worker's own event loop
+
+    Requests come in over conn as ('call', id, method, args) and are answered with
+    ('result', id, ok, value). Callback and meta-callback calls go back as
+    ('callback', message, args) and ('meta', name, args). State is copied into the
+    shared-memory block every share_interval seconds when it changed.
+
+    Everything sent back is pickled on the event loop but written to conn by a sender
+    thread, so a full pipe (a busy DriverClient) never blocks the driver's event loop.
+    """
+
+    def __init__(self, conn, shared, driver, loop, share_interval=0.005):
+        self.conn = conn
+        self.shared = shared
+        self.driver = driver
+        self.loop = loop
+        self.share_interval = share_interval
+        self.shared_version = None
+        self.forwarded = set()
+        self.outbox = queue.Queue()
+        self.sender = threading.Thread(target=self._send_outbox, name='driver-worker-sender', daemon=True)
+        for name in driver.meta_callbacks_dict:
+            driver.set_meta_callback(name, self._meta_forwarder(name))
+
+
+    def start(self):
+        self.sender.start()
+        self.loop.add_reader(self.conn.fileno(), self.on_readable)
+        self.share_state()
+
+
+    def on_readable(self):
+        try:
+            while self.conn.poll():
+                self.handle(self.conn.recv())
+        except (EOFError, OSError):
+            log.info('DriverWorker: pipe closed, stopping')
+            self.loop.remove_reader(self.conn.fileno())
+            self.outbox.put(None)
+            self.loop.stop()
+
+
+    def handle(self, request):
+        kind, call_id, method, args = request
+        try:
+            if method == 'forward':
+                value = self.forward(args[0])
+            elif method in REMOTE_METHODS:
+                value = getattr(self.driver, method)(*args)
+            else:
+                raise ValueError('not a remote method: '+str(method))
+        except Exception:
+            if method in ONE_WAY_METHODS:
+                log.exception('DriverWorker: %s failed', method)
+            else:
+                # raised again in the DriverClient, which reports it
+                log.debug('DriverWorker: %s failed', method, exc_info=True)
+                self._send(('result', call_id, False, sys.exc_info()[1]))
+            return
+        if method not in ONE_WAY_METHODS:
+            self._send(('result', call_id, True, value))
+
+
+    def _send(self, message):
+        """Queues message for the sender thread
+        """
+        try:
+            data = ForkingPickler.dumps(message)
+        except Exception:
+            log.exception('DriverWorker: cannot send %r', message[0])
+            if message[0] != 'result':
+                return
+            # the call still gets its answer
+            data = ForkingPickler.dumps(('result', message[1], False, TypeError('cannot send the result: '+str(sys.exc_info()[1]))))
+        self.outbox.put(data)
+
+
+    def _send_outbox(self):
+        """Writes the outbox to conn, until it gets None or the pipe is closed
+        """
+        while True:
+            data = self.outbox.get()
+            if data is None:
+                return
+            try:
+                self.conn.send_bytes(data)
+            except (EOFError, OSError):
+                log.info('DriverWorker: pipe closed, sender stopping')
+                return
+
+
+    def forward(self, messages):
+        """Makes the driver send the calls of callbacks for messages back to the DriverClient
+        """
+        for message in self.forwarded - set(messages):
+            self.driver.remove_callback(self._forwarder_name(message))
+        for message in set(messages) - self.forwarded:
+            self.driver.add_callback(self._forwarder(message), [message])
+        self.forwarded = set(messages)
+        return sorted(self.forwarded)
+
+
+    def share_state(self):
+        if self.driver.state_dict.version != self.shared_version:
+            self.shared_version = self.driver.state_dict.version
+            write_shared(self.shared, self.driver.state_dict)
+        self.loop.call_later(self.share_interval, self.share_state)
+
+
+    def _forwarder_name(self, message):
+        return 'forward_'+str(message)
+
+
+    def _forwarder(self, message):
+        def forward(name, from_, session_id, data):
+            self._send(('callback', message, (name, from_, session_id, data)))
+        forward.__name__ = self._forwarder_name(message)
+        return forward
+
+
+    def _meta_forwarder(self, meta_name):
+        def forward(*args):
+            self._send(('meta', meta_name, args))
+        forward.__name__ = 'forward_'+meta_name
+        return forward
+
+
+
+def worker_main(conn, shared, driver_kwargs):
+    """Entry point of a worker process
+    """
+    from smoothie_driver import SmoothieDriver
+    driver_log.configure()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    driver = SmoothieDriver(**driver_kwargs)
+    DriverWorker(conn, shared, driver, loop).start()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+
+class WorkerDriver():
+    """Stands in for a SmoothieDriver that runs in its own worker process
+
+    The worker owns the device connection, command queue and flow control, so device timing
+    doesn't depend on how busy the DriverClient's event loop is. Driver methods are forwarded
+    over a pipe and return Futures of the worker's answers, so waiting for one never blocks the
+    event loop; callbacks and meta-callbacks stay in this process and are called with what the
+    worker sends back. shared_state() reads positions and flow state from a shared-memory block
+    without asking the worker at all.
+    """
+
+    def __init__(self, simulate=True, name='smoothie', host=None, port=None, loop=None, timeout=5.0):
+        self.name = name
+        self.timeout = timeout
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.callbacks_dict = {}
+        self.meta_callbacks_dict = {
+            'on_connect' : None,
+            'on_disconnect' : None,
+            'on_empty_queue' : None,
+            'on_raw_data' : None,
+            'on_progress' : None,
+            'on_queue_high' : None,
+            'on_queue_low' : None
+        }
+        self.call_ids = itertools.count()
+        self.pending = {}   # call id: Future of the worker's reply
+
+        context = multiprocessing.get_context('spawn')
+        self.shared = context.RawArray('d', len(SHARED_FIELDS)+1)
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=worker_main,
+            args=(child_conn, self.shared, {'simulate':simulate, 'name':name, 'host':host, 'port':port}),
+            name='driver-'+name,
+            daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.loop.add_reader(self.conn.fileno(), self.on_readable)
+
+
+    def shared_state(self):
+        """Returns {'version', 'connected', 'locked', 'queue_size', 'in_flight', 'smoothie_pos', 'adjusted_pos'}
+        """
+        return read_shared(self.shared)
+
+
+    def on_readable(self):
+        try:
+            while self.conn.poll():
+                self._receive(self.conn.recv())
+        except (EOFError, OSError):
+            log.error('WorkerDriver %s: worker process is gone', self.name)
+            self.loop.remove_reader(self.conn.fileno())
+            self._abandon_calls(EOFError('worker '+self.name+' is gone'))
+
+
+    def _receive(self, message):
+        kind = message[0]
+        if kind == 'result':
+            kind, call_id, ok, value = message
+            future = self.pending.pop(call_id, None)
+            if future is None or future.done():
+                # the call timed out (or its caller gave up) before the worker answered
+                log.warning('WorkerDriver %s: late reply to call %s dropped', self.name, call_id)
+            elif ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        elif kind == 'callback':
+            kind, name, args = message
+            for callback in list(self.callbacks_dict.values()):
+                if name in callback['messages']:
+                    callback['callback'](*args)
+        elif kind == 'meta':
+            kind, name, args = message
+            callback = self.meta_callbacks_dict.get(name)
+            if isinstance(callback, Callable):
+                callback(*args)
+        else:
+            log.error('WorkerDriver %s: unknown message from worker: %r', self.name, kind)
+
+
+    def _call(self, method, *args):
+        """Sends method to the worker, returns a Future of its result (None for ONE_WAY_METHODS)
+
+        The Future fails with TimeoutError if the worker hasn't answered within timeout seconds
+        """
+        call_id = next(self.call_ids)
+        self.conn.send(('call', call_id, method, args))
+        if method in ONE_WAY_METHODS:
+            return None
+        future = asyncio.Future(loop=self.loop)
+        self.pending[call_id] = future
+        timer = self.loop.call_later(self.timeout, self._expire, call_id, method)
+        future.add_done_callback(lambda future: timer.cancel())
+        return future
+
+
+    def _expire(self, call_id, method):
+        future = self.pending.pop(call_id, None)
+        if future is not None and not future.done():
+            future.set_exception(TimeoutError('worker '+self.name+' did not answer '+method))
+
+
+    def _abandon_calls(self, exception):
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exception)
+
+
+    def _forward_callbacks(self):
+        messages = set()
+        for callback in self.callbacks_dict.values():
+            messages.update(callback['messages'])
+        self._call('forward', sorted(messages)).add_done_callback(self._forwarded)
+
+
+    def _forwarded(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error('WorkerDriver %s: forwarding callbacks failed: %s', self.name, future.exception())
+
+
+    def callbacks(self):
+        return_dict = {}
+        for name, value in self.callbacks_dict.items():
+            return_dict[name] = value['messages']
+        return return_dict
+
+
+    def add_callback(self, callback, messages):
+        if not isinstance(messages, list):
+            messages = [messages]
+        if callback.__name__ not in self.callbacks_dict:
+            self.callbacks_dict[callback.__name__] = {'callback':callback, 'messages':list(messages)}
+        else:
+            for message in messages:
+                if message not in self.callbacks_dict[callback.__name__]['messages']:
+                    self.callbacks_dict[callback.__name__]['messages'].append(message)
+        self._forward_callbacks()
+        return self.callbacks()
+
+
+    def remove_callback(self, callback_name):
+        del self.callbacks_dict[callback_name]
+        self._forward_callbacks()
+        return self.callbacks()
+
+
+    def meta_callbacks(self):
+        return_dict = dict()
+        for name, value in self.meta_callbacks_dict.items():
+            if value is not None and isinstance(value, Callable):
+                return_dict[name] = value.__name__
+            else:
+                return_dict[name] = 'None'
+        return return_dict
+
+
+    def set_meta_callback(self, name, callback):
+        if name in self.meta_callbacks_dict and isinstance(callback, Callable):
+            self.meta_callbacks_dict[name] = callback
+        else:
+            return '{error:name not in meta_callbacks or callback is not Callable}'
+        return self.meta_callbacks()
+
+
+    def flow(self, since=None):
+        if since is not None:
+            shared = self.shared_state()
+            if shared is not None and shared['version'] == since:
+                return {'version':since}
+        return self._call('flow', since)
+
+
+    def clear_queue(self):
+        return self._call('clear_queue')
+
+
+    def connect(self, from_, session_id, device=None, port=None):
+        return self._call('connect', from_, session_id, device, port)
+
+
+    def disconnect(self, from_, session_id):
+        return self._call('disconnect', from_, session_id)
+
+
+    def commands(self):
+        return self._call('commands')
+
+
+    def configs(self):
+        return self._call('configs')
+
+
+    def set_config(self, config, setting):
+        return self._call('set_config', config, setting)
+
+
+    def set_command(self, command, code, parameters, lane=None):
+        return self._call('set_command', command, code, parameters, lane)
+
+
+    def unlock(self):
+        return self._call('unlock')
+
+
+    def send_command(self, from_, session_id, data, lane=None):
+        return self._call('send_command', from_, session_id, data, lane)
+
+
+    def send_commands(self, from_, session_id, data_list, lane=None):
+        return self._call('send_commands', from_, session_id, data_list, lane)
+
+
+    def precompile(self, protocol):
+        return self._call('precompile', protocol)
+
+
+    def run_precompiled(self, from_, session_id, key):
+        return self._call('run_precompiled', from_, session_id, key)
+
+
+    def run_file(self, from_, session_id, path):
+        return self._call('run_file', from_, session_id, path)
+
+
+    def close(self):
+        """Stops the worker process
+        """
+        self.loop.remove_reader(self.conn.fileno())
+        self.conn.close()
+        self._abandon_calls(EOFError('worker '+self.name+' was closed'))
+        self.process.join(self.timeout)
+
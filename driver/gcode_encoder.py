@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+
+
+
+
+class GCodeEncoder(object):
+	"""
+	commands_dict compiled into the lookups needed to turn commands into G-code lines:
+
+	codes - command name -> code
+	by_code - code -> command name (so a raw code like 'G0' maps back to its command)
+	parameters - command name -> set of acceptable parameters
+	lanes - command name -> default command queue lane
+	prefixes - command name -> encoded code
+
+	Fully encoded lines (message_ender included) are kept in an LRU cache, since protocols
+	repeat the same moves over and over.
+
+	Call compile() again whenever commands_dict or message_ender changes.
+	"""
+
+
+	def __init__(self, commands_dict, message_ender="\r\n", cache_size=256):
+		self.cache_size = cache_size
+		self.compile(commands_dict, message_ender)
+
+
+	def compile(self, commands_dict, message_ender):
+		self.codes = {}
+		self.by_code = {}
+		self.parameters = {}
+		self.lanes = {}
+		self.prefixes = {}
+		for name, value in commands_dict.items():
+			code = value.get("code","")
+			self.codes[name] = code
+			if code not in self.by_code:
+				self.by_code[code] = name
+			self.parameters[name] = frozenset(value.get("parameters",[]))
+			self.lanes[name] = value.get("lane","normal")
+			self.prefixes[name] = code.encode()
+		self.ender = message_ender.encode()
+		self.cache = OrderedDict()
+
+
+	def lookup(self, command):
+		"""Returns the command name for a command name or code, or None if it is neither
+		"""
+		if command in self.codes:
+			return command
+		return self.by_code.get(command)
+
+
+	def encode(self, name, params=()):
+		"""Returns the encoded line for command name with params, a tuple of (parameter, value) pairs
+		"""
+		key = (name, params)
+		try:
+			line = self.cache[key]
+		except KeyError:
+			pass
+		except TypeError:
+			# unhashable value, can't be cached
+			return self._encode(name, params)
+		else:
+			self.cache.move_to_end(key)
+			return line
+
+		line = self._encode(name, params)
+		if self.cache_size > 0:
+			self.cache[key] = line
+			if len(self.cache) > self.cache_size:
+				self.cache.popitem(last=False)
+		return line
+
+
+	def _encode(self, name, params):
+		if len(params) == 0:
+			return self.prefixes[name] + self.ender
+		return self.prefixes[name] + ''.join([' '+str(param)+str(val) for param, val in params]).encode() + self.ender
+
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+
+
+
+class LineFramer(object):
+	"""
+	Splits incoming bytes into delimited lines
+
+	Complete lines are handed back as bytes, delimiter included, sliced once out of the data
+	they arrived in. Only a trailing partial line is kept, in a bytearray, and when more data
+	arrives only the new bytes are scanned for the delimiter, so lines arriving in small
+	fragments cost no more than lines arriving whole.
+
+	Nothing is decoded here; consumers decode the lines they actually need as text.
+
+	If a partial line grows past max_buffer bytes without a delimiter it is dropped and
+	overflows is incremented. The rest of that line, up to and including its delimiter, is
+	dropped as it arrives, so no fragment of it is ever handed back as a line.
+
+	kinds maps exact lines (delimiter included) to what they are, so that classify() can pick
+	out well known lines, like acknowledgements, with a single dict lookup.
+	"""
+
+
+	def __init__(self, delimiter=b'\n', max_buffer=4096):
+		self.delimiter = delimiter
+		self.max_buffer = max_buffer
+		self.buffer = bytearray()
+		self.overflows = 0
+		self.discarding = False	# dropping the rest of an oversized line
+		self.kinds = {}
+
+
+	def feed(self, data):
+		"""Returns the list of lines completed by data
+		"""
+		lines = []
+		delimiter = self.delimiter
+		step = len(delimiter)
+		start = 0
+
+		if self.discarding:
+			# the buffer only holds what could be the start of a delimiter
+			data = bytes(self.buffer) + data
+			del self.buffer[:]
+			end = data.find(delimiter)
+			if end < 0:
+				self.buffer += data[max(0, len(data) - step + 1):]
+				return lines
+			self.discarding = False
+			start = end + step
+
+		if len(self.buffer) > 0:
+			scanned = len(self.buffer)
+			self.buffer += data
+			# a delimiter can only start in the new bytes (or straddle into them)
+			end = self.buffer.find(delimiter, max(0, scanned - step + 1))
+			if end < 0:
+				self._check_bound()
+				return lines
+			with memoryview(self.buffer) as view:
+				lines.append(bytes(view[:end+step]))
+			del self.buffer[:]
+			start = end + step - scanned
+
+		end = data.find(delimiter, start)
+		while end >= 0:
+			lines.append(data[start:end+step])
+			start = end + step
+			end = data.find(delimiter, start)
+
+		if start < len(data):
+			with memoryview(data) as view:
+				self.buffer += view[start:]
+			self._check_bound()
+		return lines
+
+
+	def classify(self, line):
+		"""Returns what line is according to kinds, or None if it isn't a well known line
+		"""
+		return self.kinds.get(line)
+
+
+	def clear(self):
+		del self.buffer[:]
+		self.discarding = False
+
+
+	def set_delimiter(self, delimiter):
+		"""Splits lines at delimiter from now on, returns the lines the partial line already holds
+		"""
+		partial = bytes(self.buffer)
+		discarding = self.discarding
+		self.clear()
+		self.delimiter = delimiter
+		self.discarding = discarding
+		return self.feed(partial)
+
+
+	def _check_bound(self):
+		if len(self.buffer) > self.max_buffer:
+			self.overflows += 1
+			self.discarding = True
+			keep = len(self.delimiter) - 1
+			if keep > 0:
+				del self.buffer[:-keep]
+			else:
+				del self.buffer[:]
+
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+import asyncio
+
+
+
+class LoopbackTransport(asyncio.Transport):
+	"""
+	One end of an in-process connection: what is written to it is received by the protocol at the
+	other end, on a later event loop iteration, with no sockets involved
+
+	Writes arriving before the receiver gets to them are delivered together, as one
+	data_received call, like a socket would. pause_reading holds delivery to this end's protocol
+	until resume_reading. Closing either end gives the other end's protocol eof_received after
+	any data still on its way, and both protocols connection_lost.
+	"""
+
+
+	def __init__(self, loop, protocol):
+		super().__init__()
+		self.loop = loop
+		self.protocol = protocol
+		self.peer = None
+		self.incoming = bytearray()
+		self.eof = False	# the peer closed, eof_received is due after incoming
+		self.flush_handle = None
+		self.paused = False
+		self.closing = False
+
+
+	def get_extra_info(self, name, default=None):
+		if name == 'peername':
+			return 'loopback'
+		return default
+
+
+	def is_closing(self):
+		return self.closing
+
+
+	def set_protocol(self, protocol):
+		self.protocol = protocol
+
+
+	def get_protocol(self):
+		return self.protocol
+
+
+	def get_write_buffer_size(self):
+		return 0
+
+
+	def can_write_eof(self):
+		return False
+
+
+	def write(self, data):
+		if self.closing or len(data) == 0:
+			return
+		self.peer._receive(data)
+
+
+	def pause_reading(self):
+		self.paused = True
+
+
+	def resume_reading(self):
+		if self.paused:
+			self.paused = False
+			self._schedule_flush()
+
+
+	def close(self):
+		if self.closing:
+			return
+		self.closing = True
+		self.peer._receive_eof()
+		self.loop.call_soon(self.protocol.connection_lost, None)
+
+
+	def abort(self):
+		self.close()
+
+
+	def _receive(self, data):
+		if self.closing:
+			return
+		self.incoming += data
+		self._schedule_flush()
+
+
+	def _receive_eof(self):
+		self.eof = True
+		self._schedule_flush()
+
+
+	def _schedule_flush(self):
+		if self.flush_handle is None and not self.paused:
+			self.flush_handle = self.loop.call_soon(self._flush)
+
+
+	def _flush(self):
+		self.flush_handle = None
+		if self.paused or self.closing:
+			return
+		if len(self.incoming) > 0:
+			data = bytes(self.incoming)
+			del self.incoming[:]
+			self.protocol.data_received(data)
+		if self.eof and not self.paused and len(self.incoming) == 0:
+			self.eof = False
+			if not self.protocol.eof_received():
+				self.close()
+
+
+
+def transport_pair(loop, protocol, peer_protocol):
+	"""Returns the connected (transport, peer transport) for protocol and peer_protocol
+	"""
+	transport = LoopbackTransport(loop, protocol)
+	peer_transport = LoopbackTransport(loop, peer_protocol)
+	transport.peer = peer_transport
+	peer_transport.peer = transport
+	return (transport, peer_transport)
+
+
+def create_connection(protocol_factory, client_connected_cb, loop=None):
+	"""
+	Like loop.create_connection, to a server in this process: client_connected_cb(reader, writer)
+	is what asyncio.start_server would be given, eg. smoothie_simulator.simulator
+
+	Nothing has to be waited for, so it isn't a coroutine: both ends are connected on return
+
+	returns (transport, protocol)
+	"""
+	if loop is None:
+		loop = asyncio.get_event_loop()
+	protocol = protocol_factory()
+	reader = asyncio.StreamReader(loop=loop)
+	server_protocol = asyncio.StreamReaderProtocol(reader, client_connected_cb, loop=loop)
+	transport, server_transport = transport_pair(loop, protocol, server_protocol)
+	server_protocol.connection_made(server_transport)
+	protocol.connection_made(transport)
+	return (transport, protocol)
+
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+
+
+
+# codes whose line sets a mode that stays in effect until the same code is sent again
+MODAL_CODES = (b'F', b'a', b'b', b'c', b'M198', b'M199', b'M203', b'M204', b'M205')
+
+MODE_CODES = (b'G90', b'G91')
+
+MOTION_CODES = (b'G0', b'G1')
+
+
+
+def _format_number(value):
+	if value == int(value):
+		return str(int(value)).encode()
+	return ('%.6f' % value).rstrip('0').rstrip('.').encode()
+
+
+
+
+class MotionOptimizer(object):
+	"""
+	Removes lines from the normal lane of the command queue before they are queued:
+
+	- relative moves (G91 G0/G1) following an unsent relative move with the same codes, in the
+	  same direction along the same line, are merged into it, eg. 'G91 G0 X1 Y1' followed by
+	  'G91 G0 X2 Y2' becomes 'G91 G0 X3 Y3'. Moves that turn a corner are never merged, so the
+	  path stays the same.
+	- G90/G91 lines are dropped when that mode is already in effect
+	- modal lines (feed rates, accelerations, ...) are dropped when they repeat the last one
+
+	It works on encoded lines and only knows about the lines it was offered, so reset() must be
+	called whenever anything else reaches the device (other lanes, halt, a new connection) or
+	queued lines are thrown away.
+	"""
+
+
+	def __init__(self, message_ender=b'\r\n'):
+		self.ender = message_ender
+		self.eliminated = 0
+		self.reset()
+
+
+	def reset(self):
+		self.mode = None
+		self.modal = {}
+
+
+	def optimize(self, line, tail=None):
+		"""Offers line for the queue, tail is the line it would follow if that can still be changed
+
+		Returns None if line should be queued as it is, b'' if it is redundant, or the line
+		that should replace tail
+		"""
+		parsed = self._parse(line)
+		if parsed is None:
+			self.reset()
+			return None
+		codes, axes, others = parsed
+
+		if len(axes) == 0 and len(others) == 0 and len(codes) == 1 and codes[0] in MODE_CODES:
+			if self.mode == codes[0]:
+				self.eliminated += 1
+				return b''
+			self.mode = codes[0]
+			return None
+
+		if len(codes) > 0 and codes[0] in MODAL_CODES:
+			if self.modal.get(codes[0]) == line:
+				self.eliminated += 1
+				return b''
+			self.modal[codes[0]] = line
+			return None
+
+		for token in others:
+			if token.startswith(b'F'):
+				self.modal.pop(b'F', None)
+		for code in codes:
+			if code in MODE_CODES:
+				self.mode = code
+
+		if tail is not None and len(others) == 0 and len(axes) > 0 and b'G91' in codes and any(code in MOTION_CODES for code in codes):
+			merged = self._merge(tail, codes, axes)
+			if merged is not None:
+				self.eliminated += 1
+				return merged
+		return None
+
+
+	def _merge(self, tail, codes, axes):
+		parsed = self._parse(tail)
+		if parsed is None:
+			return None
+		tail_codes, tail_axes, tail_others = parsed
+		if tail_codes != codes or len(tail_others) > 0 or len(tail_axes) == 0:
+			return None
+		names = [axis for axis in tail_axes] + [axis for axis in axes if axis not in tail_axes]
+		first = [tail_axes.get(axis, 0.0) for axis in names]
+		second = [axes.get(axis, 0.0) for axis in names]
+		# same direction along the same line: the cross products vanish and the dot product is positive
+		scale = max(abs(value) for value in first + second)
+		tolerance = 1e-9 * scale * scale
+		if sum(a*b for a, b in zip(first, second)) <= 0:
+			return None
+		for i in range(len(names)):
+			for j in range(i+1, len(names)):
+				if abs(first[i]*second[j] - first[j]*second[i]) > tolerance:
+					return None
+		params = [axis + _format_number(a + b) for axis, a, b in zip(names, first, second)]
+		return b' '.join(list(codes) + params) + self.ender
+
+
+	def _parse(self, line):
+		"""Splits an encoded line into (codes, {axis: value}, other parameters), or None if it can't be read
+		"""
+		if not line.endswith(self.ender):
+			return None
+		codes = []
+		axes = OrderedDict()
+		others = []
+		for token in line[:-len(self.ender)].split():
+			if token[:1] in (b'G', b'M') or token in MODAL_CODES:
+				codes.append(token)
+			elif token[:1] in (b'X', b'Y', b'Z', b'A', b'B', b'C') and len(token) > 1:
+				try:
+					axes[token[:1]] = float(token[1:])
+				except ValueError:
+					return None
+			else:
+				others.append(token)
+		return (tuple(codes), axes, others)
+
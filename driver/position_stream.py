@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+import asyncio
+
+
+
+class PositionStream():
+    """Coalesces position updates and publishes them at most max_rate times a second
+
+    Updates are kept per (topic, to, name, message), so every client gets its own stream.
+    The latest value wins: an update arriving before the stream's next slot replaces the
+    held one, and dict values are merged so axes reported separately (eg. {'X':..} then
+    {'Y':..}) go out together. A held update is always published when its slot comes up,
+    so the final resting position is never lost.
+
+    A max_rate of 0 (or None) turns coalescing off and publishes every update immediately.
+    """
+
+    def __init__(self, publish, max_rate=30.0, loop=None):
+        """
+        publish: called with (topic, to, session_id, type_, name, message, param), eg. DriverClient.publish
+        """
+        self.publish = publish
+        self.max_rate = max_rate
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.pending = {}
+        self.last_sent = {}
+        self.timers = {}
+
+
+    def update(self, topic, to, session_id, type_, name, message, param):
+        if not self.max_rate:
+            self.publish(topic, to, session_id, type_, name, message, param)
+            return
+
+        key = (topic, to, name, message)
+        held = self.pending.get(key)
+        if held is not None and isinstance(held[6], dict) and isinstance(param, dict):
+            merged = dict(held[6])
+            merged.update(param)
+            param = merged
+        args = (topic, to, session_id, type_, name, message, param)
+
+        if key in self.timers:
+            self.pending[key] = args
+            return
+
+        wait = self.last_sent.get(key, float('-inf')) + 1.0/self.max_rate - self.loop.time()
+        if wait <= 0:
+            self.pending.pop(key, None)
+            self._send(key, args)
+        else:
+            self.pending[key] = args
+            self.timers[key] = self.loop.call_later(wait, self._flush_key, key)
+
+
+    def flush(self):
+        """Publishes every held update now
+        """
+        for key in list(self.timers):
+            self.timers.pop(key).cancel()
+            self._flush_key(key)
+
+
+    def _flush_key(self, key):
+        self.timers.pop(key, None)
+        args = self.pending.pop(key, None)
+        if args is not None:
+            self._send(key, args)
+
+
+    def _send(self, key, args):
+        self.last_sent[key] = self.loop.time()
+        self.publish(*args)
+
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+import driver_log
+
+
+log = driver_log.get_logger('smoothie')
+
+
+# bump whenever artifacts or the way lines are built change, so older artifacts are not used
+FORMAT = 2
+
+_KEY = re.compile(r'[0-9a-f]{64}')
+
+
+
+def default_cache_dir():
+	"""$XDG_CACHE_HOME/sandbox-driver, or ~/.cache/sandbox-driver
+	"""
+	base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+	return os.path.join(base, 'sandbox-driver')
+
+
+
+class Precompiler(object):
+	"""
+	Content-addressed on-disk cache of compiled protocols
+
+	A protocol (a list of commands, as send_commands takes them) compiles into a finished G-code
+	byte stream, stored in cache_dir as <key>.gcode, where key is the sha256 of everything that
+	goes into it: the protocol, commands_dict, message_ender, slack, and the direction and position
+	the axes start from. <key>.json next to it (the sidecar) holds the line count, the lines that
+	don't go in the normal lane, and the direction and position the moves start from and leave the
+	axes at. Compiling is SmoothieDriver's job, this only hashes, stores and loads.
+
+	The sidecar is written last, so an artifact without one is incomplete and ignored. It also
+	holds the sha256 of the G-code, which is checked on every load.
+
+	cache_dir is created private (0700), and is only used while it belongs to this user and
+	nobody else can write to it, since whatever is loaded from it goes to the device as it is.
+	"""
+
+
+	def __init__(self, cache_dir=None):
+		if cache_dir is None:
+			cache_dir = os.environ.get('DRIVER_CACHE_DIR') or default_cache_dir()
+		self.cache_dir = cache_dir
+
+
+	def key(self, protocol, commands_dict, message_ender, slack, direction, position):
+		inputs = {
+			'format':FORMAT,
+			'protocol':protocol,
+			'commands':commands_dict,
+			'message_ender':message_ender,
+			'slack':{axis:float(value) for axis, value in slack.items()},
+			'direction':direction,
+			'position':{axis:float(value) for axis, value in position.items()}
+		}
+		text = json.dumps(inputs, sort_keys=True, separators=(',',':'), default=str)
+		return hashlib.sha256(text.encode()).hexdigest()
+
+
+	def paths(self, key):
+		"""Returns the (G-code, sidecar) paths for key, raises ValueError if key isn't a key
+		"""
+		if not isinstance(key, str) or _KEY.fullmatch(key) is None:
+			raise ValueError('not a precompiled protocol key: '+str(key))
+		path = os.path.join(self.cache_dir, key)
+		return (path+'.gcode', path+'.json')
+
+
+	def load(self, key):
+		"""Returns (G-code bytes, sidecar dict) for key, or None if it isn't cached (or is damaged)
+		"""
+		gcode_path, sidecar_path = self.paths(key)
+		try:
+			self._check_dir()
+			with open(sidecar_path, 'r') as sidecar_file:
+				sidecar = json.load(sidecar_file)
+			with open(gcode_path, 'rb') as gcode_file:
+				data = gcode_file.read()
+		except FileNotFoundError:
+			return None
+		except (OSError, ValueError):
+			log.warning('Precompiler: cannot read %s', key, exc_info=True)
+			return None
+		if sidecar.get('format') != FORMAT or sidecar.get('bytes') != len(data) or sidecar.get('sha256') != hashlib.sha256(data).hexdigest():
+			log.warning('Precompiler: %s is stale or damaged, ignored', key)
+			return None
+		return (data, sidecar)
+
+
+	def store(self, key, data, sidecar):
+		"""Writes data and sidecar (format, bytes and sha256 are added) for key, each atomically
+		"""
+		gcode_path, sidecar_path = self.paths(key)
+		os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+		self._check_dir()
+		sidecar = dict(sidecar, format=FORMAT, bytes=len(data), sha256=hashlib.sha256(data).hexdigest())
+		self._write(gcode_path, data)
+		self._write(sidecar_path, json.dumps(sidecar, sort_keys=True).encode())
+
+
+	def _check_dir(self):
+		"""Raises PermissionError unless cache_dir belongs to this user and only this user can write to it
+		"""
+		status = os.stat(self.cache_dir)
+		if hasattr(os, 'getuid') and status.st_uid != os.getuid():
+			raise PermissionError('cache directory belongs to another user: '+self.cache_dir)
+		if status.st_mode & 0o022:
+			raise PermissionError('cache directory is writable by others: '+self.cache_dir)
+
+
+	def _write(self, path, data):
+		descriptor, temporary = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+		try:
+			with os.fdopen(descriptor, 'wb') as temporary_file:
+				temporary_file.write(data)
+			os.replace(temporary, path)
+		except:
+			os.unlink(temporary)
+			raise
+
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import asyncio
+from collections import deque
+
+import driver_log
+
+
+log = driver_log.get_logger('output')
+
+
+
+class LineScheduler(object):
+	"""
+	Shares the event loop fairly between the devices of one process
+
+	Each connection (Output) hands its received lines to deliver(). While nobody has a backlog,
+	up to quantum lines are handled straight away, so a single device pays nothing extra. Lines
+	beyond that wait in the connection's pending deque, and connections with pending lines are
+	served round robin, quantum lines per turn, one round per event loop iteration, so other
+	devices' I/O callbacks run in between. A connection whose backlog grows past max_pending
+	lines has its transport paused until the backlog is cleared.
+
+	A connection needs: pending (a deque), transport, paused, and handle_line(line).
+	"""
+
+
+	def __init__(self, quantum=32, max_pending=1024):
+		self.quantum = quantum
+		self.max_pending = max_pending
+		self.ready = deque()
+		self.handle = None
+
+
+	def deliver(self, source, lines):
+		if len(self.ready) == 0 and len(source.pending) == 0:
+			count = min(len(lines), self.quantum)
+			for index in range(count):
+				self._handle(source, lines[index])
+			lines = lines[count:]
+		if len(lines) == 0:
+			return
+		source.pending.extend(lines)
+		if source not in self.ready:
+			self.ready.append(source)
+		if len(source.pending) > self.max_pending and not source.paused and source.transport is not None:
+			log.debug('LineScheduler: pausing %s, %d lines pending', source, len(source.pending))
+			source.transport.pause_reading()
+			source.paused = True
+		if self.handle is None:
+			self.handle = asyncio.get_event_loop().call_soon(self.run)
+
+
+	def run(self):
+		"""Serves every connection with pending lines once, quantum lines each
+		"""
+		self.handle = None
+		for turn in range(len(self.ready)):
+			source = self.ready.popleft()
+			for count in range(min(self.quantum, len(source.pending))):
+				self._handle(source, source.pending.popleft())
+			if len(source.pending) > 0:
+				self.ready.append(source)
+			else:
+				self._resume(source)
+		if len(self.ready) > 0:
+			self.handle = asyncio.get_event_loop().call_soon(self.run)
+
+
+	def drain(self, source):
+		"""Handles all of source's pending lines now, eg. before its connection goes away
+		"""
+		while len(source.pending) > 0:
+			self._handle(source, source.pending.popleft())
+		if source in self.ready:
+			self.ready.remove(source)
+		self._resume(source)
+
+
+	def _handle(self, source, line):
+		try:
+			source.handle_line(line)
+		except:
+			log.exception('LineScheduler: error handling %r', line)
+
+
+	def _resume(self, source):
+		if source.paused:
+			source.paused = False
+			if source.transport is not None:
+				source.transport.resume_reading()
+
+
+
+_scheduler = None
+
+
+def get_scheduler():
+	"""Returns the LineScheduler shared by every device of this process
+	"""
+	global _scheduler
+	if _scheduler is None:
+		_scheduler = LineScheduler()
+	return _scheduler
+
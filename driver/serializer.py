@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+if orjson is not None:
+    CODEC = 'orjson'
+    def _fast_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    _fast_loads = orjson.loads
+elif ujson is not None:
+    CODEC = 'ujson'
+    _fast_dumps = ujson.dumps
+    _fast_loads = ujson.loads
+else:
+    CODEC = 'json'
+    _fast_dumps = None
+    _fast_loads = None
+
+
+
+def dumps(obj):
+    """Returns obj encoded as a JSON string, with the fastest codec installed
+
+    Anything the fast codec refuses is retried with the json module, so every codec
+    accepts the same values
+    """
+    if _fast_dumps is not None:
+        try:
+            return _fast_dumps(obj)
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return json.dumps(obj, separators=(',',':'))
+
+
+def loads(data):
+    """Decodes a JSON string or bytes
+    """
+    if _fast_loads is not None:
+        return _fast_loads(data)
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode()
+    return json.loads(data)
+
+
+def packb(obj):
+    """Returns obj encoded as msgpack bytes (msgpack must be installed)
+    """
+    return msgpack.packb(obj, use_bin_type=True)
+
+
+def unpackb(data):
+    """Decodes msgpack bytes (msgpack must be installed)
+    """
+    return msgpack.unpackb(data, raw=False)
+
+
+def pack_array(parts):
+    """Returns the msgpack array of parts, a list of already packed values
+    """
+    count = len(parts)
+    if count < 16:
+        header = bytes((0x90 | count,))
+    elif count < 0x10000:
+        header = b'\xdc' + count.to_bytes(2, 'big')
+    else:
+        header = b'\xdd' + count.to_bytes(4, 'big')
+    return header + b''.join(parts)
+
+
+
+class EnvelopeEncoder():
+    """Encodes driver_client messages:
+
+    {'time':time, 'type':type_, 'to':to, 'from':from_id, 'sessionID':session_id, 'data':{'name':name, 'message':{message:param}}}
+
+    The 'from' id never changes and type_ and name come from a small set, so their encodings
+    are kept and only the varying fields are encoded for each message.
+    """
+
+    max_fragments = 256
+
+    def __init__(self, from_id):
+        self.from_fragment = '{"from":'+dumps(from_id)
+        self.type_fragments = {}
+        self.name_fragments = {}
+
+
+    def encode(self, time_string, type_, to, session_id, name, message, param):
+        return ''.join((
+            self.from_fragment,
+            self._fragment(self.type_fragments, ',"type":', type_),
+            ',"to":', dumps(to),
+            ',"sessionID":', dumps(session_id),
+            ',"time":', dumps(time_string),
+            self._fragment(self.name_fragments, ',"data":{"name":', name),
+            ',"message":', dumps({message:param}),
+            '}}'
+            ))
+
+
+    def _dump(self, value):
+        return dumps(value)
+
+
+    def _fragment(self, fragments, prefix, value):
+        try:
+            return fragments[value]
+        except (KeyError, TypeError):
+            pass
+        fragment = prefix+self._dump(value)
+        try:
+            if len(fragments) >= self.max_fragments:
+                fragments.clear()
+            fragments[value] = fragment
+        except TypeError:
+            pass
+        return fragment
+
+
+
+class MsgpackEnvelopeEncoder(EnvelopeEncoder):
+    """EnvelopeEncoder for clients that negotiated binary payloads: the same message, as msgpack bytes
+
+    A msgpack map is its header followed by its packed keys and values, so the constant
+    fragments can be kept already packed and joined just like the JSON ones.
+    """
+
+    def __init__(self, from_id):
+        self.from_fragment = b'\x86' + packb('from') + packb(from_id)
+        self.type_fragments = {}
+        self.name_fragments = {}
+        self.keys = {key:packb(key) for key in ('type', 'to', 'sessionID', 'time', 'message')}
+        self.keys['data'] = packb('data') + b'\x82' + packb('name')
+
+
+    def encode(self, time_string, type_, to, session_id, name, message, param):
+        keys = self.keys
+        return b''.join((
+            self.from_fragment,
+            self._fragment(self.type_fragments, keys['type'], type_),
+            keys['to'], packb(to),
+            keys['sessionID'], packb(session_id),
+            keys['time'], packb(time_string),
+            self._fragment(self.name_fragments, keys['data'], name),
+            keys['message'], packb({message:param})
+            ))
+
+
+    def _dump(self, value):
+        return packb(value)
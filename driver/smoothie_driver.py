@@ -1,25 +1,50 @@
 #!/usr/bin/env python3
 
 #import serial
-import asyncio, json, copy
-import datetime
+import asyncio, json
+import itertools
+import logging
 import sys
-from collections import Callable
+from collections import Callable, deque
 import os
+import re
+import tempfile
 
+import backlash
+from backoff import Backoff
+from command_queue import LANES, CommandQueue
+from gcode_encoder import GCodeEncoder
+from line_framer import LineFramer
+import loopback
+from motion_optimizer import MotionOptimizer
+from precompiler import Precompiler
+from scheduler import get_scheduler
+from smoothie_simulator import simulator
+from versioned_state import VersionedState, freeze
+import driver_log
 
 
-@asyncio.coroutine
-def simulator(reader, writer):
-	while True:
-		data = yield from reader.read(100)
-		print('data: ',data.decode())
-		ack_received = 'ok\r\n'.encode()
-		ack_ready = '{"stat":0}\r\n'.encode()
-		writer.write(ack_received)
-		yield from writer.drain()
-		writer.write(ack_ready)
-		yield from writer.drain()
+log = driver_log.get_logger('smoothie')
+flow_log = driver_log.get_logger('flow')
+output_log = driver_log.get_logger('output')
+parser_log = driver_log.get_logger('parser')
+
+
+
+# one token of a text reply: 'word', 'word:' or 'parameter:value'
+_TEXT_TOKEN = re.compile(r'([^\s,:]+)(:?)([^\s,]*)')
+
+
+# messages whose axis parameters are positions: JSON feedback ('None') and M114's reply ('C')
+POSITION_MESSAGES = ('None', 'C')
+
+
+def _to_number(value):
+	try:
+		return float(value)
+	except ValueError:
+		return value
+
 
 
 
@@ -29,47 +54,60 @@ class Output(asyncio.Protocol):
 
 	def __init__(self, outer):
 		self.outer = outer
-		self._delimiter = "\n"
-		self.data_buffer = ""
+		self.framer = LineFramer(outer.config_dict['delimiter'].encode(), outer.config_dict['receive_buffer_size'])
+		self.framer.kinds = outer.fast_lines
 		self.transport = None
 		self.data_last = ""
 		self.datum_last = ""
+		self.pending = deque()	# received lines waiting for their turn in the LineScheduler
+		self.paused = False
 
 
 	def connection_made(self, transport):
-		print(datetime.datetime.now(),' - Output.connection_made:')
-		print('\ttransport: ',transport)
+		output_log.info('Output.connection_made: %s', transport)
 		self.transport = transport
 		self.outer.smoothie_transport = transport
-		transport.write("M114\r\n".encode())
-		loop = asyncio.get_event_loop()
+		self.outer.smoothie_output = self
 		self.outer._on_connection_made()
 
 
 	def data_received(self, data):
 		#print(datetime.datetime.now(),' - Output.data_received:')
 		#print('\tdata: '+str(data))
-		self.data_buffer = self.data_buffer + data.decode()
-		delimiter_index = self.data_buffer.rfind("\n")
-		if delimiter_index >= 0:
-			current_data = self.data_buffer[:delimiter_index]
-			self.data_buffer = self.data_buffer[delimiter_index+1:]
-			data_list = [e+self._delimiter for e in current_data.split(self._delimiter)]
-			for datum in data_list:
-				#if datum != self.datum_last:
-				#self.datum_last = datum
-				self.outer._smoothie_data_handler(datum)
+		overflows = self.framer.overflows
+		self.outer.scheduler.deliver(self, self.framer.feed(data))
+		if self.framer.overflows != overflows:
+			output_log.warning('Output.data_received: line longer than receive_buffer_size dropped')
 		if data != self.data_last:
 			self.data_last = data
 			self.outer._on_raw_data(data)
 
 
+	def set_delimiter(self, delimiter):
+		"""Frames what comes next, and the partial line already received, with delimiter
+		"""
+		self.outer.scheduler.deliver(self, self.framer.set_delimiter(delimiter))
+
+
+	def handle_line(self, datum):
+		#if datum != self.datum_last:
+		#self.datum_last = datum
+		fast = self.framer.classify(datum)
+		if fast is not None:
+			self.outer._on_fast_line(fast)
+		else:
+			self.outer._smoothie_data_handler(datum)
+
+
 	def connection_lost(self, exc):
-		print(datetime.datetime.now(),' - Output.connection_lost:')
-		#print('\texc: ',exc)
+		output_log.info('Output.connection_lost: %s', exc)
+		# lines already received may acknowledge lines in flight, handle them before requeueing
+		self.outer.scheduler.drain(self)
 		self.transport = None
 		self.outer.smoothie_transport = None
-		self.data_buffer = ""
+		if self.outer.smoothie_output is self:
+			self.outer.smoothie_output = None
+		self.framer.clear()
 		loop = asyncio.get_event_loop()
 		self.outer._on_connection_lost()
  
@@ -88,8 +126,10 @@ class SmoothieDriver(object):
 
 	From:
 
-	1. Data coming in is split up by delimiter ('\n') and then
-	each section is sent to a callback (SmoothieDriver._smoothie_data_handler)
+	1. Data coming in is split up by delimiter ('\n') by a LineFramer (line_framer.py) and then
+	each section is sent, still as bytes, to a callback (SmoothieDriver._smoothie_data_handler).
+	Lines that are nothing but an acknowledgement ('ok', {"stat":0}) are recognised by exact
+	comparison and go to SmoothieDriver._on_fast_line instead, skipping steps 2 and 3
 	The raw data is then sent to another callback (SmoothieDriver._raw_data_handler)
 
 	Function: Output.data_received()
@@ -123,24 +163,42 @@ class SmoothieDriver(object):
 
 
 
-	def __init__(self, simulate=True):
+	def __init__(self, simulate=True, name='smoothie', host=None, port=None, scheduler=None):
 		"""
+		name: the device's name, state_dict['name']
+		host, port: the device's ser2net endpoint, by default SMOOTHIE_HOST and SMOOTHIE_PORT
+		scheduler: LineScheduler sharing the event loop with other devices, by default the process's
 		"""
-		print(datetime.datetime.now(),' - driver.__init__:')
+		log.debug('__init__')
 		#print('\n\targs: ',locals(),'\n')
 		self.simulation = simulate
+		self.host = host
+		self.port = port
+		self.scheduler = scheduler if scheduler is not None else get_scheduler()
 		self.the_loop = asyncio.get_event_loop()
-		self.command_queue = []
+		self.command_queue = CommandQueue()
 		self.simulation_queue = []
+		self.in_flight = deque()	# streaming mode: (length, message) sent but not yet acknowledged
+		self.awaiting_ack = None	# lock-step mode: the message sent but not yet acknowledged
+		self.immediate_acks = deque()	# per immediate line not yet acknowledged: acknowledgements due before its own
 	
 		self.smoothie_transport = None
+		self.smoothie_output = None	# the Output (protocol) of the current connection
 		self.the_loop = None
+		self.link_task = None
+		self.simulation_server = None
+		self.simulation_path = None	# the 'unix' simulation server's socket, in a directory of its own
+		self.disconnecting = False
+		self.stream_task = None
+		self.stream_wakeup = None	# Future the stream producer waits on while its read-ahead window is full
+		self.queue_info = {'session_id':"",'from':""}	# who queued last
+		self.watermark_info = {'session_id':"",'from':""}	# who took the queue past the high watermark
 
 		self.current_info = {'session_id':"",'from':""}
 		self.connected_info = {'session_id':"",'from':""}
 		self.disconnected_info = {'session_id':"",'from':""}
 
-		self.state_dict = {
+		self.state_dict = VersionedState({
 			'name':'smoothie',
 			'simulation':False,
 			'connected':False,
@@ -149,16 +207,25 @@ class SmoothieDriver(object):
 			'ack_received':True,
 			'ack_ready':True,
 			'queue_size':0,
-			'direction':{'X':0,'Y':0,'Z':0,'A':0,'B':0,'C':0},	# 0 = positive, 1 = negative
+			'lane_sizes':self.command_queue.sizes(),
+			'direction':{'X':0,'Y':0,'Z':0,'A':0,'B':0,'C':0},	# 1 = last moved positive, 0 = negative (or not yet)
 			'smoothie_pos':{'X':0,'Y':0,'Z':0,'A':0,'B':0,'C':0},
 			'adjusted_pos':{'X':0,'Y':0,'Z':0,'A':0,'B':0,'C':0},
 			'absolute_mode':True,
-			'feedback_on':False
-		}
+			'feedback_on':False,
+			'in_flight':0,
+			'in_flight_bytes':0,
+			'reconnecting':False,
+			'reconnect_attempts':0,
+			'optimized_lines':0,
+			'queue_high':False,
+			'stream':{'active':False,'name':None,'read_lines':0,'read_bytes':0,'sent_lines':0,'sent_bytes':0,'total_bytes':None,'done':False,'error':None}
+		})
 
 		self.state_dict['simulation'] = simulate
+		self.state_dict['name'] = name
 
-		self.config_dict = {
+		self.config_dict = VersionedState({
 			'delimiter':"\n",
 			'message_ender':"\r\n",
 			'ack_received_message':"ok",
@@ -167,8 +234,24 @@ class SmoothieDriver(object):
 			'ack_ready_message':"None",
 			'ack_ready_parameter':"stat",
 			'ack_ready_value':"0",
-			'slack':{'X':0.5,'Y':0.5,'Z':0.0,'A':0.1,'B':0.1,'C':0.0}
-		}
+			'slack':{'X':0.5,'Y':0.5,'Z':0.0,'A':0.1,'B':0.1,'C':0.0},
+			'streaming':False,
+			'stream_buffer_size':128,
+			'stream_max_lines':8,
+			'encoder_cache_size':256,
+			'receive_buffer_size':4096,
+			'reconnect':True,
+			'reconnect_max_delay':5.0,
+			'optimize':False,
+			'file_chunk_size':4096,
+			'file_read_ahead':256,
+			'max_queue_size':50000,
+			'queue_high_watermark':40000,
+			'queue_low_watermark':10000,
+			'simulator':{'rx_buffer_size':128,'planner_size':32,'time_scale':1.0,'latency':0.0,'jitter':0.0},
+			'simulation_transport':'loopback'
+		})
+		self.command_queue.max_size = self.config_dict['max_queue_size']
 
 		self.callbacks_dict = {}
 		#  {
@@ -180,11 +263,21 @@ class SmoothieDriver(object):
 		#    ...
 		#  }
 
+		self.callback_index = {}
+		#  callbacks_dict turned inside out, maintained by add_callback and remove_callback
+		#  {
+		#    <message>: [ <CALLBACK OBJECT>, ... ],
+		#    ...
+		#  }
+
 		self.meta_callbacks_dict = {
 			'on_connect' : None,
 			'on_disconnect' : None,
 			'on_empty_queue' : None,
-			'on_raw_data' : None
+			'on_raw_data' : None,
+			'on_progress' : None,
+			'on_queue_high' : None,
+			'on_queue_low' : None
 		}
 
 		self.commands_dict = {
@@ -250,15 +343,18 @@ class SmoothieDriver(object):
 			},
 			"halt":{
 				"code":"M112",
-				"parameters":[]
+				"parameters":[],
+				"lane":"emergency"
 			},
 			"positions":{
 				"code":"M114",
-				"parameters":[]
+				"parameters":[],
+				"lane":"interactive"
 			},
 			"limit_switches":{
 				"code":"M119",
-				"parameters":[]
+				"parameters":[],
+				"lane":"interactive"
 			},
 			"feed_rate":{
 				"code":"M198",
@@ -286,7 +382,8 @@ class SmoothieDriver(object):
 			},
 			"reset_from_halt":{
 				"code":"M999",
-				"parameters":[]
+				"parameters":[],
+				"lane":"emergency"
 			},
 			"nothing":{
 				"code":"",
@@ -294,11 +391,31 @@ class SmoothieDriver(object):
 			}
 		}
 
+		self._commands_snapshot = None
+
+		self.encoder = GCodeEncoder(self.commands_dict, self.config_dict['message_ender'], self.config_dict['encoder_cache_size'])
+		self.optimizer = MotionOptimizer(self.config_dict['message_ender'].encode())
+
+		# where the queued moves will have taken the axes, for compensating absolute moves
+		self.planned_pos = dict(self.state_dict['adjusted_pos'])
+		# (direction, position) the lines sent so far leave the axes at, see _recompensate
+		self.sent_plan = (dict(self.state_dict['direction']), dict(self.planned_pos))
+
+		self.precompiler = Precompiler()
+
+		self.fast_lines = {}
+		#  exact lines that are nothing but an acknowledgement, shared with Output's LineFramer
+		#  {
+		#    <line bytes, delimiter included>: (<'ack_received' or 'ack_ready'>, <message>, <parameters>),
+		#    ...
+		#  }
+		self._compile_fast_lines()
+
 
 	def callbacks(self):
 		"""
 		"""
-		print(datetime.datetime.now(),' - driver.callbacks')
+		log.debug('callbacks')
 		return_dict = {}
 		for name, value in self.callbacks_dict.items():
 			return_dict[name] = value['messages']
@@ -309,24 +426,66 @@ class SmoothieDriver(object):
 	def configs(self):
 		"""
 		"""
-		print(datetime.datetime.now(),' - driver.configs')
-		return copy.deepcopy(self.config_dict)
+		log.debug('configs')
+		return self.config_dict.snapshot()
 
 
 	def set_config(self, config, setting):
 		"""
 		"""
-		print(datetime.datetime.now(),' - driver.set_config:')
+		log.debug('set_config')
 		#print('\n\targs: ',locals(),'\n')
 		if config in self.config_dict:
 			self.config_dict[config] = setting
+			if config in ('message_ender','encoder_cache_size'):
+				self.encoder.cache_size = self.config_dict['encoder_cache_size']
+				self.encoder.compile(self.commands_dict, self.config_dict['message_ender'])
+				self.optimizer.ender = self.encoder.ender
+			if config == 'optimize':
+				self.optimizer.reset()
+			if config == 'max_queue_size':
+				self.command_queue.max_size = self.config_dict['max_queue_size']
+			if config.startswith('queue_'):
+				self._check_watermarks()
+			if config == 'delimiter' or config.startswith('ack_'):
+				self._compile_fast_lines()
+			if config == 'delimiter' and self.smoothie_output is not None:
+				# the connection's framer has to split lines the way fast_lines expects them
+				self.smoothie_output.set_delimiter(self.config_dict['delimiter'].encode())
 		return self.configs()
 
 
+	def _compile_fast_lines(self):
+		"""Works out the exact lines the device sends as bare acknowledgements from the ack_* configs
+
+		Only the simple forms are recognised: a bare message (Smoothieboard's 'ok'), or a JSON object
+		holding just the parameter (Smoothieboard's {"stat":0}). Anything else goes through the parser.
+		"""
+		self.fast_lines.clear()
+		delimiter = self.config_dict['delimiter']
+		for kind in ('ack_received','ack_ready'):
+			message = self.config_dict[kind+'_message']
+			parameter = self.config_dict[kind+'_parameter']
+			value = self.config_dict[kind+'_value']
+			texts = []
+			if message not in (None,'None') and parameter is None and value is None:
+				texts = [message]
+				parsed = {message:{}}
+			elif message == 'None' and parameter is not None and value is not None:
+				value = _to_number(str(value))
+				if isinstance(value, float) and value.is_integer():
+					value = int(value)
+				texts = [json.dumps({parameter:value},separators=(',',':')), json.dumps({parameter:value})]
+				parsed = {message:{parameter:value}}
+			for text in texts:
+				for ender in ('\r'+delimiter, delimiter):
+					self.fast_lines[(text+ender).encode()] = (kind, list(parsed)[0], list(parsed.values())[0])
+
+
 	def meta_callbacks(self):
 		"""
 		"""
-		print(datetime.datetime.now(),' - driver.meta_callbacks')
+		log.debug('meta_callbacks')
 		return_dict = dict()
 		for name, value in self.meta_callbacks_dict.items():
 			if value is not None and isinstance(value, Callable):
@@ -342,7 +501,7 @@ class SmoothieDriver(object):
 		"""
 		name should correspond 
 		"""
-		print(datetime.datetime.now(),' - driver.set_meta_callback:')
+		log.debug('set_meta_callback')
 		#print('\n\targs: ',locals(),'\n')
 		if name in self.meta_callbacks_dict and isinstance(callback, Callable):
 			self.meta_callbacks_dict[name] = callback
@@ -354,217 +513,586 @@ class SmoothieDriver(object):
 	def add_callback(self, callback, messages):
 		"""
 		"""
-		print(datetime.datetime.now(),' - driver.add_callback:')
+		log.debug('add_callback')
 		#print('\n\targs: ',locals(),'\n')
-		if callback.__name__ not in list(self.callbacks_dict):
-			if isinstance(messages, list):
-				self.callbacks_dict[callback.__name__] = {'callback':callback, 'messages':messages}
-			else:
-				self.callbacks_dict[callback.__name__] = {'callback':callback, 'messages':[messages]}
-		elif message not in self.callbacks_dict[callback.__name__]['messages']:
-			if isinstance(messages, list):
-				self.callbacks_dict[callback.__name__]['messages'].extend(messages)
-			else:
-				self.callbacks_dict[callback.__name__]['messages'].append(messages)
+		if not isinstance(messages, list):
+			messages = [messages]
+		if callback.__name__ not in self.callbacks_dict:
+			self.callbacks_dict[callback.__name__] = {'callback':callback, 'messages':list(messages)}
+		else:
+			for message in messages:
+				if message not in self.callbacks_dict[callback.__name__]['messages']:
+					self.callbacks_dict[callback.__name__]['messages'].append(message)
+		self._index_callbacks()
 		return self.callbacks()
 
 
 	def remove_callback(self, callback_name):
 		"""
 		"""
-		print(datetime.datetime.now(),' - driver.remove_callback')
+		log.debug('remove_callback')
 		#print('\n\targs: ',locals(),'\n')
 		del self.callbacks_dict[callback_name]
+		self._index_callbacks()
 		return self.callbacks()
 
 
-	def flow(self):
+	def _index_callbacks(self):
+		self.callback_index = {}
+		for callback_name, callback in self.callbacks_dict.items():
+			for message in callback['messages']:
+				self.callback_index.setdefault(message, []).append(callback['callback'])
+
+
+	def flow(self, since=None):
 		"""
+		Returns an immutable snapshot of state_dict, shared until the state changes
+
+		If since is the 'version' of an earlier snapshot and nothing has changed since,
+		only {'version': since} is returned
 		"""
-		print(datetime.datetime.now(),' - driver.flow')
-		return copy.deepcopy(self.state_dict)
+		log.debug('flow')
+		if since is not None and not self.state_dict.changed_since(since):
+			return {'version':since}
+		return self.state_dict.snapshot()
 
 
 	def clear_queue(self):
 		"""
 		"""
-		print(datetime.datetime.now(),' - driver.clear_queue')
-		self.command_queue = []
+		log.debug('clear_queue')
+		if self.stream_task is not None and not self.stream_task.done():
+			self.stream_task.cancel()
+		self.command_queue.clear()
+		self.optimizer.reset()
+		# the next moves start from where the lines already sent leave the axes
+		self._recompensate()
 		self.state_dict['queue_size'] = len(self.command_queue)
+		self.state_dict['lane_sizes'] = self.command_queue.sizes()
+		# lines already sent stay in the streaming window until the device acknowledges them
 		self.state_dict['ack_received'] = True
 		self.state_dict['ack_ready'] = True
+		self._check_watermarks()
 		return self.flow()
 
 	
 	def connect(self, from_, session_id, device=None, port=None):
 		"""
+		Starts connecting to the device without blocking or stopping the event loop
+
+		device and port override the driver's host and port
+
+		If the connection fails, or is lost later on, it is retried with backoff (see the 'reconnect'
+		and 'reconnect_max_delay' configs) until it succeeds or disconnect() is called
 		"""
-		print(datetime.datetime.now(),' - driver.connect called:')
+		log.debug('connect')
 		#print('\n\targs: ',locals(),'\n')
 		self.connected_info = {'from':from_,'session_id':session_id}
+		if device is not None:
+			self.host = device
+		if port is not None:
+			self.port = int(port)
 		self.the_loop = asyncio.get_event_loop()
+		self.disconnecting = False
 		#asyncio.async(serial.aio.create_serial_connection(self.the_loop, Output, '/dev/ttyUSB0', baudrate=115200))
-		callbacker = Output(self)
-		try:
-			if self.the_loop.is_running():
-				self.the_loop.stop()
-			print(self.simulation)
-			if self.simulation:
-				print(simulator)
-				server = self.the_loop.run_until_complete(asyncio.start_server(simulator,'0.0.0.0',3334))
-				self.the_loop.run_until_complete(self.the_loop.create_connection(lambda: callbacker, host='0.0.0.0', port=3334))
-				
-				#yield from server.wait_closed()
-			else:
-				smoothie_host=os.environ.get('SMOOTHIE_HOST', '0.0.0.0')
-				smoothie_port=int(os.environ.get('SMOOTHIE_PORT', '3333'))
-				asyncio.async(self.the_loop.create_connection(
-					lambda: callbacker,
-					host=smoothie_host,
-					port=smoothie_port))
-		except:
-			print(datetime.datetime.now(),' - error:driver.connects\n\r',sys.exc_info())
-			
+		self._start_link()
+
+
+	def _start_link(self):
+		if self.link_task is None or self.link_task.done():
+			self.link_task = asyncio.ensure_future(self._link())
+
+
+	@asyncio.coroutine
+	def _link(self):
+		"""Connects to the device, retrying with backoff while 'reconnect' is on
+		"""
+		backoff = Backoff(maximum=self.config_dict['reconnect_max_delay'])
+		while not self.disconnecting:
+			try:
+				yield from self._open_link()
+				return
+			except (OSError, asyncio.TimeoutError):
+				log.warning('%s connect failed: %s', self.state_dict['name'], sys.exc_info()[1])
+			except ValueError:
+				# a bad config, retrying won't help
+				log.error('%s cannot connect: %s', self.state_dict['name'], sys.exc_info()[1])
+				break
+			if not self.config_dict['reconnect']:
+				break
+			self.state_dict['reconnecting'] = True
+			self.state_dict['reconnect_attempts'] = backoff.attempts + 1
+			delay = backoff.next()
+			log.info('reconnecting in %.3f seconds', delay)
+			yield from asyncio.sleep(delay)
+		self.state_dict['reconnecting'] = False
+
+
+	@asyncio.coroutine
+	def _open_link(self):
+		log.info('%s connecting, simulation: %s', self.state_dict['name'], self.simulation)
+		loop = asyncio.get_event_loop()
+		if self.simulation:
+			yield from self._open_simulation()
+		else:
+			smoothie_host = self.host if self.host is not None else os.environ.get('SMOOTHIE_HOST', '0.0.0.0')
+			smoothie_port = self.port if self.port is not None else int(os.environ.get('SMOOTHIE_PORT', '3333'))
+			yield from loop.create_connection(
+				lambda: Output(self),
+				host=smoothie_host,
+				port=smoothie_port)
+
+
+	@asyncio.coroutine
+	def _open_simulation(self):
+		"""Connects to a simulated device (smoothie_simulator.py) over 'simulation_transport':
+
+		'loopback' - an in-process transport pair (loopback.py), no sockets at all
+		'unix' - a Unix socket in a private directory made with tempfile.mkdtemp
+		'tcp' - a TCP socket on a free port of 127.0.0.1
+
+		Every driver gets its own simulator, and each connection a freshly reset device. The unix
+		and tcp servers stay up, so reconnecting doesn't restart them, until disconnect()
+		"""
+		loop = asyncio.get_event_loop()
+		transport = self.config_dict['simulation_transport']
+		connected = lambda reader, writer: simulator(reader, writer, **self.config_dict['simulator'])
+		if transport == 'loopback':
+			loopback.create_connection(lambda: Output(self), connected)
+		elif transport == 'unix':
+			if self.simulation_server is None:
+				self.simulation_path = os.path.join(tempfile.mkdtemp(prefix='sandbox-driver-'), 'simulator.sock')
+				self.simulation_server = yield from asyncio.start_unix_server(connected, self.simulation_path)
+			yield from loop.create_unix_connection(lambda: Output(self), self.simulation_path)
+		elif transport == 'tcp':
+			if self.simulation_server is None:
+				self.simulation_server = yield from asyncio.start_server(connected, '127.0.0.1', 0)
+			simulation_port = self.simulation_server.sockets[0].getsockname()[1]
+			yield from loop.create_connection(lambda: Output(self), host='127.0.0.1', port=simulation_port)
+		else:
+			raise ValueError('unknown simulation_transport: '+str(transport))
+
 
 	def disconnect(self, from_, session_id):
 		"""
+		Closes the connection to the device and stops reconnecting. The command queue is kept
 		"""
-		print(datetime.datetime.now(),' - driver.disconnect')
+		log.debug('disconnect')
 		#print('\n\targs: ',locals(),'\n')
 		self.disconnected_info = {'from':from_,'session_id':session_id}
-		self.smoothie_transport.close()
+		self.disconnecting = True
+		if self.link_task is not None:
+			self.link_task.cancel()
+		if self.smoothie_transport is not None:
+			self.smoothie_transport.close()
+		self._close_simulation()
+
+
+	def _close_simulation(self):
+		"""Stops the unix or tcp simulation server, removing the unix socket and its directory
+		"""
+		if self.simulation_server is not None:
+			self.simulation_server.close()
+			self.simulation_server = None
+		if self.simulation_path is not None:
+			try:
+				os.unlink(self.simulation_path)
+				os.rmdir(os.path.dirname(self.simulation_path))
+			except OSError:
+				log.warning('cannot remove %s', self.simulation_path, exc_info=True)
+			self.simulation_path = None
 
 
 	def commands(self):
 		"""
 		"""
-		print(datetime.datetime.now(),' - driver.commands')
-		return copy.deepcopy(self.commands_dict)
+		log.debug('commands')
+		if self._commands_snapshot is None:
+			self._commands_snapshot = freeze(self.commands_dict)
+		return self._commands_snapshot
+
+
+	def set_command(self, command, code, parameters, lane=None):
+		"""
+		Adds or replaces a command in commands_dict
+		"""
+		log.debug('set_command')
+		#print('\n\targs: ',locals(),'\n')
+		self.commands_dict[command] = {'code':code, 'parameters':list(parameters)}
+		if lane is not None:
+			self.commands_dict[command]['lane'] = lane
+		self.encoder.compile(self.commands_dict, self.config_dict['message_ender'])
+		self._commands_snapshot = None
+		return self.commands()
 
 
 	def unlock(self):
 		"""
 		"""
-		print(datetime.datetime.now(),' - driver.unlock')
+		flow_log.debug('unlock')
+		self._clear_in_flight()
+		self.lock_check()
+
+
+	def _clear_in_flight(self):
+		"""Forgets the lines sent but not acknowledged, releasing their credit
+		"""
+		self.in_flight.clear()
+		self.awaiting_ack = None
+		self.immediate_acks.clear()
+		self.state_dict['in_flight'] = 0
+		self.state_dict['in_flight_bytes'] = 0
 		self.state_dict['ack_received'] = True
 		self.state_dict['ack_ready'] = True
-		self.lock_check()
 
 
-	def send(self, message):
-		print(datetime.datetime.now(),' - driver.send:')
+	def send(self, message, immediate=False):
+		"""Writes a message to the device
+
+		immediate messages (halt etc.) skip flow control: they neither wait for nor take the lock, and
+		take no window or ack credit. Halt (M112) and reset (M999) also drop what is in flight, the
+		device won't acknowledge it
+		"""
+		flow_log.debug('send')
 		#print('\n\targs: ',locals(),'\n')
 		self.state_dict['queue_size'] = len(self.command_queue)
-		command = message['command'] + self.config_dict['message_ender']
+		self.state_dict['lane_sizes'] = self.command_queue.sizes()
+		data = message['command']	# already encoded, message_ender included
 
 		if self.simulation:
 			self.simulation_queue.append(message)
 		
 		if self.smoothie_transport is not None:
-			print(datetime.datetime.now(),' - smoothie_transport not None')
 			#if self.lock_check() == False:
 			# should have already been checked
-			self.state_dict['ack_received'] = False
-			self.state_dict['ack_ready'] = False  # needs to be set here because not ready message from device takes too long, ack_received already received
-			if command.startswith('M62'):
+			if immediate == True:
+				if data.startswith(b'M112') or data.startswith(b'M999'):
+					self._clear_in_flight()
+				# its 'ok' comes after those of the lines already sent, and releases nothing
+				self.immediate_acks.append(len(self.in_flight) + (0 if self.awaiting_ack is None else 1))
+			elif self.config_dict['streaming'] == True:
+				# credit for this line is released when its 'ok' comes back
+				self.in_flight.append((len(data), message))
+				self.state_dict['in_flight'] = len(self.in_flight)
+				self.state_dict['in_flight_bytes'] += len(data)
+			else:
+				self.awaiting_ack = message
+				self.state_dict['ack_received'] = False
+				self.state_dict['ack_ready'] = False  # needs to be set here because not ready message from device takes too long, ack_received already received
+			if data.startswith(b'M62'):
 				self.state_dict['feedback_on'] = True
-			elif command.startswith('M63'):
+			elif data.startswith(b'M63'):
 				self.state_dict['feedback_on'] = False
 
-			if command.startswith('G90'):
+			if data.startswith(b'G90'):
 				self.state_dict['absolute_mode'] = True
-			if command.startswith('G91'):
+			if data.startswith(b'G91'):
 				self.state_dict['absolute_mode'] = False
+			if 'move' in message:
+				message['start'] = self.sent_plan
+				self.sent_plan = self._compensate([message['move']], *self.sent_plan)
+			elif 'plan' in message:
+				message['start'] = self.sent_plan
+				self.sent_plan = message['plan']
 			self.lock_check()
+			if 'line' in message:
+				self.state_dict.set_item('stream', 'sent_lines', message['line'])
+				self.state_dict.set_item('stream', 'sent_bytes', message['offset'])
 			self.current_info = {'session_id':message['session_id'],'from':message['from']}
-			self.smoothie_transport.write(command.encode())
+			flow_log.debug('send: %r', data)
+			self.smoothie_transport.write(data)
 			#self.smoothie_streamwriter.drain()
 		else:
-			print(datetime.datetime.now(),' - smoothie_transport is None????')
+			flow_log.warning('send: smoothie_transport is None, %r not sent', data)
 
 
 
 # flow control 
 
 	def lock_check(self):
-		print(datetime.datetime.now(),' - driver.lock_check')
 		#print("SmoothieDriver.lock check called")
-		print('\tack_received: ',self.state_dict['ack_received'])
-		print('\tack_ready: ',self.state_dict['ack_ready'])
-		print('\tfeedback_on: ',self.state_dict['feedback_on'])
-		if self.state_dict['ack_received'] == True:
+		if self.smoothie_transport is None:
+			# nothing can be sent, keep the queue until (re)connected
+			locked = True
+		elif self.config_dict['streaming'] == True:
+			if len(self.command_queue) > 0:
+				length = len(self.command_queue.peek()['command'])
+			else:
+				length = 0
+			locked = not self._stream_has_credit(length)
+		elif self.state_dict['ack_received'] == True:
 			if self.state_dict['feedback_on'] == True:
-				if self.state_dict['ack_ready'] == True:
-					self.state_dict['locked'] = False
-					print('\tunlocked - 1')
-					return False
-				else:
-					self.state_dict['locked'] = True
-					print('\tlocked - 1')
-					return True
+				locked = not self.state_dict['ack_ready']
 			else:
-				self.state_dict['locked'] = False
-				print('\tunlocked - 2')
-			return False
+				locked = False
 		else:
-			self.state_dict['locked'] = True
-			print('\tlocked - 2')
-			return True
+			locked = True
+		self.state_dict['locked'] = locked
+		if flow_log.isEnabledFor(logging.DEBUG):
+			flow_log.debug('lock_check: locked: %s, ack_received: %s, ack_ready: %s, feedback_on: %s, in_flight: %d (%d bytes)',
+				locked, self.state_dict['ack_received'], self.state_dict['ack_ready'], self.state_dict['feedback_on'],
+				self.state_dict['in_flight'], self.state_dict['in_flight_bytes'])
+		return locked
 
 
-	def _add_to_command_queue(self, from_, session_id, command):
-		print(datetime.datetime.now(),' - driver._add_to_command_queue:')
+	def _add_to_command_queue(self, from_, session_id, command, lane='normal', extra=None):
+		"""Queues command, extra holds more entries for its queued message (eg. 'move', see _recompensate)
+		"""
+		flow_log.debug('_add_to_command_queue')
 		#print('\n\targs: ',locals(),'\n')
-		cmd = {'session_id':session_id,'from':from_,'command':command}
-		self.command_queue.append(cmd)
+		cmd = {'session_id':session_id,'from':from_,'command':command,'lane':lane}
+		if extra is not None:
+			cmd.update(extra)
+		self.queue_info = {'from':from_,'session_id':session_id}
+		if self._optimize(cmd, lane):
+			self.state_dict['queue_size'] = len(self.command_queue)
+			return
+		if lane == 'emergency' and self.smoothie_transport is not None:
+			# halt and friends go straight to the device instead of waiting behind the lock
+			if self._overtakes(cmd, lane):
+				self._recompensate([cmd])
+			self.send(cmd, immediate=True)
+			return
+		overtakes = self._overtakes(cmd, lane)
+		self.command_queue.append(cmd, lane)
+		if overtakes:
+			self._recompensate()
 		self.state_dict['queue_size'] = len(self.command_queue)
+		self.state_dict['lane_sizes'] = self.command_queue.sizes()
 		self._step_command_queue()
 
 
+	def _extend_command_queue(self, from_, session_id, built_list, offsets=None):
+		"""Queues a list of (command, lane, extra) and steps the queue once, see _add_to_command_queue
+
+		offsets, if given, holds a (line, offset) per command: where it ends in the file it was read from
+		"""
+		flow_log.debug('_extend_command_queue')
+		#print('\n\targs: ',locals(),'\n')
+		self.queue_info = {'from':from_,'session_id':session_id}
+		overtaken = False
+		for index, (command, lane, extra) in enumerate(built_list):
+			cmd = {'session_id':session_id,'from':from_,'command':command,'lane':lane}
+			if extra is not None:
+				cmd.update(extra)
+			if offsets is not None:
+				cmd['line'], cmd['offset'] = offsets[index]
+			if self._optimize(cmd, lane):
+				continue
+			if lane == 'emergency' and self.smoothie_transport is not None:
+				if self._overtakes(cmd, lane):
+					self._recompensate([cmd])
+				self.send(cmd, immediate=True)
+			else:
+				overtaken = self._overtakes(cmd, lane) or overtaken
+				self.command_queue.append(cmd, lane)
+		if overtaken:
+			self._recompensate()
+		self.state_dict['queue_size'] = len(self.command_queue)
+		self.state_dict['lane_sizes'] = self.command_queue.sizes()
+		self._step_command_queue()
+
+
+	def _optimize(self, cmd, lane):
+		"""Runs cmd through the MotionOptimizer if the 'optimize' config is on
+
+		Returns True if cmd was merged into the last queued normal line, or dropped as redundant
+		"""
+		if not self.config_dict['optimize']:
+			return False
+		if lane != 'normal':
+			# it may overtake the normal lane, so the optimizer no longer knows the device's modes
+			self.optimizer.reset()
+			return False
+		normal = self.command_queue.lanes['normal']
+		tail = None
+		# intermediate positions matter while feedback is on
+		if len(normal) > 0 and not self.state_dict['feedback_on']:
+			tail = normal[-1]
+			if tail['from'] != cmd['from'] or tail['session_id'] != cmd['session_id']:
+				tail = None
+			# a merged line has to be compensated again as a whole, see _recompensate
+			elif ('move' in tail) != ('move' in cmd) or 'plan' in tail or 'plan' in cmd:
+				tail = None
+		result = self.optimizer.optimize(cmd['command'], tail['command'] if tail is not None else None)
+		if result is None:
+			return False
+		if len(result) > 0:
+			tail['command'] = result
+			if 'move' in cmd:
+				tail['move'] = self._merge_moves(tail['move'], cmd['move'])
+			if 'line' in cmd:
+				tail['line'] = cmd['line']
+				tail['offset'] = cmd['offset']
+		self.state_dict['optimized_lines'] = self.optimizer.eliminated
+		flow_log.debug('_optimize: %r %s', cmd['command'], 'merged' if len(result) > 0 else 'dropped')
+		return True
+
+
+	def _merge_moves(self, first, second):
+		"""Returns the parsed move (see _parse_command) that goes as far as first and then second
+		"""
+		values = {param:float(val) for param, val in first[2]}
+		for param, val in second[2]:
+			values[param] = values.get(param, 0.0) + float(val)
+		params = []
+		for param, value in values.items():
+			value = round(value, 6)
+			# written the way the optimizer writes the merged line
+			params.append((param, int(value) if value == int(value) else value))
+		return (first[0], first[1], params)
+
+
+	def _overtakes(self, cmd, lane):
+		"""Returns True if cmd is a move that goes ahead of lines already queued in lower lanes
+		"""
+		if 'move' not in cmd:
+			return False
+		for lower in LANES[LANES.index(lane)+1:]:
+			if len(self.command_queue.lanes[lower]) > 0:
+				return True
+		return False
+
+
+	def _recompensate(self, first=()):
+		"""Compensates the queued moves again, in the order they will be sent (the messages of first,
+		then the queue's), starting from where the lines sent so far leave the axes
+
+		Moves are compensated when they are built, from where the moves queued before them leave the
+		axes. That no longer holds when a move overtakes them in a higher lane, or when the queue is
+		cleared, so their lines are built again from the 'move' they keep (the parsed, uncompensated
+		command). Precompiled lines can't be built again; the 'plan' on their last line says where
+		they leave the axes.
+		"""
+		direction, position = self.sent_plan
+		moves = []
+		for cmd in itertools.chain(first, *(self.command_queue.lanes[lane] for lane in LANES)):
+			if 'move' in cmd:
+				moves.append(cmd)
+			elif 'plan' in cmd:
+				direction, position = self._rebuild_moves(moves, direction, position)
+				moves = []
+				direction, position = cmd['plan']
+		direction, self.planned_pos = self._rebuild_moves(moves, direction, position)
+		for axis, value in direction.items():
+			self.state_dict.set_item('direction', axis, value)
+
+
+	def _rebuild_moves(self, moves, direction, position):
+		"""Compensates the queued messages moves from direction and position and encodes their lines again
+		"""
+		parsed_list = [cmd['move'] for cmd in moves]
+		direction, position = self._compensate(parsed_list, dict(direction), dict(position))
+		for cmd, (name, lane, params) in zip(moves, parsed_list):
+			cmd['command'] = self.encoder.encode(name, tuple(params))
+		return (direction, position)
+
+
 	def _step_command_queue(self):
-		print(datetime.datetime.now(),' - driver._step_command_queue')
+		flow_log.debug('_step_command_queue')
 		self.lock_check()
-		if self.state_dict['locked'] == False:
+		# send() re-checks the lock, so in streaming mode this keeps sending until the window is full
+		while self.state_dict['locked'] == False:
 			if len(self.command_queue) == 0:
-				if isinstance(self.meta_callbacks_dict['on_empty_queue'],Callable):
+				if len(self.in_flight) == 0 and isinstance(self.meta_callbacks_dict['on_empty_queue'],Callable):
 					self.meta_callbacks_dict['on_empty_queue'](self.current_info['from'],self.current_info['session_id'])
-			else:
-				self.send(self.command_queue.pop(0))
+				break
+			self.send(self.command_queue.popleft())
+		if self.stream_wakeup is not None:
+			if len(self.command_queue) == 0 or self._stream_room() >= self.config_dict['file_read_ahead'] // 2:
+				if not self.stream_wakeup.done():
+					self.stream_wakeup.set_result(None)
+				self.stream_wakeup = None
+		self._check_watermarks()
+
+
+	def _check_watermarks(self):
+		"""Calls on_queue_high when the queue reaches 'queue_high_watermark' lines, and on_queue_low
+		when it is back down to 'queue_low_watermark', for the client that took it past the high one
+		"""
+		size = len(self.command_queue)
+		if not self.state_dict['queue_high']:
+			high = self.config_dict['queue_high_watermark']
+			if high > 0 and size >= high:
+				self.state_dict['queue_high'] = True
+				self.watermark_info = self.queue_info
+				flow_log.info('%s: %d lines queued, above the high watermark', self.state_dict['name'], size)
+				if isinstance(self.meta_callbacks_dict['on_queue_high'],Callable):
+					self.meta_callbacks_dict['on_queue_high'](self.watermark_info['from'],self.watermark_info['session_id'],size)
+		elif size <= self.config_dict['queue_low_watermark']:
+			self.state_dict['queue_high'] = False
+			flow_log.info('%s: %d lines queued, below the low watermark', self.state_dict['name'], size)
+			if isinstance(self.meta_callbacks_dict['on_queue_low'],Callable):
+				self.meta_callbacks_dict['on_queue_low'](self.watermark_info['from'],self.watermark_info['session_id'],size)
+
+
+	def _check_room(self, data_list, lane=None):
+		"""Raises QueueFull (command_queue.py) if the commands of data_list don't fit in the command queue
+
+		Checked before anything is built, since building moves on the backlash compensation
+		"""
+		if self.command_queue.room() is None:
+			return
+		count = 0
+		for data in data_list:
+			name = self._command_name(data)
+			if name is not None and (lane if lane is not None else self.encoder.lanes[name]) != 'emergency':
+				count += 1
+		self.command_queue.check(count)
+
+
+	def _stream_has_credit(self, length):
+		"""Is there room in the device's receive buffer for another line of the given length?
+
+		An empty window always has room, so a line longer than the buffer can still go out on its own
+		"""
+		if len(self.in_flight) == 0:
+			return True
+		if len(self.in_flight) >= self.config_dict['stream_max_lines']:
+			return False
+		return self.state_dict['in_flight_bytes'] + length <= self.config_dict['stream_buffer_size']
+
+
+	def _on_ack_received(self):
+		if len(self.immediate_acks) > 0:
+			if self.immediate_acks[0] == 0:
+				# an immediate line's
+				self.immediate_acks.popleft()
+				return
+			for index in range(len(self.immediate_acks)):
+				self.immediate_acks[index] -= 1
+		self.state_dict['ack_received'] = True
+		self.awaiting_ack = None
+		if len(self.in_flight) > 0:
+			length, message = self.in_flight.popleft()
+			self.state_dict['in_flight'] = len(self.in_flight)
+			self.state_dict['in_flight_bytes'] -= length
 
 
 
 	def _format_text_data(self, text_data):
-		print(datetime.datetime.now(),' - driver._format_text_data:')
-		#print('\n\targs: ',locals(),'\n')
-		return_list = []
-		remainder_data = text_data
-		while remainder_data.find(',')>=0:
-			stupid_dict = self._format_group( remainder_data[:remainder_data.find(',')] ) 
-			return_list.append(stupid_dict)
-			remainder_data = remainder_data[remainder_data.find(',')+1:]
-		stupid_dict = self._format_group( remainder_data )
-		return_list.append(stupid_dict)
-		return return_list
+		"""Tokenizes a text reply in a single pass
 
+		eg. 'ok C: X:10.0 Y:20.0 Z:0.0' -> [ {'ok':{}}, {'C':{'X':10.0, 'Y':20.0, 'Z':0.0}} ]
 
-	def _format_group(self, group_data):
-		print(datetime.datetime.now(),' - driver._format_group:')
+		- 'word' or 'word:' starts a new message
+		- 'parameter:value' belongs to the last message started, or to 'None' if there isn't one
+		- numeric values are converted to float
+		"""
+		parser_log.debug('_format_text_data')
 		#print('\n\targs: ',locals(),'\n')
-		return_dict = dict()
-		remainder_data = group_data
-		if remainder_data.find(':')>=0:
-			while remainder_data.find(':')>=0:
-				message = remainder_data[:remainder_data.find(':')].replace('\n','').replace('\r','')
-				remainder_data = remainder_data[remainder_data.find(':')+1:]
-				if remainder_data.find(' ')>=0:
-					parameter = remainder_data[:remainder_data.find(' ')].replace('\n','').replace('\r','')
-					remainder_data = remainder_data[remainder_data.find(' ')+1:]
-				else:
-					parameter = remainder_data.replace('\r','').replace('\n','')
-					return_dict[message] = parameter
-		else:
-			return_dict[group_data.strip()] = ''
-		return return_dict
+		return_list = []
+		params = None
+		for name, colon, value in _TEXT_TOKEN.findall(text_data):
+			if value == '':
+				params = {}
+				return_list.append({name:params})
+			else:
+				if params is None:
+					params = {}
+					return_list.append({'None':params})
+				params[name] = _to_number(value)
+		return return_list
 
 
 	def _format_json_data(self, json_data):
@@ -577,7 +1105,7 @@ class SmoothieDriver(object):
 		#	}
 		#
 		#
-		print(datetime.datetime.now(),' - driver._format_json_data:')
+		parser_log.debug('_format_json_data')
 		#print('\n\targs: ',locals(),'\n')
 		return_list = []
 		for name, value in json_data.items():
@@ -611,7 +1139,7 @@ class SmoothieDriver(object):
 
 
 	def _process_message_dict(self, message_dict):
-		print(datetime.datetime.now(),' - driver._process_message_dict:')
+		parser_log.debug('_process_message_dict')
 		#print('\n\targs: ',locals(),'\n')
 
 		# First, pass messages to their respective callbacks based on callbacks and messages they're registered to receive
@@ -630,30 +1158,31 @@ class SmoothieDriver(object):
 		#
 		#
 		for name_message, value in message_dict.items():
-			if name_message == 'None':
+			if name_message in POSITION_MESSAGES:
 				axis_found = False
 				for axis in list(self.state_dict['smoothie_pos']):
 					if axis in value:
 						axis_found = True
-						self.state_dict['smoothie_pos'][axis] = value[axis]
+						self.state_dict.set_item('smoothie_pos', axis, value[axis])
 						if self.state_dict['direction'][axis] == 1:
-							self.state_dict['adjusted_pos'][axis] = value[axis]
+							self.state_dict.set_item('adjusted_pos', axis, value[axis])
 						else:
-							self.state_dict['adjusted_pos'][axis] = value[axis] + self.config_dict['slack'][axis]
+							self.state_dict.set_item('adjusted_pos', axis, value[axis] + self.config_dict['slack'][axis])
 
 				if axis_found == True:
-					pos_dict = {'pos':copy.deepcopy(self.state_dict['smoothie_pos'])}
-					adj_pos_dict = {'adj_pos':copy.deepcopy(self.state_dict['adjusted_pos'])}
-					for callback_name, callback in self.callbacks_dict.items():
-						if 'smoothie_pos' in callback['messages']:
-							callback['callback'](self.state_dict['name'], self.current_info['from'], self.current_info['session_id'], pos_dict)
-						if 'adjusted_pos' in callback['messages']:
-							callback['callback'](self.state_dict['name'], self.current_info['from'], self.current_info['session_id'], adj_pos_dict)
+					if 'smoothie_pos' in self.callback_index:
+						pos_dict = {'pos':self.state_dict.frozen('smoothie_pos')}
+						for callback in self.callback_index['smoothie_pos']:
+							callback(self.state_dict['name'], self.current_info['from'], self.current_info['session_id'], pos_dict)
+					if 'adjusted_pos' in self.callback_index:
+						adj_pos_dict = {'adj_pos':self.state_dict.frozen('adjusted_pos')}
+						for callback in self.callback_index['adjusted_pos']:
+							callback(self.state_dict['name'], self.current_info['from'], self.current_info['session_id'], adj_pos_dict)
 				
 
-			for callback_name, callback in self.callbacks_dict.items():
-				if name_message in callback['messages']:
-					callback['callback'](self.state_dict['name'], self.current_info['from'], self.current_info['session_id'], value)
+			# messages nobody subscribed to stop here
+			for callback in self.callback_index.get(name_message, ()):
+				callback(self.state_dict['name'], self.current_info['from'], self.current_info['session_id'], value)
 				
 
 
@@ -664,17 +1193,17 @@ class SmoothieDriver(object):
 		if self.config_dict['ack_received_message'] in list(message_dict) or self.config_dict['ack_received_message'] is None:
 			value = message_dict.get(self.config_dict['ack_received_message'])
 			if isinstance(value, dict):
-				if self.config_dict['ack_receieved_parameter'] is None:
-					self.state_dict['ack_received'] = True
+				if self.config_dict['ack_received_parameter'] is None:
+					self._on_ack_received()
 				else:
 					for value_name, value_value in value.items():
 						if value_name == self.config_dict['ack_received_parameter']:
-							if self.config_dict['ack_received_value'] is None or value_value == self.config_dict['ack_receieved_value']:
-								self.state_dict['ack_received'] = True
+							if self.config_dict['ack_received_value'] is None or _to_number(str(value_value)) == _to_number(str(self.config_dict['ack_received_value'])):
+								self._on_ack_received()
 			else:
 				if self.config_dict['ack_received_parameter'] is None:
 					if self.config_dict['ack_received_value'] is None or value == self.config_dict['ack_received_value']:
-						self.state_dict['ack_received'] = True
+						self._on_ack_received()
 
 
 		# third, check if ack_ready confirmation
@@ -686,7 +1215,7 @@ class SmoothieDriver(object):
 				else:
 					for value_name, value_value in value.items():
 						if value_name == self.config_dict['ack_ready_parameter']:
-							if self.config_dict['ack_ready_value'] is None or str(value_value) == str(self.config_dict['ack_ready_value']):
+							if self.config_dict['ack_ready_value'] is None or _to_number(str(value_value)) == _to_number(str(self.config_dict['ack_ready_value'])):
 								self.state_dict['ack_ready'] = True
 							else:
 								self.state_dict['ack_ready'] = False
@@ -707,16 +1236,23 @@ class SmoothieDriver(object):
 
 # Device callbacks
 	def _on_connection_made(self):
-		print(datetime.datetime.now(),' - driver._on_connection_made')
+		log.debug('_on_connection_made')
 		self.state_dict['connected'] = True
 		self.state_dict['transport'] = True if self.smoothie_transport else False
-		print('*\t*\t* connected!\t*\t*\t*')
+		self.state_dict['reconnecting'] = False
+		self.state_dict['reconnect_attempts'] = 0
+		log.info('%s connected', self.state_dict['name'])
 		if isinstance(self.meta_callbacks_dict['on_connect'],Callable):
 			self.meta_callbacks_dict['on_connect'](self.connected_info['from'],self.connected_info['session_id'])
+		# ask where the axes are before resuming the queue
+		if 'positions' in self.encoder.codes:
+			self._add_to_command_queue(self.connected_info['from'], self.connected_info['session_id'], self.encoder.encode('positions'), 'interactive')
+		else:
+			self._step_command_queue()
 
 
 	def _on_raw_data(self, data):
-		print(datetime.datetime.now(),' - driver._on_raw_data:')
+		log.debug('_on_raw_data')
 		#print('\n\targs: ',locals(),'\n')
 		if isinstance(self.meta_callbacks_dict['on_raw_data'],Callable):
                         if isinstance(data,bytes):
@@ -724,85 +1260,95 @@ class SmoothieDriver(object):
                         self.meta_callbacks_dict['on_raw_data'](self.current_info['from'],self.current_info['session_id'],data)
 
 
+	def _on_fast_line(self, fast):
+		"""Handles a line recognised by the LineFramer as a bare acknowledgement, without parsing it
+
+		fast is (<'ack_received' or 'ack_ready'>, <message>, <parameters>)
+		"""
+		kind, message, value = fast
+		for callback in self.callback_index.get(message, ()):
+			callback(self.state_dict['name'], self.current_info['from'], self.current_info['session_id'], dict(value))
+		if kind == 'ack_received':
+			self._on_ack_received()
+		else:
+			self.state_dict['ack_ready'] = True
+		self._step_command_queue()
+
+
 	def _smoothie_data_handler(self, datum):
 		"""Handles incoming data from Smoothieboard that has already been split by delimiter
 		"""
-		print(datetime.datetime.now(),' - driver._smoothie_data_handler:')
-		print('\n\targs: ',locals(),'\n')
+		parser_log.debug('_smoothie_data_handler: %r', datum)
 		json_data = ""
 		text_data = ""
 
 		if isinstance(datum,dict):
 			json_data = json.dumps(datum)
 		else:
-			str_datum = str(datum)
+			if isinstance(datum,bytes):
+				str_datum = datum.decode(errors='replace')
+			else:
+				str_datum = str(datum)
 			text_data = str_datum
 
-			if self.config_dict['ack_received_message'] in str_datum:
-				self.ack_received = True
-
 			if str_datum.find('{')>=0:
 				json_data = str_datum[str_datum.find('{'):].replace('\n','').replace('\r','')
 				text_data = str_datum[:str_datum.index('{')]
 
 		if text_data != "":
-			print('\ttext_data: ',text_data)
 			text_message_list = self._format_text_data(text_data)
 			
 			for message in text_message_list:
 				self._process_message_dict(message)
 
 		if json_data != "":
-			print('\tjson_data: ',json_data)
 			try:
 				json_data_dict = json.loads(json_data)
 				json_message_list = self._format_json_data(json_data_dict)
 				for message in json_message_list:
 					self._process_message_dict(message)
 			except:
-				print(datetime.datetime.now(),' - {error:driver._smoothie_data_handler - json.loads(json_data)}\n\r',sys.exc_info())
+				parser_log.exception('error: _smoothie_data_handler - json.loads(%r)', json_data)
 
 
 	def _on_connection_lost(self):
-		print(datetime.datetime.now(),' - driver._on_connection_lost')
+		log.debug('_on_connection_lost')
 		self.state_dict['connected'] = False
 		self.state_dict['transport'] = True if self.smoothie_transport else False
-		print('*\t*\t* not connected!\t*\t*\t*')
+		log.info('%s not connected', self.state_dict['name'])
+		self.optimizer.reset()
+		self._requeue_unacknowledged()
 		if isinstance(self.meta_callbacks_dict['on_disconnect'],Callable):
 			self.meta_callbacks_dict['on_disconnect'](self.disconnected_info['from'],self.disconnected_info['session_id'])
+		if not self.disconnecting and self.config_dict['reconnect']:
+			self.state_dict['reconnecting'] = True
+			self._start_link()
 
 
-	def _adjust_positions(self, command_text, val, param):
-		if command_text.startswith("G90"):					
-			print('(1)')
-			print(val)
-			float_val = float(val)
-			print(float_val)
-			if float_val > self.state_dict['smoothie_pos'][param] and self.state_dict['direction'][param]==0:
-				print('(2)')
-				self.state_dict['direction'][param] = 1
-				float_val+=self.config_dict['slack'][param]
-			if float_val < self.state_dict['smoothie_pos'][param] and self.state_dict['direction'][param]==1:
-				print('(3)')
-				self.config_dict['direction'][param] = 0
-				float_val-=self.config_dict['slack'][param]
-				val = str(float_val)
-
-		if command_text.startswith("G91"):
-
-			float_val = float(val)
-			if float_val > 0 and self.state_dict['direction'][param]==0:
-				self.state_dict['direction'][param] = 1
-				float_val+=self.config_dict['slack'][param]
-			if float_val < 0 and self.state_dict['direction'][param]==1:
-				self.state_dict['direction'][param] = 0
-				float_val-=self.config_dict['slack'][param]
-				val = str(float_val)
+	def _requeue_unacknowledged(self):
+		"""Puts lines that were sent but not acknowledged back at the head of the command queue
 
-		return val
+		Whether the device got them is unknown, so they are sent again, resuming from the last
+		acknowledged line
+		"""
+		unacknowledged = [message for length, message in self.in_flight]
+		if self.awaiting_ack is not None:
+			unacknowledged.append(self.awaiting_ack)
+		for message in unacknowledged:
+			if 'start' in message:
+				# they leave the axes where they did before, but the lines sent so far no longer do
+				self.sent_plan = message['start']
+				break
+		self.command_queue.requeue(unacknowledged)
+		self._clear_in_flight()
+		self.state_dict['queue_size'] = len(self.command_queue)
+		self.state_dict['lane_sizes'] = self.command_queue.sizes()
+		self.lock_check()
+		if len(unacknowledged) > 0:
+			log.info('requeued %d unacknowledged lines', len(unacknowledged))
 
 
-	def send_command(self, from_, session_id, data):
+	def send_command(self, from_, session_id, data, lane=None):
 		"""
 
 		data should be in one of 2 forms:
@@ -816,60 +1362,377 @@ class SmoothieDriver(object):
 		2. {command:params}
 			params --> {param1:value, ... , paramN:value}
 
+		lane is the command queue lane ('normal', 'interactive' or 'emergency'), if None the
+		command's default lane from commands_dict is used
+
+		Raises QueueFull if the command queue has no room for it (see 'max_queue_size')
+
 		"""
-		print(datetime.datetime.now(),' - driver.send_command:')
+		log.debug('send_command')
 		#print('\n\targs: ',locals(),'\n')
-		command_text = ""
+		self._check_room([data], lane)
+		built = self._build_command(data, lane)
+		if built is not None:
+			line, lane, extra = built
+			self._add_to_command_queue(from_ ,session_id, line, lane, extra)
+		#else:
+		#	print("command is NOT in list!")
 
-		# data in form 1
-		if isinstance(data, dict):
-			command = list(data)[0]
+
+	def send_commands(self, from_, session_id, data_list, lane=None):
+		"""
+		Queues a whole list of commands in one pass
+
+		data_list is a list of commands, each in one of the forms send_command takes.
+
+		The batch is all or nothing: if any command is unknown, a ValueError naming their
+		indexes is raised and nothing is queued, and if the batch doesn't fit in the command
+		queue QueueFull is raised. The queue is stepped once, after the whole
+		batch has been queued.
+
+		returns {'queued': number of commands queued, 'queue_size': size of the command queue,
+		'optimized': number of them the optimizer merged or dropped}
+		"""
+		log.debug('send_commands')
+		#print('\n\targs: ',locals(),'\n')
+		if not isinstance(data_list, list):
+			raise ValueError('send_commands expects a list of commands')
+		unknown = [index for index, data in enumerate(data_list) if self._command_name(data) is None]
+		if len(unknown) > 0:
+			raise ValueError('unknown commands at indexes: '+str(unknown))
+		self._check_room(data_list, lane)
+
+		built_list = self._build_commands(data_list, lane)
+		eliminated = self.optimizer.eliminated
+		self._extend_command_queue(from_, session_id, built_list)
+		return {'queued':len(built_list), 'queue_size':len(self.command_queue), 'optimized':self.optimizer.eliminated - eliminated}
+
+
+	def precompile(self, protocol):
+		"""
+		Compiles protocol, a list of commands in the forms send_command takes, into its G-code and
+		caches it on disk (see precompiler.py), unless it is cached already
+
+		The moves are compensated from where the queued moves will leave the axes, so the result is
+		meant to be run next, with run_precompiled
+
+		returns {'key': what to give run_precompiled, 'lines': number of lines, 'bytes': size of
+		the G-code, 'cached': True if it had been compiled before}
+		"""
+		log.debug('precompile')
+		if not isinstance(protocol, list):
+			raise ValueError('precompile expects a list of commands')
+		unknown = [index for index, data in enumerate(protocol) if self._command_name(data) is None]
+		if len(unknown) > 0:
+			raise ValueError('unknown commands at indexes: '+str(unknown))
+
+		start_direction, start_position = self._planned_start()
+		key = self.precompiler.key(protocol, self.commands_dict, self.config_dict['message_ender'],
+			self.config_dict['slack'], start_direction, start_position)
+		artifact = self.precompiler.load(key)
+		if artifact is not None:
+			data, sidecar = artifact
+			return {'key':key, 'lines':sidecar['lines'], 'bytes':len(data), 'cached':True}
+
+		parsed_list = [self._parse_command(data) for data in protocol]
+		direction, position = self._compensate(parsed_list, start_direction, start_position)
+		lines = []
+		lanes = []
+		for index, (name, lane, params) in enumerate(parsed_list):
+			lines.append(self.encoder.encode(name, tuple(params)))
+			if lane != 'normal':
+				lanes.append([index, lane])
+		data = b''.join(lines)
+		if data.count(self.encoder.ender) != len(lines):
+			raise ValueError('a command contains the message_ender, the protocol cannot be precompiled')
+		self.precompiler.store(key, data, {
+			'lines':len(lines),
+			'lanes':lanes,
+			'message_ender':self.config_dict['message_ender'],
+			'start':{'direction':start_direction, 'position':start_position},
+			'direction':direction,
+			'position':position
+		})
+		log.info('precompiled %d lines as %s', len(lines), key)
+		return {'key':key, 'lines':len(lines), 'bytes':len(data), 'cached':False}
+
+
+	def run_precompiled(self, from_, session_id, key):
+		"""
+		Queues a protocol precompiled by precompile() straight from the cache, without building a line
+
+		Raises ValueError if key isn't cached, or the axes no longer start where it was compiled for
+		(precompiling it again gives the key for where they are now), and QueueFull if it doesn't fit
+		in the command queue
+
+		returns {'key': key, 'queued', 'queue_size', 'optimized'}, as send_commands
+		"""
+		log.debug('run_precompiled')
+		artifact = self.precompiler.load(key)
+		if artifact is None:
+			raise ValueError('not precompiled: '+str(key))
+		data, sidecar = artifact
+		direction, position = self._planned_start()
+		if sidecar['start'] != {'direction':direction, 'position':position} or sidecar['message_ender'] != self.config_dict['message_ender']:
+			raise ValueError('precompiled for another starting position or message_ender: '+str(key))
+		self.command_queue.check(sidecar['lines'] - len([lane for index, lane in sidecar['lanes'] if lane == 'emergency']))
+
+		ender = self.encoder.ender
+		lanes = {index:lane for index, lane in sidecar['lanes']}
+		built_list = [(line+ender, lanes.get(index, 'normal'), None) for index, line in enumerate(data.split(ender)[:-1])]
+		if len(built_list) > 0:
+			# its lines can't be compensated again, but where they leave the axes is known
+			line, lane, extra = built_list[-1]
+			built_list[-1] = (line, lane, {'plan':(dict(sidecar['direction']), dict(sidecar['position']))})
+		for axis, value in sidecar['direction'].items():
+			self.state_dict.set_item('direction', axis, value)
+		self.planned_pos = sidecar['position']
+		eliminated = self.optimizer.eliminated
+		self._extend_command_queue(from_, session_id, built_list)
+		return {'key':key, 'queued':len(built_list), 'queue_size':len(self.command_queue), 'optimized':self.optimizer.eliminated - eliminated}
+
+
+	def run_file(self, from_, session_id, path):
+		"""
+		Runs the G-code file at path without reading it into memory, see run_stream
+		"""
+		log.debug('run_file')
+		source = open(path, 'rb')
+		try:
+			total_bytes = os.fstat(source.fileno()).st_size
+			return self.run_stream(from_, session_id, source, path, total_bytes, close_source=True)
+		except:
+			source.close()
+			raise
+
+
+	def run_stream(self, from_, session_id, source, name='stream', total_bytes=None, close_source=False):
+		"""
+		Runs G-code read from source, a binary file or anything else whose read(size) returns bytes
+		(b'' at the end), or an asyncio.StreamReader (anything whose read(size) is a coroutine)
+
+		Lines are read 'file_chunk_size' bytes at a time and queued as the normal lane of the command
+		queue drains, so no more than 'file_read_ahead' lines and a chunk are held in memory however
+		long the file is. Lines go to the device as they are, with comments (';' to the end of the line) and
+		blank lines left out.
+
+		Progress is kept in state_dict['stream']: lines and bytes of the file read and sent (line
+		numbers and byte offsets, so they point into the file), and reported to the on_progress
+		meta-callback once per read and when the stream ends. clear_queue stops the stream.
+
+		Raises ValueError if a stream is running already, returns state_dict['stream']
+		"""
+		log.debug('run_stream')
+		if self.stream_task is not None and not self.stream_task.done():
+			raise ValueError('already running '+str(self.state_dict['stream']['name']))
+		self.state_dict['stream'] = {'active':True,'name':name,'read_lines':0,'read_bytes':0,'sent_lines':0,'sent_bytes':0,
+			'total_bytes':total_bytes,'done':False,'error':None}
+		self.stream_task = asyncio.ensure_future(self._run_stream(from_, session_id, source, close_source))
+		return self.state_dict.frozen('stream')
+
+
+	@asyncio.coroutine
+	def _run_stream(self, from_, session_id, source, close_source):
+		framer = LineFramer(b'\n', self.config_dict['receive_buffer_size'])
+		ender = self.encoder.ender
+		line_number = 0
+		offset = 0
+		read = 0
+		try:
+			while True:
+				chunk = source.read(self.config_dict['file_chunk_size'])
+				if asyncio.iscoroutine(chunk) or isinstance(chunk, asyncio.Future):
+					chunk = yield from chunk
+				read += len(chunk)
+				if len(chunk) == 0:
+					# a last line without a newline
+					lines = [bytes(framer.buffer)] if len(framer.buffer) > 0 else []
+					framer.clear()
+				else:
+					overflows = framer.overflows
+					lines = framer.feed(chunk)
+					if framer.overflows != overflows:
+						raise ValueError('line longer than receive_buffer_size after line '+str(line_number))
+				built_list = []
+				offsets = []
+				for line in lines:
+					line_number += 1
+					offset += len(line)
+					text = line.split(b';', 1)[0].strip()
+					if len(text) > 0:
+						built_list.append((text+ender, 'normal', None))
+						offsets.append((line_number, offset))
+				self.state_dict.set_item('stream', 'read_lines', line_number)
+				self.state_dict.set_item('stream', 'read_bytes', read)
+				# queued as the window has room, so a chunk of short lines doesn't overfill it
+				start = 0
+				while start < len(built_list):
+					yield from self._stream_window()
+					end = start + self._stream_room()
+					self._extend_command_queue(from_, session_id, built_list[start:end], offsets[start:end])
+					start = end
+				if len(chunk) == 0:
+					break
+				self._stream_progress(from_, session_id)
+			self.state_dict.set_item('stream', 'done', True)
+			log.info('%s: %s read, %d lines', self.state_dict['name'], self.state_dict['stream']['name'], line_number)
+		except asyncio.CancelledError:
+			self.state_dict.set_item('stream', 'error', 'cancelled')
+		except Exception:
+			log.exception('%s: stream %s failed', self.state_dict['name'], self.state_dict['stream']['name'])
+			self.state_dict.set_item('stream', 'error', str(sys.exc_info()[1]))
+		finally:
+			self.state_dict.set_item('stream', 'active', False)
+			if close_source:
+				source.close()
+			self._stream_progress(from_, session_id)
+
+
+	@asyncio.coroutine
+	def _stream_window(self):
+		"""Waits until the normal lane (and the command queue) has room for more lines
+		"""
+		while self._stream_room() <= 0:
+			if self.stream_wakeup is None:
+				self.stream_wakeup = asyncio.Future()
+			yield from self.stream_wakeup
+
+
+	def _stream_room(self):
+		"""Returns how many more lines of a file or stream can be queued now
+		"""
+		room = self.config_dict['file_read_ahead'] - len(self.command_queue.lanes['normal'])
+		queue_room = self.command_queue.room()
+		if queue_room is not None:
+			room = min(room, queue_room)
+		return room
+
+
+	def _stream_progress(self, from_, session_id):
+		if isinstance(self.meta_callbacks_dict['on_progress'],Callable):
+			self.meta_callbacks_dict['on_progress'](from_, session_id, self.state_dict.frozen('stream'))
+
+
+	def _command_name(self, data):
+		"""Returns the commands_dict name for data (given as a command name or a code), or None if unknown
+		"""
+		if isinstance(data, dict) and len(data) > 0:
+			return self.encoder.lookup(list(data)[0])
+		elif isinstance(data, str):
+			return self.encoder.lookup(data)
+		return None
+
+
+	def _build_command(self, data, lane=None):
+		"""Turns data (see send_command) into (encoded line, lane, extra), or None if the command is unknown
+
+		extra is None, or {'move': the parsed command before compensation} for moves, see _recompensate
+		"""
+		return self._build_commands([data], lane)[0]
+
+
+	def _build_commands(self, data_list, lane=None):
+		"""_build_command for a whole list, with backlash compensation done in one pass
+		"""
+		parsed_list = [self._parse_command(data, lane) for data in data_list]
+		uncompensated = list(parsed_list)
+		direction, position = self._planned_start()
+		direction, self.planned_pos = self._compensate(parsed_list, direction, position)
+		for axis, value in direction.items():
+			self.state_dict.set_item('direction', axis, value)
+		built_list = []
+		for parsed, original in zip(parsed_list, uncompensated):
+			if parsed is None:
+				built_list.append(None)
+			else:
+				name, command_lane, params = parsed
+				extra = {'move':original} if self._is_move(original) else None
+				built_list.append((self.encoder.encode(name, tuple(params)), command_lane, extra))
+		return built_list
+
+
+	def _parse_command(self, data, lane=None):
+		"""Returns (command name, lane, [(parameter, value), ...]) for data, or None if the command is unknown
+		"""
 		# data in form 2
+		if isinstance(data, dict) and len(data) > 0:
+			command = list(data)[0]
+		# data in form 1
 		elif isinstance(data, str):
 			command = data
-		
-		# check if command is in commands dictionary
-		if command in list(self.commands_dict):
-			command_text = self.commands_dict[command]["code"]
-			print('command_text: ',command_text)
-			if isinstance(data, dict):
-				#print('data is dict')
-				if isinstance(data[command], dict):
-					#print('data[',command,'] is dict')
-					for param, val in data[command].items():
-						if param in self.commands_dict[command]["parameters"]:
-							if param in list(self.state_dict['smoothie_pos']):
-
-								val = self._adjust_positions(command_text, val, param)
-
-							command_text += " "
-							command_text += str(param)
-							command_text += str(val)
-			
-			self._add_to_command_queue(from_ ,session_id, command_text)
-
-		else:	#check whether command is actually a code in commands dictionary
-			for cmd, dat in self.commands_dict.items():
-				if command == dat.get("code"):
-					# command is actually a code in the commands dictionary
-					command_text = command
-					if isinstance(data,dict):
-						if isinstance(data[command], dict):
-							for param, val in data[command].items():
-								if param in val.parameters:
-									if param in self.state_dict['smoothie_pos']:
-										
-										val = self._adjust_positions(command_text, val)
-
-									command_text += " "
-									command_text += str(param)
-									command_text += str(val)
-
-					self._add_to_command_queue(from_, session_id, command_text)
-					break
+		else:
+			return None
 
-		#else:
-		#	print("command is NOT in list!")
+		# command can be a name in commands dictionary or one of its codes
+		name = self.encoder.lookup(command)
+		if name is None:
+			return None
+		if lane is None:
+			lane = self.encoder.lanes[name]
+
+		params = []
+		if isinstance(data, dict) and isinstance(data[command], dict):
+			allowed = self.encoder.parameters[name]
+			params = [(param, val) for param, val in data[command].items() if param in allowed]
+		return (name, lane, params)
+
+
+	def _planned_start(self):
+		"""Returns the (direction, position) the next queued move starts from
+		"""
+		if len(self.command_queue) == 0 and len(self.in_flight) == 0 and self.awaiting_ack is None:
+			# nothing pending, the device's position is up to date
+			self.planned_pos = dict(self.state_dict['adjusted_pos'])
+			self.sent_plan = (dict(self.state_dict['direction']), dict(self.planned_pos))
+		return (dict(self.state_dict['direction']), dict(self.planned_pos))
+
+
+	def _is_move(self, parsed):
+		"""Returns True if parsed (see _parse_command) is a move _compensate works on
+		"""
+		if parsed is None:
+			return False
+		code = self.encoder.codes[parsed[0]]
+		if not (code.startswith('G90') or code.startswith('G91')):
+			return False
+		axes = self.state_dict['smoothie_pos']
+		return any(param in axes for param, val in parsed[2])
+
+
+	def _compensate(self, parsed_list, direction, position):
+		"""Applies backlash compensation (backlash.py) to the G90/G91 moves of parsed_list, in place
+
+		The moves start from direction and position, returns the (direction, position) they leave the axes at
+		"""
+		axes = list(self.state_dict['smoothie_pos'])
+		moves = []
+		rows = []
+		relative = []
+		for row, parsed in enumerate(parsed_list):
+			if parsed is None:
+				continue
+			code = self.encoder.codes[parsed[0]]
+			if not (code.startswith('G90') or code.startswith('G91')):
+				continue
+			move = {param:float(val) for param, val in parsed[2] if param in axes}
+			if len(move) > 0:
+				moves.append(move)
+				rows.append(row)
+				relative.append(code.startswith('G91'))
+		if len(moves) == 0:
+			return (direction, position)
+
+		compensated, direction, position = backlash.compensate(
+			moves, axes, self.config_dict['slack'], direction, position, relative)
+
+		for row, move, result in zip(rows, moves, compensated):
+			name, lane, params = parsed_list[row]
+			# values that didn't change keep their original form, so the line stays the same
+			parsed_list[row] = (name, lane, [
+				(param, round(result[param], 6) if param in result and result[param] != move[param] else val)
+				for param, val in params
+			])
+		return (direction, position)
 
 
 
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import math
+import random
+import sys
+from collections import deque
+
+import driver_log
+
+
+log = driver_log.get_logger('output')
+
+
+AXES = ('X', 'Y', 'Z', 'A', 'B', 'C')
+
+# axes driven by the feed and seek rates, the others have their own speeds ('a', 'b', 'c')
+LINEAR_AXES = ('X', 'Y', 'Z')
+
+# bytes received but not yet in the RX buffer before the connection is pushed back on, as much
+# as an asyncio.StreamReader holds on to
+LINK_BUFFER_SIZE = 2 ** 16
+
+
+
+def move_time(distance, rate, acceleration):
+	"""Seconds a move of distance takes at rate with a trapezoidal profile, from a stop to a stop
+
+	If the move is too short to reach rate it accelerates to halfway and decelerates from there
+	"""
+	if distance <= 0 or rate <= 0:
+		return 0.0
+	if acceleration <= 0:
+		return distance / rate
+	if distance >= rate * rate / acceleration:
+		return distance / rate + rate / acceleration
+	return 2.0 * math.sqrt(distance / acceleration)
+
+
+
+
+class SimulatedSmoothie(object):
+	"""
+	A Smoothieboard, closely enough to measure streaming throughput and flow control against
+
+	- Received lines go into an RX buffer of rx_buffer_size bytes as it has room, the rest waits in
+	  the connection, which is pushed back on once LINK_BUFFER_SIZE bytes are waiting. A line
+	  longer than the RX buffer is dropped.
+	- Lines are taken out of the RX buffer in order and parsed, and only while the planner has
+	  fewer than planner_size blocks. 'ok' is sent when a line has been parsed, so when the planner
+	  is full the device stops answering, as the real one does.
+	- G0/G1/G28 become planner blocks that take as long as the move would: feed rate ('F', M198)
+	  or seek rate (M199) along X, Y and Z, 'a'/'b'/'c' (or M198/M199's A and B) for the other axes,
+	  each axis capped at its max rate (M203, mm/s), with a trapezoidal profile at the acceleration
+	  set by M204 (S for X/Y, Z, A, B). Every block starts and ends at a stop, junctions (M205) are
+	  not planned. time_scale scales motion time, 0 makes moves instant.
+	- M114 answers 'ok C: X:.. Y:.. Z:.. A:.. B:.. C:..' with the last planned position, M119 the
+	  min endstops (pressed when an axis sits at 0), M400 waits for the planner to empty.
+	- With feedback on (M62) the position is sent as JSON after every block, and {"stat":0} whenever
+	  the planner runs empty, or a line is handled while it is empty.
+	- M112 halts as soon as its line is received, ahead of the lines waiting for the RX buffer or
+	  the planner: the planner is dropped and every line is answered with '!!' until M999.
+	- Every reply is delayed by latency plus up to jitter seconds, in order.
+
+	stats() reports counters for throughput measurements.
+	"""
+
+
+	def __init__(self, rx_buffer_size=128, planner_size=32, time_scale=1.0, latency=0.0, jitter=0.0, loop=None):
+		self.rx_buffer_size = rx_buffer_size
+		self.planner_size = planner_size
+		self.time_scale = time_scale
+		self.latency = latency
+		self.jitter = jitter
+		self.loop = loop if loop is not None else asyncio.get_event_loop()
+
+		self.rx = bytearray()
+		self.incoming = bytearray()	# received, waiting for room in the RX buffer
+		self.scanned = 0	# incoming holds complete lines up to here, checked for M112
+		self.link_space = None	# Future serve() waits on while LINK_BUFFER_SIZE bytes are waiting
+		self.planner = deque()	# (seconds, position the block ends at)
+		self.block_handle = None
+		self.writer = None
+		self.closed = False
+		self.reply_due = 0.0
+
+		self.absolute = True
+		self.halted = False
+		self.feedback = False
+		self.waiting_idle = False
+		self.position = {axis:0.0 for axis in AXES}	# where the planned moves end
+		self.machine_position = {axis:0.0 for axis in AXES}	# where the executed moves ended
+		self.feed_rate = 4000.0	# mm/min
+		self.seek_rate = 4000.0	# mm/min
+		self.axis_rates = {'A':3000.0, 'B':3000.0, 'C':3000.0}	# mm/min
+		self.max_rates = {'X':500.0, 'Y':500.0, 'Z':100.0, 'A':100.0, 'B':100.0, 'C':100.0}	# mm/s
+		self.accelerations = {'X':3000.0, 'Y':3000.0, 'Z':1000.0, 'A':1000.0, 'B':1000.0, 'C':1000.0}	# mm/s^2
+		self.junction = {}
+
+		self.counters = {'lines':0, 'moves':0, 'bytes':0, 'rx_peak':0, 'planner_peak':0, 'motion_time':0.0, 'overflows':0}
+
+
+	def stats(self):
+		return dict(self.counters, rx=len(self.rx), incoming=len(self.incoming), planner=len(self.planner))
+
+
+	@asyncio.coroutine
+	def serve(self, reader, writer):
+		"""Talks to one connection until it closes
+		"""
+		self.writer = writer
+		try:
+			while True:
+				if len(self.incoming) >= LINK_BUFFER_SIZE:
+					if self.scanned == 0:
+						# no line in sight, it could never be parsed
+						self.counters['overflows'] += 1
+						del self.incoming[:]
+						continue
+					self.link_space = asyncio.Future(loop=self.loop)
+					yield from self.link_space
+					continue
+				data = yield from reader.read(self.rx_buffer_size)
+				if len(data) == 0:
+					break
+				self.counters['bytes'] += len(data)
+				self._receive(data)
+		finally:
+			self.closed = True
+			if self.block_handle is not None:
+				self.block_handle.cancel()
+			writer.close()
+
+
+	def _receive(self, data):
+		"""Takes data from the connection: M112 lines are acted on at once, the others wait their turn
+		"""
+		self.incoming += data
+		start = self.scanned
+		while True:
+			end = self.incoming.find(b'\n', start)
+			if end < 0:
+				break
+			if self.incoming.find(b'M112', start, end) >= 0 and self.incoming[start:end].split()[:1] == [b'M112']:
+				del self.incoming[start:end+1]
+				self.counters['lines'] += 1
+				self._halt()
+			else:
+				start = end + 1
+		self.scanned = start
+		self._consume()
+
+
+	def _fill(self):
+		"""Moves the complete lines that fit from incoming into the RX buffer
+		"""
+		while self.scanned > 0:
+			room = self.rx_buffer_size - len(self.rx)
+			end = self.incoming.rfind(b'\n', 0, min(room, self.scanned))
+			if end >= 0:
+				self.rx += self.incoming[:end+1]
+				del self.incoming[:end+1]
+				self.scanned -= end + 1
+				self.counters['rx_peak'] = max(self.counters['rx_peak'], len(self.rx))
+				return
+			if len(self.rx) > 0:
+				return
+			# a line longer than the RX buffer can never be parsed
+			end = self.incoming.find(b'\n', 0, self.scanned)
+			del self.incoming[:end+1]
+			self.scanned -= end + 1
+			self.counters['overflows'] += 1
+
+
+	def _consume(self):
+		"""Parses lines from the RX buffer while the planner has room
+		"""
+		while True:
+			self._fill()
+			if len(self.planner) >= self.planner_size or self.waiting_idle:
+				break
+			end = self.rx.find(b'\n')
+			if end < 0:
+				break
+			line = bytes(self.rx[:end+1])
+			del self.rx[:end+1]
+			self.counters['lines'] += 1
+			self._handle(line.decode(errors='replace').strip())
+		if self.link_space is not None and len(self.incoming) < LINK_BUFFER_SIZE:
+			if not self.link_space.done():
+				self.link_space.set_result(None)
+			self.link_space = None
+
+
+	def _handle(self, line):
+		if len(line) == 0:
+			return
+		tokens = line.split()
+		if self.halted:
+			if tokens[0] == 'M999':
+				self.halted = False
+				self._reply('ok')
+			else:
+				self._reply('!!')
+			return
+		words = [(token[:1], token[1:]) for token in tokens]
+		codes = [token for token in tokens if token[:1] in ('G', 'M')]
+		params = {}
+		for letter, value in words:
+			try:
+				params[letter] = float(value)
+			except ValueError:
+				pass
+
+		if 'M112' in codes:
+			self._halt()
+			return
+
+		for code in codes:
+			if code == 'G90':
+				self.absolute = True
+			elif code == 'G91':
+				self.absolute = False
+			elif code == 'M62':
+				self.feedback = True
+			elif code == 'M63':
+				self.feedback = False
+			elif code == 'M198':
+				self._set_rates(params, 'feed_rate')
+			elif code == 'M199':
+				self._set_rates(params, 'seek_rate')
+			elif code == 'M203':
+				self.max_rates.update({axis:params[axis] for axis in AXES if axis in params})
+			elif code == 'M204':
+				if 'S' in params:
+					self.accelerations['X'] = self.accelerations['Y'] = params['S']
+				self.accelerations.update({axis:params[axis] for axis in ('Z', 'A', 'B', 'C') if axis in params})
+			elif code == 'M205':
+				self.junction.update({letter:value for letter, value in params.items() if letter in ('X', 'Z', 'S')})
+		# modal speeds, when they come on their own
+		if len(codes) == 0:
+			if 'F' in params:
+				self.feed_rate = params['F']
+			for axis in ('A', 'B', 'C'):
+				if axis.lower() in params:
+					self.axis_rates[axis] = params[axis.lower()]
+
+		if 'M114' in codes:
+			self._reply('ok C: '+' '.join('%s:%.4f' % (axis, self.position[axis]) for axis in AXES))
+		elif 'M119' in codes:
+			self._reply(' '.join('%s_min:%d' % (axis, self.position[axis] == 0) for axis in AXES))
+			self._reply('ok')
+		elif 'M400' in codes:
+			if len(self.planner) > 0:
+				# answered when the planner is empty
+				self.waiting_idle = True
+			else:
+				self._reply('ok')
+		elif 'G28' in codes:
+			axes = [axis for axis in AXES if axis in params] or list(LINEAR_AXES)
+			self._plan({axis:0.0 for axis in axes}, self.seek_rate)
+			self._reply('ok')
+		elif 'G0' in codes or 'G1' in codes:
+			if 'F' in params and 'G1' in codes:
+				self.feed_rate = params['F']
+			rate = self.seek_rate if 'G0' in codes else self.feed_rate
+			if self.absolute:
+				target = {axis:params[axis] for axis in AXES if axis in params}
+			else:
+				target = {axis:self.position[axis] + params[axis] for axis in AXES if axis in params}
+			self._plan(target, rate)
+			self._reply('ok')
+		else:
+			self._reply('ok')
+		if self.feedback and len(self.planner) == 0 and not self.waiting_idle:
+			# nothing is moving, so the line is done as soon as it is parsed
+			self._reply('{"stat":0}')
+
+
+	def _halt(self):
+		self.planner.clear()
+		if self.block_handle is not None:
+			self.block_handle.cancel()
+			self.block_handle = None
+		self.position = dict(self.machine_position)
+		self.halted = True
+		self.waiting_idle = False
+		self._reply('ok Emergency Stop Requested - reset or M999 required to exit HALT state')
+
+
+	def _set_rates(self, params, name):
+		if 'S' in params:
+			setattr(self, name, params['S'])
+		self.axis_rates.update({axis:params[axis] for axis in ('A', 'B') if axis in params})
+
+
+	def _plan(self, target, rate):
+		"""Adds the block moving to target to the planner
+		"""
+		deltas = {axis:target[axis] - self.position[axis] for axis in target if target[axis] != self.position[axis]}
+		if len(deltas) == 0:
+			return
+		seconds = 0.0
+		linear = [axis for axis in deltas if axis in LINEAR_AXES]
+		if len(linear) > 0:
+			distance = math.sqrt(sum(deltas[axis] ** 2 for axis in linear))
+			speed = rate / 60.0
+			for axis in linear:
+				speed = min(speed, self.max_rates[axis] * distance / abs(deltas[axis]))
+			acceleration = min(self.accelerations[axis] for axis in linear)
+			seconds = move_time(distance, speed, acceleration)
+		for axis in deltas:
+			if axis not in LINEAR_AXES:
+				speed = min(self.axis_rates[axis] / 60.0, self.max_rates[axis])
+				seconds = max(seconds, move_time(abs(deltas[axis]), speed, self.accelerations[axis]))
+		self.position.update(target)
+		self.planner.append((seconds, dict(self.position)))
+		self.counters['moves'] += 1
+		self.counters['motion_time'] += seconds
+		self.counters['planner_peak'] = max(self.counters['planner_peak'], len(self.planner))
+		if self.block_handle is None:
+			self._start_block()
+
+
+	def _start_block(self):
+		seconds, position = self.planner[0]
+		if self.time_scale > 0:
+			self.block_handle = self.loop.call_later(seconds * self.time_scale, self._end_block)
+		else:
+			self.block_handle = self.loop.call_soon(self._end_block)
+
+
+	def _end_block(self):
+		seconds, position = self.planner.popleft()
+		self.machine_position = position
+		self.block_handle = None
+		if self.feedback:
+			self._reply(json.dumps({axis:position[axis] for axis in AXES}))
+		if len(self.planner) > 0:
+			self._start_block()
+		else:
+			if self.feedback:
+				self._reply('{"stat":0}')
+			if self.waiting_idle:
+				self.waiting_idle = False
+				self._reply('ok')
+		self._consume()
+
+
+	def _reply(self, text):
+		data = (text+'\r\n').encode()
+		if self.writer is None or self.closed:
+			return
+		if self.latency <= 0 and self.jitter <= 0:
+			self.writer.write(data)
+			return
+		# delayed, but never overtaking an earlier reply
+		due = max(self.reply_due, self.loop.time() + self.latency + random.uniform(0, self.jitter))
+		self.reply_due = due
+		self.loop.call_at(due, self._write, data)
+
+
+	def _write(self, data):
+		if not self.closed:
+			self.writer.write(data)
+
+
+
+@asyncio.coroutine
+def simulator(reader, writer, **options):
+	"""asyncio.start_server callback, each connection talks to its own SimulatedSmoothie(**options)
+	"""
+	device = SimulatedSmoothie(**options)
+	yield from device.serve(reader, writer)
+	log.debug('simulator connection closed: %s', device.stats())
+
+
+
+
+if __name__ == '__main__':
+	# a stand-in device to point SMOOTHIE_HOST/SMOOTHIE_PORT at: smoothie_simulator.py [port]
+	driver_log.configure()
+	loop = asyncio.get_event_loop()
+	port = int(sys.argv[1]) if len(sys.argv) > 1 else 3333
+	server = loop.run_until_complete(asyncio.start_server(simulator, '0.0.0.0', port))
+	log.info('simulated smoothie on port %d', port)
+	try:
+		loop.run_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.close()
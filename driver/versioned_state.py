@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import copy
+
+
+
+class FrozenDict(dict):
+	"""
+	A dict that refuses to be changed, so one instance can be handed to every reader
+
+	It is still a dict, so it serializes (json etc.) like one.
+	"""
+
+	def _immutable(self, *args, **kwargs):
+		raise TypeError('FrozenDict is immutable')
+
+	__setitem__ = _immutable
+	__delitem__ = _immutable
+	clear = _immutable
+	pop = _immutable
+	popitem = _immutable
+	setdefault = _immutable
+	update = _immutable
+
+	def __copy__(self):
+		return self
+
+	def __deepcopy__(self, memo):
+		return self
+
+	def __reduce__(self):
+		# pickle would otherwise fill the new instance with __setitem__
+		return (FrozenDict, (dict(self),))
+
+
+
+def freeze(value):
+	"""Returns an immutable copy of value: dicts become FrozenDicts and lists become tuples
+	"""
+	if isinstance(value, FrozenDict):
+		return value
+	if isinstance(value, dict):
+		return FrozenDict((key, freeze(val)) for key, val in value.items())
+	if isinstance(value, (list, tuple)):
+		return tuple(freeze(val) for val in value)
+	return value
+
+
+
+
+class VersionedState(object):
+	"""
+	A dict-like container that counts its changes
+
+	Every change increments version. snapshot() returns an immutable copy (with 'version'
+	added) that is only rebuilt after something changed, so readers share one object instead
+	of deep copying, and can ask changed_since(version) instead of comparing.
+
+	Reads return the stored values, so nested values must not be changed in place, use
+	state[key] = value or set_item(key, subkey, value) instead.
+	"""
+
+
+	def __init__(self, data):
+		self._data = copy.deepcopy(data)
+		self.version = 0
+		self._frozen = {}
+		self._snapshot = None
+
+
+	def __getitem__(self, key):
+		return self._data[key]
+
+
+	def __setitem__(self, key, value):
+		if key in self._data and type(self._data[key]) is type(value) and self._data[key] == value:
+			return
+		self._data[key] = value
+		self._changed(key)
+
+
+	def __contains__(self, key):
+		return key in self._data
+
+
+	def __iter__(self):
+		return iter(self._data)
+
+
+	def __len__(self):
+		return len(self._data)
+
+
+	def get(self, key, default=None):
+		return self._data.get(key, default)
+
+
+	def keys(self):
+		return self._data.keys()
+
+
+	def items(self):
+		return self._data.items()
+
+
+	def set_item(self, key, subkey, value):
+		"""state.set_item(key, subkey, value) is the versioned state[key][subkey] = value
+		"""
+		inner = self._data[key]
+		if subkey in inner and type(inner[subkey]) is type(value) and inner[subkey] == value:
+			return
+		inner[subkey] = value
+		self._changed(key)
+
+
+	def changed_since(self, version):
+		return self.version != version
+
+
+	def frozen(self, key):
+		"""Returns an immutable copy of state[key], rebuilt only after it changed
+		"""
+		try:
+			return self._frozen[key]
+		except KeyError:
+			self._frozen[key] = freeze(self._data[key])
+			return self._frozen[key]
+
+
+	def snapshot(self):
+		"""Returns an immutable copy of the whole state, plus 'version', rebuilt only after something changed
+		"""
+		if self._snapshot is None:
+			snapshot = {key:self.frozen(key) for key in self._data}
+			snapshot['version'] = self.version
+			self._snapshot = FrozenDict(snapshot)
+		return self._snapshot
+
+
+	def _changed(self, key):
+		self.version += 1
+		self._frozen.pop(key, None)
+		self._snapshot = None
+
@@ -1 +1,592 @@
-import unittest
\ No newline at end of file
+import unittest
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'driver'))
+
+import serializer
+from position_stream import PositionStream
+from versioned_state import FrozenDict, VersionedState, freeze
+import driver_worker
+from driver_worker import DriverWorker, WorkerDriver
+
+try:
+    import driver_client
+    from smoothie_driver import SmoothieDriver
+except ImportError:
+    # needs autobahn
+    driver_client = None
+
+
+class FakeConn():
+    """Records what a WorkerDriver sends its worker
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+
+class FakeSession():
+    """Records what a DriverClient publishes, in place of a WAMP session
+    """
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, url, payload):
+        self.published.append((url, payload))
+
+    def messages(self, url=None):
+        """Returns the {message: param} of every JSON payload published (to url)
+        """
+        return_list = []
+        for published_url, payload in self.published:
+            if url is None or published_url == url:
+                decoded = json.loads(payload)
+                for item in (decoded if isinstance(decoded, list) else [decoded]):
+                    return_list.append(item['data']['message'])
+        return return_list
+
+
+def worker_driver(loop, timeout=5.0):
+    """A WorkerDriver talking to a FakeConn instead of a worker process
+    """
+    driver = WorkerDriver.__new__(WorkerDriver)
+    driver.name = 'smoothie'
+    driver.timeout = timeout
+    driver.loop = loop
+    driver.callbacks_dict = {}
+    driver.meta_callbacks_dict = {'on_connect':None}
+    driver.call_ids = itertools.count()
+    driver.pending = {}
+    driver.conn = FakeConn()
+    return driver
+
+
+def client_with_session(**kwargs):
+    """A DriverClient that publishes to a FakeSession and knows the client 'client'
+    """
+    client = driver_client.DriverClient(**kwargs)
+    client.session_factory._myAppSession = FakeSession()
+    client.clients['client'] = 'com.opentrons.client'
+    return client
+
+
+class SerializerTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        value = {'a':[1, 2.5, 'b', None, True], 'c':{'d':'e'}}
+        self.assertEqual(serializer.loads(serializer.dumps(value)), value)
+        self.assertEqual(serializer.loads(serializer.dumps(value).encode()), value)
+
+    def test_envelope(self):
+        encoder = serializer.EnvelopeEncoder('driver-id')
+        encoded = encoder.encode('now', 'driver', 'client', 'session', 'smoothie', 'positions', {'X':1.0})
+        self.assertEqual(json.loads(encoded), {
+            'from':'driver-id', 'type':'driver', 'to':'client', 'sessionID':'session', 'time':'now',
+            'data':{'name':'smoothie', 'message':{'positions':{'X':1.0}}}})
+
+    def test_fragments_are_kept(self):
+        encoder = serializer.EnvelopeEncoder('driver-id')
+        first = encoder.encode('now', 'driver', 'client', 'session', 'smoothie', 'status', 'ok')
+        self.assertEqual(list(encoder.type_fragments), ['driver'])
+        self.assertEqual(list(encoder.name_fragments), ['smoothie'])
+        self.assertEqual(encoder.encode('now', 'driver', 'client', 'session', 'smoothie', 'status', 'ok'), first)
+        # unhashable values are encoded, just not kept
+        encoded = encoder.encode('now', 'driver', 'client', 'session', ['a'], 'status', 'ok')
+        self.assertEqual(json.loads(encoded)['data']['name'], ['a'])
+        self.assertEqual(len(encoder.name_fragments), 1)
+
+    def test_fragments_are_bounded(self):
+        encoder = serializer.EnvelopeEncoder('driver-id')
+        for name in range(encoder.max_fragments + 1):
+            encoder.encode('now', 'driver', 'client', 'session', str(name), 'status', 'ok')
+        self.assertLessEqual(len(encoder.name_fragments), encoder.max_fragments)
+
+    def test_pack_array(self):
+        self.assertEqual(serializer.pack_array([b'\x01', b'\x02']), b'\x92\x01\x02')
+        self.assertEqual(serializer.pack_array([b'\x01']*16), b'\xdc\x00\x10' + b'\x01'*16)
+
+
+class SharedBlockTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        state = VersionedState({
+            'connected':True, 'locked':False, 'queue_size':12, 'in_flight':3,
+            'smoothie_pos':{'X':1.5, 'Y':2.0}, 'adjusted_pos':{'X':2.0}})
+        state['queue_size'] = 13
+        shared = [0.0] * (len(driver_worker.SHARED_FIELDS) + 1)
+        driver_worker.write_shared(shared, state)
+        values = driver_worker.read_shared(shared)
+        self.assertEqual(values['version'], 1)
+        self.assertEqual((values['connected'], values['locked']), (True, False))
+        self.assertEqual((values['queue_size'], values['in_flight']), (13, 3))
+        self.assertEqual(values['smoothie_pos']['Y'], 2.0)
+        self.assertEqual(values['adjusted_pos']['Z'], 0.0)
+
+    def test_torn_write(self):
+        shared = [1.0] * (len(driver_worker.SHARED_FIELDS) + 1)
+        self.assertIsNone(driver_worker.read_shared(shared, attempts=3))
+
+
+class WorkerDriverTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.driver = worker_driver(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_reply_resolves_its_call(self):
+        first = self.driver._call('configs')
+        second = self.driver._call('commands')
+        self.assertEqual([message[:3] for message in self.driver.conn.sent], [('call', 0, 'configs'), ('call', 1, 'commands')])
+        self.driver._receive(('result', 1, True, 'commands'))
+        self.driver._receive(('result', 0, True, 'configs'))
+        self.assertEqual((first.result(), second.result()), ('configs', 'commands'))
+        self.assertEqual(self.driver.pending, {})
+
+    def test_failure_is_raised(self):
+        future = self.driver._call('set_config', 'x', 1)
+        self.driver._receive(('result', 0, False, ValueError('no such config')))
+        self.assertRaises(ValueError, future.result)
+
+    def test_one_way_calls_return_nothing(self):
+        self.assertIsNone(self.driver._call('connect', 'client', 'session', None, None))
+        self.assertEqual(self.driver.pending, {})
+
+    def test_late_reply_is_dropped(self):
+        self.driver.timeout = 0
+        future = self.driver._call('configs')
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertRaises(TimeoutError, future.result)
+        self.assertEqual(self.driver.pending, {})
+        self.driver._receive(('result', 0, True, 'configs'))
+        self.driver._receive(('result', 42, True, None))
+
+    def test_callbacks_and_meta_callbacks(self):
+        calls = []
+        def positions(name, from_, session_id, data):
+            calls.append(('positions', data))
+        def on_connect(from_, session_id):
+            calls.append(('on_connect', from_))
+        self.driver.callbacks_dict['positions'] = {'callback':positions, 'messages':['M114']}
+        self.driver.meta_callbacks_dict['on_connect'] = on_connect
+        self.driver._receive(('callback', 'M114', ('smoothie', 'client', 'session', {'X':1.0})))
+        self.driver._receive(('callback', 'M119', ('smoothie', 'client', 'session', {})))
+        self.driver._receive(('meta', 'on_connect', ('client', 'session')))
+        self.assertEqual(calls, [('positions', {'X':1.0}), ('on_connect', 'client')])
+
+    def test_closing_fails_pending_calls(self):
+        future = self.driver._call('flow', None)
+        self.driver._abandon_calls(EOFError('worker smoothie is gone'))
+        self.assertRaises(EOFError, future.result)
+
+
+@unittest.skipIf(driver_client is None, 'autobahn is not installed')
+class DriverWorkerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.driver = SmoothieDriver(simulate=True)
+        self.worker = DriverWorker(child_conn, [0.0] * (len(driver_worker.SHARED_FIELDS) + 1), self.driver, self.loop)
+        self.worker.sender.start()
+
+    def tearDown(self):
+        self.worker.outbox.put(None)
+        self.worker.sender.join(1)
+        self.worker.conn.close()
+        self.conn.close()
+        self.loop.close()
+
+    def receive(self):
+        self.assertTrue(self.conn.poll(1))
+        return self.conn.recv()
+
+    def test_replies_are_sent_in_order(self):
+        self.worker.handle(('call', 0, 'set_config', ('streaming', True)))
+        self.worker.handle(('call', 1, 'bogus', ()))
+        self.worker.handle(('call', 2, 'configs', ()))
+        self.assertEqual(self.receive()[:3], ('result', 0, True))
+        kind, call_id, ok, value = self.receive()
+        self.assertEqual((call_id, ok), (1, False))
+        self.assertIsInstance(value, ValueError)
+        self.assertTrue(self.receive()[3]['streaming'])
+
+    def test_callbacks_and_meta_callbacks_are_forwarded(self):
+        self.worker.handle(('call', 0, 'forward', (['M114'],)))
+        self.assertEqual(self.receive(), ('result', 0, True, ['M114']))
+        for callback in self.driver.callbacks_dict.values():
+            callback['callback']('smoothie', 'client', 'session', {'X':1.0})
+        self.driver.meta_callbacks_dict['on_connect']('client', 'session')
+        self.assertEqual(self.receive(), ('callback', 'M114', ('smoothie', 'client', 'session', {'X':1.0})))
+        self.assertEqual(self.receive(), ('meta', 'on_connect', ('client', 'session')))
+
+    def test_an_unpicklable_result_is_still_answered(self):
+        self.worker._send(('result', 0, True, lambda: None))
+        kind, call_id, ok, value = self.receive()
+        self.assertEqual((call_id, ok), (0, False))
+        self.assertIsInstance(value, TypeError)
+
+
+class PositionStreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.published = []
+        self.stream = PositionStream(lambda *args: self.published.append(args), max_rate=100.0, loop=self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def update(self, param, to='client', message='positions'):
+        self.stream.update('com.opentrons.client', to, 'session', 'driver', 'smoothie', message, param)
+
+    def params(self):
+        return [args[6] for args in self.published]
+
+    def test_first_update_goes_out_at_once(self):
+        self.update({'X':1.0})
+        self.assertEqual(self.params(), [{'X':1.0}])
+
+    def test_latest_value_wins_and_axes_merge(self):
+        self.update({'X':1.0, 'Y':0.0})
+        self.update({'X':2.0})
+        self.update({'X':3.0})
+        self.update({'Y':4.0})
+        self.assertEqual(self.params(), [{'X':1.0, 'Y':0.0}])
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+        # the resting position is published once its slot comes up
+        self.assertEqual(self.params(), [{'X':1.0, 'Y':0.0}, {'X':3.0, 'Y':4.0}])
+
+    def test_streams_are_per_client_and_message(self):
+        self.update({'X':1.0})
+        self.update({'X':1.0}, to='other')
+        self.update({'X':1.0}, message='adjusted_pos')
+        self.update({'X':2.0})
+        self.assertEqual(len(self.published), 3)
+
+    def test_flush(self):
+        self.update({'X':1.0})
+        self.update({'X':2.0})
+        self.stream.flush()
+        self.assertEqual(self.params(), [{'X':1.0}, {'X':2.0}])
+        self.assertEqual(self.stream.timers, {})
+
+    def test_rate_zero_publishes_everything(self):
+        self.stream.max_rate = 0
+        for x in range(3):
+            self.update({'X':float(x)})
+        self.assertEqual(self.params(), [{'X':0.0}, {'X':1.0}, {'X':2.0}])
+
+
+class VersionedStateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.state = VersionedState({'queue_size':0, 'pos':{'X':0.0, 'Y':0.0}})
+
+    def test_changes_count(self):
+        self.state['queue_size'] = 1
+        self.state.set_item('pos', 'X', 2.0)
+        self.assertEqual(self.state.version, 2)
+        self.assertTrue(self.state.changed_since(1))
+        self.assertFalse(self.state.changed_since(2))
+
+    def test_same_value_is_no_change(self):
+        self.state['queue_size'] = 0
+        self.state.set_item('pos', 'X', 0.0)
+        self.assertEqual(self.state.version, 0)
+        # a value of another type is a change, even if equal
+        self.state.set_item('pos', 'X', 0)
+        self.assertEqual(self.state.version, 1)
+
+    def test_snapshot_is_shared_until_changed(self):
+        snapshot = self.state.snapshot()
+        self.assertIs(self.state.snapshot(), snapshot)
+        self.assertEqual(snapshot['version'], 0)
+        self.state.set_item('pos', 'Y', 1.0)
+        changed = self.state.snapshot()
+        self.assertIsNot(changed, snapshot)
+        self.assertEqual(changed['pos'], {'X':0.0, 'Y':1.0})
+        self.assertEqual(snapshot['pos'], {'X':0.0, 'Y':0.0})
+        self.assertEqual(changed['version'], 1)
+
+    def test_frozen_is_rebuilt_per_key(self):
+        pos = self.state.frozen('pos')
+        self.state['queue_size'] = 5
+        self.assertIs(self.state.frozen('pos'), pos)
+        self.state.set_item('pos', 'X', 1.0)
+        self.assertIsNot(self.state.frozen('pos'), pos)
+
+    def test_snapshot_is_immutable(self):
+        snapshot = self.state.snapshot()
+        self.assertRaises(TypeError, snapshot.__setitem__, 'queue_size', 1)
+        self.assertRaises(TypeError, snapshot['pos'].update, {'X':1.0})
+
+
+class FrozenDictTests(unittest.TestCase):
+
+    def test_freeze(self):
+        frozen = freeze({'a':[1, {'b':2}]})
+        self.assertIsInstance(frozen, FrozenDict)
+        self.assertEqual(frozen['a'], (1, {'b':2}))
+        self.assertIsInstance(frozen['a'][1], FrozenDict)
+        self.assertIs(freeze(frozen), frozen)
+
+    def test_pickles(self):
+        frozen = freeze({'pos':{'X':1.0}, 'queue_size':3})
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(frozen, protocol))
+            self.assertIsInstance(copy, FrozenDict)
+            self.assertIsInstance(copy['pos'], FrozenDict)
+            self.assertEqual(copy, frozen)
+
+    def test_copies_are_itself(self):
+        import copy
+        frozen = freeze({'a':{'b':1}})
+        self.assertIs(copy.copy(frozen), frozen)
+        self.assertIs(copy.deepcopy(frozen), frozen)
+
+
+@unittest.skipIf(driver_client is None, 'autobahn is not installed')
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = client_with_session()
+        self.session = self.client.session_factory._myAppSession
+        self.driver = SmoothieDriver(simulate=True)
+        self.client.add_driver('client', 'session', 'smoothie', self.driver)
+        del self.session.published[:]
+
+    def tearDown(self):
+        self.loop.close()
+
+    def dispatch(self, type_, data):
+        self.client.dispatch_message(json.dumps({'type':type_, 'from':'client', 'sessionID':'session', 'data':data}))
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+        return self.session.messages('com.opentrons.client')
+
+    def test_batch_is_acknowledged_once(self):
+        messages = self.dispatch('commands', {'name':'smoothie', 'message':['relative', {'move':{'X':10}}, 'positions']})
+        self.assertEqual(messages, [{'commands':{'queued':3, 'queue_size':3, 'optimized':0}}])
+        self.assertEqual(len(self.driver.command_queue), 3)
+
+    def test_unknown_command_refuses_the_batch(self):
+        messages = self.dispatch('commands', {'name':'smoothie', 'message':[{'move':{'X':10}}, 'bogus']})
+        self.assertEqual(messages, [{'error':'unknown commands at indexes: [1]'}])
+        self.assertEqual(len(self.driver.command_queue), 0)
+
+    def test_full_queue_asks_to_retry_later(self):
+        self.driver.set_config('max_queue_size', 2)
+        messages = self.dispatch('commands', {'name':'smoothie', 'message':['positions'] * 3})
+        self.assertEqual(messages, [{'retry_later':{'queue_size':0, 'max_queue_size':2, 'refused':3}}])
+        self.assertEqual(len(self.driver.command_queue), 0)
+
+    def test_set_config(self):
+        self.loop.run_until_complete(self.client.meta_command('client', 'session', {'name':'smoothie', 'message':{'set_config':{'streaming':True}}}))
+        self.assertTrue(self.driver.config_dict['streaming'])
+        self.assertTrue(self.session.messages('com.opentrons.client')[-1]['configs']['streaming'])
+
+    def test_unknown_driver(self):
+        messages = self.dispatch('commands', {'name':'other', 'message':['positions']})
+        self.assertEqual(messages, [{'error':'name not in drivers'}])
+
+
+@unittest.skipIf(driver_client is None, 'autobahn is not installed')
+class OutboxTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = client_with_session(batch_window=0)
+        self.session = self.client.session_factory._myAppSession
+
+    def tearDown(self):
+        self.loop.close()
+
+    def publish(self, message, param):
+        self.client.publish('client', 'client', 'session', 'driver', 'smoothie', message, param)
+
+    def test_one_event_per_topic(self):
+        self.publish('positions', {'X':1.0})
+        self.publish('status', 'ok')
+        self.assertEqual(self.session.published, [])
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(len(self.session.published), 1)
+        self.assertEqual(self.session.messages(), [{'positions':{'X':1.0}}, {'status':'ok'}])
+
+    def test_a_bad_message_only_loses_itself(self):
+        self.publish('positions', {'X':1.0})
+        self.publish('bad', {'X':object()})
+        self.publish('status', 'ok')
+        self.client.flush_outbox()
+        self.assertEqual(self.session.messages(), [{'positions':{'X':1.0}}, {'status':'ok'}])
+
+    def test_a_batch_of_bad_messages_publishes_nothing(self):
+        self.publish('bad', {'X':object()})
+        self.client.flush_outbox()
+        self.assertEqual(self.session.published, [])
+
+
+@unittest.skipIf(driver_client is None, 'autobahn is not installed')
+class EncodingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = client_with_session()
+        self.session = self.client.session_factory._myAppSession
+
+    def tearDown(self):
+        self.loop.close()
+
+    def handshake(self, encoding):
+        self.client.handshake(json.dumps({'from':'client', 'data':{'message':{'encoding':encoding}}}))
+        return self.session.messages('com.opentrons.frontend')[-1]
+
+    def test_legacy_clients_stay_json(self):
+        self.client.handshake(json.dumps({'from':'client', 'data':{'message':{'shake':True}}}))
+        self.assertNotIn('client', self.client.client_encodings)
+        self.assertEqual(self.handshake('json'), {'encoding':'json'})
+        self.client.publish('client', 'client', 'session', 'driver', 'smoothie', 'status', 'ok')
+        self.assertEqual(self.session.messages('com.opentrons.client')[-1], {'status':'ok'})
+
+    @unittest.skipIf(serializer.msgpack is not None, 'msgpack is installed')
+    def test_msgpack_falls_back_to_json(self):
+        self.assertEqual(self.handshake('msgpack'), {'encoding':'json'})
+        self.assertNotIn('client', self.client.client_encodings)
+
+    @unittest.skipIf(serializer.msgpack is None, 'msgpack is not installed')
+    def test_msgpack(self):
+        self.assertEqual(self.handshake('msgpack'), {'encoding':'msgpack'})
+        self.client.publish('client', 'client', 'session', 'driver', 'smoothie', 'positions', {'X':1.0})
+        url, payload = self.session.published[-1]
+        self.assertEqual(url, 'com.opentrons.client')
+        self.assertEqual(serializer.unpackb(payload)['data'], {'name':'smoothie', 'message':{'positions':{'X':1.0}}})
+        # the frontend topic stays JSON
+        self.client.publish('frontend', 'client', 'session', 'driver', 'smoothie', 'status', 'ok')
+        self.assertEqual(self.session.messages('com.opentrons.frontend')[-1], {'status':'ok'})
+        self.assertEqual(self.handshake('json'), {'encoding':'json'})
+
+
+@unittest.skipIf(driver_client is None, 'autobahn is not installed')
+class SuperviseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = driver_client.DriverClient()
+        self.closed = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def crossbar(self, on_connected):
+        """Makes the client's connection attempts succeed, calling on_connected(transport)
+        """
+        @asyncio.coroutine
+        def create_connection(factory, host, port):
+            yield from asyncio.sleep(0)
+            transport = FakeConn()
+            transport.close = lambda: self.closed.append(transport)
+            self.loop.call_soon(on_connected, transport)
+            return (transport, None)
+        self.loop.create_connection = create_connection
+
+    def supervise(self, join_timeout=10):
+        started = self.loop.time()
+        self.loop.run_until_complete(asyncio.wait_for(self.client.supervise(keep_trying=False, join_timeout=join_timeout), 5))
+        return self.loop.time() - started
+
+    def test_disconnect_before_join(self):
+        self.crossbar(lambda transport: self.client._on_disconnect())
+        self.assertLess(self.supervise(), 1)
+        self.assertEqual(self.closed, [])
+
+    def test_join_then_disconnect(self):
+        def on_connected(transport):
+            self.client._on_join()
+            self.loop.call_soon(self.client._on_disconnect)
+        self.crossbar(on_connected)
+        self.assertLess(self.supervise(), 1)
+        self.assertEqual(self.closed, [])
+
+    def test_join_timeout(self):
+        self.crossbar(lambda transport: None)
+        self.supervise(join_timeout=0.01)
+        self.assertEqual(len(self.closed), 1)
+
+
+@unittest.skipIf(driver_client is None, 'autobahn is not installed')
+class JobPathTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.directory = os.path.realpath(tempfile.mkdtemp())
+        self.jobs = os.path.join(self.directory, 'jobs')
+        os.mkdir(self.jobs)
+        self.client = driver_client.DriverClient(job_dir=self.jobs)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+        self.loop.close()
+
+    def test_paths_in_the_job_directory(self):
+        self.assertEqual(self.client.job_path('a.gcode'), os.path.join(self.jobs, 'a.gcode'))
+        self.assertEqual(self.client.job_path('sub/../b.gcode'), os.path.join(self.jobs, 'b.gcode'))
+        self.assertEqual(self.client.job_path(os.path.join(self.jobs, 'c.gcode')), os.path.join(self.jobs, 'c.gcode'))
+
+    def test_paths_outside_are_refused(self):
+        os.symlink(self.directory, os.path.join(self.jobs, 'up'))
+        for path in ('../secret', '/etc/passwd', 'up/secret', self.jobs, self.jobs + 'x/a.gcode', None):
+            self.assertRaises(ValueError, self.client.job_path, path)
+
+    def meta_command(self, client, param):
+        self.loop.run_until_complete(client.meta_command('client', 'session', {'name':'smoothie', 'message':{'run_file':param}}))
+        return client.session_factory._myAppSession.messages('com.opentrons.client')
+
+    def test_run_file(self):
+        with open(os.path.join(self.jobs, 'a.gcode'), 'wb') as job:
+            job.write(b'G0 X1\nG0 X2\n')
+        client = client_with_session(job_dir=self.jobs)
+        driver = SmoothieDriver(simulate=True)
+        client.add_driver('client', 'session', 'smoothie', driver)
+        messages = self.meta_command(client, 'a.gcode')
+        self.assertEqual(messages[-1]['run_file']['name'], os.path.join(self.jobs, 'a.gcode'))
+        self.loop.run_until_complete(driver.stream_task)
+        # not connected, so the lines wait in the queue
+        self.assertEqual(len(driver.command_queue), 2)
+        self.assertTrue(driver.state_dict['stream']['done'])
+
+    def test_refusal_is_published(self):
+        client = client_with_session(job_dir=self.jobs)
+        client.add_driver('client', 'session', 'smoothie', SmoothieDriver(simulate=True))
+        messages = self.meta_command(client, '../../etc/passwd')
+        self.assertEqual(list(messages[-1]), ['error'])
+        self.assertIn('job directory', messages[-1]['error'])
+
+    def test_no_job_directory(self):
+        self.client.job_dir = None
+        self.assertRaises(ValueError, self.client.job_path, 'a.gcode')
+
+
+if __name__ == '__main__':
+    unittest.main()
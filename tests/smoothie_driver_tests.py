@@ -1 +1,1052 @@
 import unittest
+import asyncio
+from collections import deque
+import io
+import os
+import socket
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'driver'))
+
+import backlash
+from backoff import Backoff
+from command_queue import CommandQueue, QueueFull
+from gcode_encoder import GCodeEncoder
+from line_framer import LineFramer
+import loopback
+from motion_optimizer import MotionOptimizer
+from precompiler import Precompiler
+from scheduler import LineScheduler
+from smoothie_driver import Output, SmoothieDriver
+from smoothie_simulator import SimulatedSmoothie
+
+
+
+class FakeTransport(object):
+	"""Collects what the driver writes, in place of a device connection
+	"""
+
+	def __init__(self):
+		self.written = []
+
+	def write(self, data):
+		self.written.append(data)
+
+	def close(self):
+		pass
+
+	def pause_reading(self):
+		self.written.append('paused')
+
+	def resume_reading(self):
+		self.written.append('resumed')
+
+
+class FakeSource(object):
+	"""A connection for the LineScheduler, recording the lines it handles
+	"""
+
+	def __init__(self, name, handled):
+		self.name = name
+		self.handled = handled
+		self.pending = deque()
+		self.transport = FakeTransport()
+		self.paused = False
+
+	def handle_line(self, line):
+		if line == 'bad':
+			raise ValueError(line)
+		self.handled.append((self.name, line))
+
+
+
+class LineFramerTests(unittest.TestCase):
+
+	def test_whole_lines(self):
+		framer = LineFramer()
+		self.assertEqual(framer.feed(b'ok\nok C: X:1\n'), [b'ok\n', b'ok C: X:1\n'])
+		self.assertEqual(len(framer.buffer), 0)
+
+	def test_fragments(self):
+		framer = LineFramer()
+		self.assertEqual(framer.feed(b'o'), [])
+		self.assertEqual(framer.feed(b'k'), [])
+		self.assertEqual(framer.feed(b'\nX:1'), [b'ok\n'])
+		self.assertEqual(framer.feed(b'0\n\n'), [b'X:10\n', b'\n'])
+
+	def test_delimiter_split_across_fragments(self):
+		framer = LineFramer(b'\r\n')
+		self.assertEqual(framer.feed(b'ok\r'), [])
+		self.assertEqual(framer.feed(b'\nok\r\n'), [b'ok\r\n', b'ok\r\n'])
+
+	def test_overflow_drops_the_whole_line(self):
+		framer = LineFramer(max_buffer=16)
+		self.assertEqual(framer.feed(b'A'*20), [])
+		self.assertEqual(framer.overflows, 1)
+		self.assertEqual(framer.feed(b'AA'), [])
+		self.assertEqual(framer.feed(b'BB\nok\n'), [b'ok\n'])
+		self.assertEqual(framer.feed(b'ok\n'), [b'ok\n'])
+
+	def test_overflow_with_split_delimiter(self):
+		framer = LineFramer(b'\r\n', max_buffer=4)
+		self.assertEqual(framer.feed(b'ABCDEFG\r'), [])
+		self.assertEqual(framer.feed(b'\nok\r\n'), [b'ok\r\n'])
+
+	def test_clear(self):
+		framer = LineFramer(max_buffer=4)
+		framer.feed(b'ABCDEF')
+		framer.clear()
+		self.assertEqual(framer.feed(b'ok\n'), [b'ok\n'])
+
+	def test_set_delimiter(self):
+		framer = LineFramer()
+		self.assertEqual(framer.feed(b'ok\rok'), [])
+		self.assertEqual(framer.set_delimiter(b'\r'), [b'ok\r'])
+		self.assertEqual(framer.feed(b'\r'), [b'ok\r'])
+
+	def test_classify(self):
+		framer = LineFramer()
+		framer.kinds[b'ok\n'] = 'ack'
+		self.assertEqual(framer.classify(b'ok\n'), 'ack')
+		self.assertIsNone(framer.classify(b'ok C:\n'))
+
+
+
+class CommandQueueTests(unittest.TestCase):
+
+	def test_lanes_drain_in_priority_order(self):
+		queue = CommandQueue()
+		queue.append({'id':1}, 'normal')
+		queue.append({'id':2}, 'interactive')
+		queue.append({'id':3}, 'normal')
+		queue.append({'id':4}, 'emergency')
+		self.assertEqual(len(queue), 4)
+		self.assertEqual(queue.sizes(), {'emergency':1, 'interactive':1, 'normal':2})
+		self.assertEqual(queue.peek(), {'id':4})
+		self.assertEqual([queue.popleft()['id'] for i in range(4)], [4, 2, 1, 3])
+		self.assertIsNone(queue.peek())
+		self.assertRaises(IndexError, queue.popleft)
+
+	def test_unknown_lane(self):
+		self.assertRaises(ValueError, CommandQueue().append, {}, 'urgent')
+
+	def test_room_and_check(self):
+		queue = CommandQueue(max_size=3)
+		self.assertEqual(queue.room(), 3)
+		queue.append({})
+		queue.append({})
+		queue.check(1)
+		with self.assertRaises(QueueFull) as raised:
+			queue.check(2)
+		self.assertEqual((raised.exception.size, raised.exception.max_size, raised.exception.count), (2, 3, 2))
+		self.assertIsNone(CommandQueue().room())
+		CommandQueue().check(1000000)
+
+	def test_append_and_requeue_ignore_max_size(self):
+		queue = CommandQueue(max_size=1)
+		queue.append({})
+		queue.append({})
+		queue.requeue([{}])
+		self.assertEqual(len(queue), 3)
+		self.assertEqual(queue.room(), 0)
+
+	def test_queue_full_pickles(self):
+		import pickle
+		error = pickle.loads(pickle.dumps(QueueFull(5, 10, 7)))
+		self.assertEqual((error.size, error.max_size, error.count), (5, 10, 7))
+
+	def test_requeue_goes_ahead_in_order(self):
+		queue = CommandQueue()
+		queue.append({'id':3})
+		queue.requeue([{'id':1}, {'id':2, 'lane':'normal'}, {'id':0, 'lane':'interactive'}])
+		self.assertEqual([queue.popleft()['id'] for i in range(4)], [0, 1, 2, 3])
+
+
+
+
+
+class MotionOptimizerTests(unittest.TestCase):
+
+	def setUp(self):
+		self.optimizer = MotionOptimizer(b'\r\n')
+
+	def test_merges_moves_along_the_same_line(self):
+		self.assertEqual(self.optimizer.optimize(b'G91 G0 X2 Y2\r\n', b'G91 G0 X1 Y1\r\n'), b'G91 G0 X3 Y3\r\n')
+		self.assertEqual(self.optimizer.optimize(b'G91 G0 X0.25\r\n', b'G91 G0 X0.5\r\n'), b'G91 G0 X0.75\r\n')
+		self.assertEqual(self.optimizer.eliminated, 2)
+
+	def test_keeps_corners_and_reversals(self):
+		self.assertIsNone(self.optimizer.optimize(b'G91 G0 Y1\r\n', b'G91 G0 X1\r\n'))
+		self.assertIsNone(self.optimizer.optimize(b'G91 G0 X-1\r\n', b'G91 G0 X1\r\n'))
+		self.assertIsNone(self.optimizer.optimize(b'G91 G0 X2 Y1\r\n', b'G91 G0 X1 Y1\r\n'))
+
+	def test_keeps_other_moves(self):
+		# absolute moves, different codes, feed rates on the move
+		self.assertIsNone(self.optimizer.optimize(b'G90 G0 X2\r\n', b'G90 G0 X1\r\n'))
+		self.assertIsNone(self.optimizer.optimize(b'G91 G1 X2\r\n', b'G91 G0 X1\r\n'))
+		self.assertIsNone(self.optimizer.optimize(b'G91 G0 X2 F100\r\n', b'G91 G0 X1\r\n'))
+		self.assertIsNone(self.optimizer.optimize(b'G91 G0 X2\r\n', None))
+
+	def test_drops_repeated_modes(self):
+		self.assertIsNone(self.optimizer.optimize(b'G91\r\n'))
+		self.assertEqual(self.optimizer.optimize(b'G91\r\n'), b'')
+		self.assertIsNone(self.optimizer.optimize(b'G90\r\n'))
+		self.assertIsNone(self.optimizer.optimize(b'G91 G0 X1\r\n'))
+		self.assertEqual(self.optimizer.optimize(b'G91\r\n'), b'')
+
+	def test_drops_repeated_modal_lines(self):
+		self.assertIsNone(self.optimizer.optimize(b'M198 S3000\r\n'))
+		self.assertEqual(self.optimizer.optimize(b'M198 S3000\r\n'), b'')
+		self.assertIsNone(self.optimizer.optimize(b'M198 S2000\r\n'))
+		self.assertIsNone(self.optimizer.optimize(b'F S100\r\n'))
+		self.assertEqual(self.optimizer.optimize(b'F S100\r\n'), b'')
+		# a feed rate on a move changes what is in effect
+		self.assertIsNone(self.optimizer.optimize(b'G1 X1 F200\r\n'))
+		self.assertIsNone(self.optimizer.optimize(b'F S100\r\n'))
+
+	def test_reset_forgets(self):
+		self.optimizer.optimize(b'G91\r\n')
+		self.optimizer.reset()
+		self.assertIsNone(self.optimizer.optimize(b'G91\r\n'))
+
+	def test_unreadable_lines_reset(self):
+		self.optimizer.optimize(b'G91\r\n')
+		self.assertIsNone(self.optimizer.optimize(b'G91 G0 Xabc\r\n'))
+		self.assertIsNone(self.optimizer.optimize(b'G91\r\n'))
+
+
+
+class BacklashTests(unittest.TestCase):
+
+	axes = ['X', 'Y', 'Z', 'A', 'B', 'C']
+	slack = {'X':0.5, 'Y':0.5, 'Z':0.0, 'A':0.1, 'B':0.1, 'C':0.0}
+
+	# what SmoothieDriver._compensate gave for these moves, one command at a time
+	moves = [{'X':1}, {'X':2}, {'X':-1}, {'X':5, 'Y':3}, {'X':5}, {'X':4}, {'Y':-1, 'Z':2}]
+	relative = [True, True, True, False, False, False, True]
+	compensated = [{'X':1.5}, {'X':2}, {'X':-1.5}, {'X':5, 'Y':3}, {'X':5}, {'X':3.5}, {'Y':-1.5, 'Z':2}]
+
+	def test_python_pass(self):
+		moves, direction, position = backlash._compensate_python(self.moves, self.axes, self.slack, {}, {}, self.relative)
+		self.assertEqual(moves, self.compensated)
+		self.assertEqual(direction, {'X':0, 'Y':0, 'Z':1, 'A':0, 'B':0, 'C':0})
+		self.assertEqual(position, {'X':4, 'Y':2, 'Z':2, 'A':0.0, 'B':0.0, 'C':0.0})
+
+	def test_one_move_at_a_time(self):
+		direction = {}
+		position = {}
+		for move, relative, expected in zip(self.moves, self.relative, self.compensated):
+			moves, direction, position = backlash.compensate([move], self.axes, self.slack, direction, position, relative)
+			self.assertEqual(moves, [expected])
+
+	def test_uncompensated_axes_pass_through(self):
+		moves, direction, position = backlash.compensate([{'X':1, 'F':100}], ['X'], self.slack, {}, {})
+		self.assertEqual(moves, [{'X':1.5, 'F':100}])
+
+	@unittest.skipIf(backlash.numpy is None, 'numpy is not installed')
+	def test_numpy_pass_matches_python_pass(self):
+		import random
+		generator = random.Random(20)
+		moves = []
+		relative = []
+		for index in range(200):
+			axes = generator.sample(self.axes, generator.randint(1, 3))
+			moves.append({axis:generator.choice([0, generator.uniform(-20, 20), float(generator.randint(-5, 5))]) for axis in axes})
+			relative.append(generator.random() < 0.5)
+		moves.append({'X':1.0, 'F':100})
+		relative.append(True)
+		direction = {'X':1, 'A':1}
+		position = {'X':3.0, 'Z':-2.0}
+		expected = backlash._compensate_python(moves, self.axes, self.slack, direction, position, relative)
+		result = backlash._compensate_numpy(moves, self.axes, self.slack, direction, position, relative)
+		self.assertEqual(len(result[0]), len(expected[0]))
+		for move, expected_move in zip(result[0], expected[0]):
+			self.assertEqual(sorted(move), sorted(expected_move))
+			for axis in move:
+				self.assertAlmostEqual(move[axis], expected_move[axis], places=9)
+		self.assertEqual(result[1], expected[1])
+		for axis in self.axes:
+			self.assertAlmostEqual(result[2][axis], expected[2][axis], places=9)
+
+	def test_driver_builds_the_same_lines(self):
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		self.addCleanup(loop.close)
+		driver = SmoothieDriver(simulate=True)
+		data_list = []
+		for move, relative in zip(self.moves, self.relative):
+			data_list.append({('move' if relative else 'move_to'):move})
+		lines = [line for line, lane, extra in driver._build_commands(data_list)]
+		self.assertEqual(lines, [
+			b'G91 G0 X1.5\r\n', b'G91 G0 X2\r\n', b'G91 G0 X-1.5\r\n',
+			b'G90 G0 X5 Y3\r\n', b'G90 G0 X5\r\n', b'G90 G0 X3.5\r\n', b'G91 G0 Y-1.5 Z2\r\n'])
+
+
+
+class GCodeEncoderTests(unittest.TestCase):
+
+	commands_dict = {
+		'move':{'code':'G91 G0', 'parameters':['', 'X', 'Y']},
+		'rapid_linear_move':{'code':'G0', 'parameters':['X']},
+		'also_g0':{'code':'G0', 'parameters':[]},
+		'halt':{'code':'M112', 'parameters':[], 'lane':'emergency'}
+	}
+
+	def setUp(self):
+		self.encoder = GCodeEncoder(self.commands_dict, '\r\n', cache_size=2)
+
+	def test_lookup(self):
+		self.assertEqual(self.encoder.lookup('move'), 'move')
+		self.assertEqual(self.encoder.lookup('M112'), 'halt')
+		self.assertIn(self.encoder.lookup('G0'), ('rapid_linear_move', 'also_g0'))
+		self.assertIsNone(self.encoder.lookup('G28'))
+		self.assertEqual(self.encoder.lanes['halt'], 'emergency')
+		self.assertEqual(self.encoder.lanes['move'], 'normal')
+		self.assertEqual(self.encoder.parameters['move'], frozenset(['', 'X', 'Y']))
+
+	def test_encode(self):
+		self.assertEqual(self.encoder.encode('halt'), b'M112\r\n')
+		self.assertEqual(self.encoder.encode('move', (('X', 1), ('Y', -2.5))), b'G91 G0 X1 Y-2.5\r\n')
+
+	def test_cache_is_lru(self):
+		first = self.encoder.encode('move', (('X', 1),))
+		self.assertIs(self.encoder.encode('move', (('X', 1),)), first)
+		self.encoder.encode('move', (('X', 2),))
+		self.encoder.encode('move', (('X', 1),))
+		self.encoder.encode('move', (('X', 3),))
+		self.assertEqual([key[1] for key in self.encoder.cache], [(('X', 1),), (('X', 3),)])
+
+	def test_unhashable_values_are_not_cached(self):
+		self.assertEqual(self.encoder.encode('move', (('X', [1]),)), b'G91 G0 X[1]\r\n')
+		self.assertEqual(len(self.encoder.cache), 0)
+
+	def test_compile_again(self):
+		self.encoder.encode('halt')
+		self.encoder.compile(dict(self.commands_dict, halt={'code':'M112', 'parameters':[]}), '\n')
+		self.assertEqual(self.encoder.encode('halt'), b'M112\n')
+		self.assertEqual(self.encoder.lanes['halt'], 'normal')
+
+
+
+class PrecompilerTests(unittest.TestCase):
+
+	key = 'ab' * 32
+
+	def setUp(self):
+		import tempfile
+		self.directory = tempfile.mkdtemp()
+		self.precompiler = Precompiler(os.path.join(self.directory, 'cache'))
+
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.directory)
+
+	def test_store_and_load(self):
+		self.precompiler.store(self.key, b'G0 X1\r\n', {'lines':1})
+		self.assertEqual(os.stat(self.precompiler.cache_dir).st_mode & 0o777, 0o700)
+		data, sidecar = self.precompiler.load(self.key)
+		self.assertEqual(data, b'G0 X1\r\n')
+		self.assertEqual(sidecar['lines'], 1)
+		self.assertIsNone(self.precompiler.load('cd' * 32))
+		self.assertRaises(ValueError, self.precompiler.load, '../../etc/passwd')
+
+	def test_changed_artifact_is_ignored(self):
+		self.precompiler.store(self.key, b'G0 X1\r\n', {'lines':1})
+		gcode_path, sidecar_path = self.precompiler.paths(self.key)
+		with open(gcode_path, 'wb') as gcode_file:
+			gcode_file.write(b'G0 X9\r\n')
+		self.assertIsNone(self.precompiler.load(self.key))
+
+	def test_shared_directory_is_refused(self):
+		os.makedirs(self.precompiler.cache_dir)
+		os.chmod(self.precompiler.cache_dir, 0o777)
+		self.assertRaises(PermissionError, self.precompiler.store, self.key, b'G0 X1\r\n', {})
+		self.assertIsNone(self.precompiler.load(self.key))
+
+	def test_default_directory_is_per_user(self):
+		environ = dict(os.environ)
+		self.addCleanup(os.environ.update, environ)
+		os.environ.pop('DRIVER_CACHE_DIR', None)
+		os.environ['XDG_CACHE_HOME'] = self.directory
+		self.assertEqual(Precompiler().cache_dir, os.path.join(self.directory, 'sandbox-driver'))
+
+
+
+class LineSchedulerTests(unittest.TestCase):
+
+	def setUp(self):
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		self.scheduler = LineScheduler(quantum=2, max_pending=3)
+		self.handled = []
+		self.a = FakeSource('a', self.handled)
+		self.b = FakeSource('b', self.handled)
+
+	def tearDown(self):
+		self.loop.close()
+
+	def run_once(self):
+		"""Runs one event loop iteration
+		"""
+		self.loop.call_soon(self.loop.stop)
+		self.loop.run_forever()
+
+	def test_quantum_is_handled_at_once(self):
+		self.scheduler.deliver(self.a, ['1', '2'])
+		self.assertEqual(self.handled, [('a', '1'), ('a', '2')])
+		self.assertIsNone(self.scheduler.handle)
+
+	def test_backlogs_are_served_round_robin(self):
+		self.scheduler.deliver(self.a, ['1', '2', '3', '4', '5'])
+		self.scheduler.deliver(self.b, ['1', '2'])
+		self.assertEqual(self.handled, [('a', '1'), ('a', '2')])
+		self.run_once()
+		self.assertEqual(self.handled[2:], [('a', '3'), ('a', '4'), ('b', '1'), ('b', '2')])
+		self.run_once()
+		self.assertEqual(self.handled[6:], [('a', '5')])
+		self.assertEqual(len(self.scheduler.ready), 0)
+
+	def test_a_long_backlog_pauses_reading(self):
+		self.scheduler.deliver(self.a, [str(index) for index in range(6)])
+		self.assertTrue(self.a.paused)
+		self.assertEqual(self.a.transport.written, ['paused'])
+		self.run_once()
+		self.run_once()
+		self.assertFalse(self.a.paused)
+		self.assertEqual(self.a.transport.written, ['paused', 'resumed'])
+		self.assertEqual(len(self.handled), 6)
+
+	def test_drain(self):
+		self.scheduler.deliver(self.a, [str(index) for index in range(6)])
+		self.scheduler.drain(self.a)
+		self.assertEqual(len(self.handled), 6)
+		self.assertFalse(self.a.paused)
+		self.assertEqual(len(self.scheduler.ready), 0)
+
+	def test_a_bad_line_is_skipped(self):
+		self.scheduler.deliver(self.a, ['bad', '1'])
+		self.assertEqual(self.handled, [('a', '1')])
+
+
+
+class RecordingProtocol(asyncio.Protocol):
+	"""Records what a transport hands its protocol
+	"""
+
+	def __init__(self):
+		self.events = []
+
+	def connection_made(self, transport):
+		self.transport = transport
+		self.events.append('made')
+
+	def data_received(self, data):
+		self.events.append(data)
+
+	def eof_received(self):
+		self.events.append('eof')
+
+	def connection_lost(self, exc):
+		self.events.append('lost')
+
+
+
+class LoopbackTests(unittest.TestCase):
+
+	def setUp(self):
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		self.a = RecordingProtocol()
+		self.b = RecordingProtocol()
+		self.a_transport, self.b_transport = loopback.transport_pair(self.loop, self.a, self.b)
+
+	def tearDown(self):
+		self.loop.close()
+
+	def run_once(self):
+		self.loop.call_soon(self.loop.stop)
+		self.loop.run_forever()
+
+	def test_writes_are_delivered_together_later(self):
+		self.a_transport.write(b'G0 ')
+		self.a_transport.write(b'X1\n')
+		self.a_transport.write(b'')
+		self.assertEqual(self.b.events, [])
+		self.run_once()
+		self.assertEqual(self.b.events, [b'G0 X1\n'])
+		self.assertEqual(self.a.events, [])
+
+	def test_pause_reading_holds_delivery(self):
+		self.b_transport.pause_reading()
+		self.a_transport.write(b'ok\r\n')
+		self.run_once()
+		self.assertEqual(self.b.events, [])
+		self.b_transport.resume_reading()
+		self.run_once()
+		self.assertEqual(self.b.events, [b'ok\r\n'])
+
+	def test_close_after_data(self):
+		self.a_transport.write(b'M114\n')
+		self.a_transport.close()
+		self.assertTrue(self.a_transport.is_closing())
+		self.a_transport.write(b'lost\n')
+		self.run_once()
+		self.run_once()
+		self.assertEqual(self.a.events, ['lost'])
+		# the peer gets the data still on its way, then eof, and closes its end too
+		self.assertEqual(self.b.events, [b'M114\n', 'eof', 'lost'])
+
+	def test_create_connection(self):
+		@asyncio.coroutine
+		def echo(reader, writer):
+			line = yield from reader.readline()
+			writer.write(b'echo '+line)
+		transport, protocol = loopback.create_connection(RecordingProtocol, echo)
+		self.assertEqual(protocol.events, ['made'])
+		transport.write(b'hello\n')
+		self.loop.run_until_complete(asyncio.sleep(0.01))
+		self.assertEqual(protocol.events, ['made', b'echo hello\n'])
+		transport.close()
+		self.loop.run_until_complete(asyncio.sleep(0.01))
+
+
+
+class SimulatedSmoothieTests(unittest.TestCase):
+
+	def setUp(self):
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		self.device = SimulatedSmoothie(rx_buffer_size=32, planner_size=2, time_scale=100.0, loop=self.loop)
+		self.device.writer = FakeTransport()
+
+	def tearDown(self):
+		if self.device.block_handle is not None:
+			self.device.block_handle.cancel()
+		self.loop.close()
+
+	def replies(self):
+		return b''.join(self.device.writer.written).split(b'\r\n')[:-1]
+
+	def test_rx_buffer_and_planner_hold_lines_back(self):
+		self.device._receive(b'G91 G0 X1\n' * 10)
+		self.assertEqual(self.replies(), [b'ok', b'ok'])
+		stats = self.device.stats()
+		self.assertEqual((stats['planner'], stats['rx'], stats['incoming']), (2, 30, 50))
+
+	def test_m112_goes_ahead(self):
+		self.device._receive(b'G91 G0 X1\n' * 10)
+		self.device._receive(b'M1')
+		self.assertFalse(self.device.halted)
+		self.device._receive(b'12\n')
+		self.assertTrue(self.device.halted)
+		self.assertEqual(self.device.stats()['planner'], 0)
+		replies = self.replies()
+		self.assertTrue(replies[2].startswith(b'ok Emergency Stop'))
+		# the lines received before it are refused
+		self.assertEqual(replies[3:], [b'!!'] * 8)
+		self.device._receive(b'M999\nM114\n')
+		self.assertFalse(self.device.halted)
+		self.assertEqual(self.replies()[-2], b'ok')
+
+	def test_feedback_reports_idle_after_every_line(self):
+		self.device.time_scale = 0
+		self.device._receive(b'M62\nM114\nG91 G0 X1\n')
+		self.assertEqual(self.replies(), [b'ok', b'{"stat":0}', b'ok C: X:0.0000 Y:0.0000 Z:0.0000 A:0.0000 B:0.0000 C:0.0000', b'{"stat":0}', b'ok'])
+		self.loop.run_until_complete(asyncio.sleep(0))
+		self.assertEqual(self.replies()[5:], [b'{"X": 1.0, "Y": 0.0, "Z": 0.0, "A": 0.0, "B": 0.0, "C": 0.0}', b'{"stat":0}'])
+		self.device._receive(b'M63\nM114\n')
+		self.assertEqual(self.replies()[7:], [b'ok', b'ok C: X:1.0000 Y:0.0000 Z:0.0000 A:0.0000 B:0.0000 C:0.0000'])
+
+	def test_long_line_is_dropped(self):
+		self.device._receive(b'G0 X1 ' + b'Y1 ' * 20 + b'\nM114\n')
+		self.assertEqual(self.device.stats()['overflows'], 1)
+		self.assertEqual(len(self.replies()), 1)
+		self.assertTrue(self.replies()[0].startswith(b'ok C: X:0.0000'))
+
+
+
+class SmoothieDriverTests(unittest.TestCase):
+
+	def setUp(self):
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		self.driver = SmoothieDriver(simulate=True)
+		self.transport = FakeTransport()
+		self.driver.smoothie_transport = self.transport
+		self.driver.state_dict['connected'] = True
+
+	def tearDown(self):
+		self.loop.close()
+
+	def test_streaming_window_credit(self):
+		self.driver.set_config('streaming', True)
+		self.driver.set_config('stream_max_lines', 4)
+		self.driver.set_config('stream_buffer_size', 48)
+		self.driver.send_commands('client', 'session', [{'move':{'X':index+1}} for index in range(10)])
+		# 'G91 G0 X1.5\r\n' (backlash compensated) is 13 bytes, the next ones 11: 4 lines fit in 48 bytes
+		self.assertEqual(len(self.transport.written), 4)
+		self.assertEqual(self.driver.state_dict['in_flight'], 4)
+		self.assertEqual(self.driver.state_dict['in_flight_bytes'], 46)
+		self.assertTrue(self.driver.state_dict['locked'])
+
+		self.driver._on_ack_received()
+		self.assertEqual(self.driver.state_dict['in_flight'], 3)
+		self.assertEqual(self.driver.state_dict['in_flight_bytes'], 33)
+		self.driver._step_command_queue()
+		self.assertEqual(len(self.transport.written), 5)
+		self.assertEqual(self.driver.state_dict['in_flight'], 4)
+
+		for index in range(20):
+			self.driver._on_ack_received()
+			self.driver._step_command_queue()
+		self.assertEqual(len(self.transport.written), 10)
+		self.assertEqual(self.driver.state_dict['in_flight'], 0)
+		self.assertEqual(self.driver.state_dict['in_flight_bytes'], 0)
+
+	def test_byte_limit(self):
+		self.driver.set_config('streaming', True)
+		self.driver.set_config('stream_max_lines', 8)
+		self.driver.set_config('stream_buffer_size', 30)
+		self.driver.send_commands('client', 'session', [{'move':{'X':index+1}} for index in range(5)])
+		# 13 + 11 bytes, a third line would take it to 35
+		self.assertEqual(self.driver.state_dict['in_flight'], 2)
+		self.assertEqual(self.driver.state_dict['in_flight_bytes'], 24)
+
+	def test_lockstep_waits_for_each_ok(self):
+		self.driver.send_commands('client', 'session', [{'move':{'X':1}}, {'move':{'X':2}}])
+		self.assertEqual(len(self.transport.written), 1)
+		self.assertTrue(self.driver.state_dict['locked'])
+		self.assertEqual(self.driver.state_dict['in_flight'], 0)
+		self.driver._on_ack_received()
+		self.driver._step_command_queue()
+		self.assertEqual(len(self.transport.written), 2)
+
+	def test_immediate_lines_take_no_credit(self):
+		self.driver.set_config('streaming', True)
+		self.driver.set_config('stream_max_lines', 2)
+		self.driver.send_commands('client', 'session', [{'move':{'X':index+1}} for index in range(4)])
+		self.assertEqual(self.driver.state_dict['in_flight'], 2)
+		self.driver.send_command('client', 'session', 'positions', 'emergency')
+		self.assertEqual(self.driver.state_dict['in_flight'], 2)
+		# the two moves' acknowledgements, then the immediate line's, which releases nothing
+		self.driver._on_ack_received()
+		self.driver._on_ack_received()
+		self.assertEqual(self.driver.state_dict['in_flight'], 0)
+		self.driver._step_command_queue()
+		self.assertEqual(self.driver.state_dict['in_flight'], 2)
+		self.driver._on_ack_received()
+		self.assertEqual(self.driver.state_dict['in_flight'], 2)
+
+	def test_halt_and_reset_clear_the_window(self):
+		self.driver.set_config('streaming', True)
+		self.driver.send_commands('client', 'session', [{'move':{'X':index+1}} for index in range(6)])
+		self.assertEqual(self.driver.state_dict['in_flight'], 6)
+		self.driver.send_command('client', 'session', 'halt')
+		self.driver.clear_queue()
+		self.driver.send_command('client', 'session', 'reset_from_halt')
+		self.assertEqual(self.driver.state_dict['in_flight'], 0)
+		self.assertEqual(self.driver.state_dict['in_flight_bytes'], 0)
+		self.assertFalse(self.driver.state_dict['locked'])
+
+	def test_lockstep_immediate_ok_keeps_the_lock(self):
+		self.driver.send_commands('client', 'session', [{'move':{'X':1}}, {'move':{'X':2}}])
+		self.assertEqual(len(self.transport.written), 1)
+		self.driver.send_command('client', 'session', 'positions', 'emergency')
+		self.driver._on_ack_received()
+		self.driver._step_command_queue()
+		self.assertEqual(len(self.transport.written), 3)
+		# the immediate line's 'ok' doesn't release the second move
+		self.driver._on_ack_received()
+		self.driver._step_command_queue()
+		self.assertIsNotNone(self.driver.awaiting_ack)
+		self.assertTrue(self.driver.state_dict['locked'])
+		self.driver._on_ack_received()
+		self.assertIsNone(self.driver.awaiting_ack)
+
+	def test_interactive_lane_goes_first(self):
+		self.driver.send_commands('client', 'session', [{'move':{'X':1}}, {'move':{'X':2}}, {'move':{'X':3}}])
+		self.driver.send_command('client', 'session', 'positions')
+		self.driver._on_ack_received()
+		self.driver._step_command_queue()
+		self.assertEqual(self.transport.written[1], b'M114\r\n')
+
+	def test_batch_is_queued_in_one_pass(self):
+		result = self.driver.send_commands('client', 'session', ['relative', {'move':{'X':1}}, {'G0':{'Y':2}}, 'positions'])
+		self.assertEqual(result, {'queued':4, 'queue_size':3, 'optimized':0})
+		self.assertEqual(self.transport.written, [b'M114\r\n'])
+		self.assertEqual([cmd['command'] for cmd in self.driver.command_queue.lanes['normal']],
+			[b'G91\r\n', b'G91 G0 X1.5\r\n', b'G0 Y2\r\n'])
+
+	def test_batch_is_all_or_nothing(self):
+		with self.assertRaises(ValueError) as raised:
+			self.driver.send_commands('client', 'session', [{'move':{'X':1}}, 'bogus', {'bogus':{}}])
+		self.assertIn('[1, 2]', str(raised.exception))
+		self.assertRaises(ValueError, self.driver.send_commands, 'client', 'session', 'positions')
+		self.assertEqual(len(self.driver.command_queue), 0)
+		self.assertEqual(self.transport.written, [])
+		self.assertEqual(self.driver.state_dict['direction']['X'], 0)
+
+	def test_encoder_follows_commands_and_message_ender(self):
+		self.driver.set_command('dwell', 'G4', ['P'])
+		self.driver.set_config('message_ender', '\n')
+		self.driver.send_commands('client', 'session', [{'dwell':{'P':100, 'Q':1}}])
+		self.assertEqual(self.transport.written, [b'G4 P100\n'])
+
+	def test_format_text_data(self):
+		format_text_data = self.driver._format_text_data
+		self.assertEqual(format_text_data('ok'), [{'ok':{}}])
+		self.assertEqual(format_text_data('ok C: X:10.0 Y:20.5 Z:0'), [{'ok':{}}, {'C':{'X':10.0, 'Y':20.5, 'Z':0.0}}])
+		self.assertEqual(format_text_data('X_min:1 Y_min:0'), [{'None':{'X_min':1.0, 'Y_min':0.0}}])
+		self.assertEqual(format_text_data('!! halted'), [{'!!':{}}, {'halted':{}}])
+		self.assertEqual(format_text_data('version: edge'), [{'version':{}}, {'edge':{}}])
+		self.assertEqual(format_text_data(''), [])
+
+	def test_text_reply_updates_positions(self):
+		self.driver._smoothie_data_handler(b'ok C: X:10.0 Y:-2 Z:0.5\r\n')
+		self.assertEqual(self.driver.state_dict['smoothie_pos']['X'], 10.0)
+		self.assertEqual(self.driver.state_dict['smoothie_pos']['Y'], -2.0)
+		# axes that haven't moved positive yet lag by the slack
+		self.assertEqual(self.driver.state_dict['adjusted_pos']['X'], 10.5)
+
+	def test_fast_lines(self):
+		fast_lines = self.driver.fast_lines
+		self.assertEqual(fast_lines[b'ok\r\n'], ('ack_received', 'ok', {}))
+		self.assertEqual(fast_lines[b'ok\n'], ('ack_received', 'ok', {}))
+		self.assertEqual(fast_lines[b'{"stat":0}\r\n'], ('ack_ready', 'None', {'stat':0}))
+		self.assertEqual(fast_lines[b'{"stat": 0}\n'], ('ack_ready', 'None', {'stat':0}))
+		self.driver.set_config('ack_ready_value', '1')
+		self.assertNotIn(b'{"stat":0}\n', fast_lines)
+		self.assertIn(b'{"stat":1}\n', fast_lines)
+
+	def test_bare_acknowledgements_skip_the_parser(self):
+		parsed = []
+		self.driver._smoothie_data_handler = parsed.append
+		output = Output(self.driver)
+		output.connection_made(self.transport)
+		self.driver.send_commands('client', 'session', [{'move':{'X':1}}])
+		# the position query's 'ok' releases the move
+		output.data_received(b'ok\r\n')
+		self.assertEqual(self.transport.written[-1], b'G91 G0 X1.5\r\n')
+		output.data_received(b'X_min:0\r\nok\r\n{"stat":0}\r\n')
+		self.assertEqual(parsed, [b'X_min:0\r\n'])
+		self.assertIsNone(self.driver.awaiting_ack)
+		self.assertTrue(self.driver.state_dict['ack_ready'])
+
+	def test_delimiter_reaches_the_connection(self):
+		self.driver.set_config('reconnect', False)
+		output = Output(self.driver)
+		output.connection_made(self.transport)
+		self.assertIsNotNone(self.driver.awaiting_ack)
+		output.data_received(b'ok C: X:1.5 Y:0')
+		self.driver.set_config('delimiter', '\r')
+		self.assertEqual(output.framer.delimiter, b'\r')
+		output.data_received(b'\rok\r')
+		self.assertEqual(self.driver.state_dict['smoothie_pos']['X'], 1.5)
+		self.assertIsNone(self.driver.awaiting_ack)
+		output.connection_lost(None)
+		self.assertIsNone(self.driver.smoothie_output)
+
+	def test_callbacks_are_indexed_by_message(self):
+		calls = []
+		def positions(name, from_, session_id, data):
+			calls.append(('positions', data))
+		def smoothie_pos(name, from_, session_id, data):
+			calls.append(('smoothie_pos', dict(data['pos'])))
+		def limits(name, from_, session_id, data):
+			calls.append(('limits', data))
+		self.driver.add_callback(positions, ['C'])
+		self.driver.add_callback(smoothie_pos, 'smoothie_pos')
+		self.driver.add_callback(limits, ['None'])
+		self.driver.add_callback(limits, ['M119'])
+		self.assertEqual(self.driver.callback_index['None'], [limits])
+		self.assertEqual(self.driver.callbacks()['limits'], ['None', 'M119'])
+
+		self.driver._smoothie_data_handler(b'ok C: X:2.0\r\n')
+		self.assertEqual(calls[0][0], 'smoothie_pos')
+		self.assertEqual(calls[0][1]['X'], 2.0)
+		self.assertEqual(calls[1], ('positions', {'X':2.0}))
+		self.assertEqual(len(calls), 2)
+
+		self.driver.remove_callback('positions')
+		self.assertNotIn('C', self.driver.callback_index)
+		del calls[:]
+		self.driver._smoothie_data_handler(b'X_min:1\r\n')
+		self.assertEqual(calls, [('limits', {'X_min':1.0})])
+
+	def test_flow_since_a_version(self):
+		flow = self.driver.flow()
+		self.assertIs(self.driver.flow(), flow)
+		self.assertEqual(self.driver.flow(flow['version']), {'version':flow['version']})
+		self.driver.send_command('client', 'session', 'positions')
+		changed = self.driver.flow(flow['version'])
+		self.assertGreater(changed['version'], flow['version'])
+		self.assertTrue(changed['locked'])
+		self.assertFalse(flow['locked'])
+
+	def test_backoff(self):
+		backoff = Backoff(initial=1.0, maximum=4.0, jitter=0)
+		self.assertEqual([backoff.next() for i in range(4)], [1.0, 2.0, 4.0, 4.0])
+		self.assertEqual(backoff.attempts, 4)
+		backoff.reset()
+		self.assertEqual(backoff.next(), 1.0)
+		backoff = Backoff(initial=1.0, jitter=0.5)
+		self.assertTrue(0.5 <= backoff.next() <= 1.0)
+
+	def test_reconnect_resumes_from_the_last_acknowledged_line(self):
+		self.driver.set_config('reconnect', False)
+		self.driver.set_config('streaming', True)
+		self.driver.set_config('stream_max_lines', 2)
+		self.driver.send_commands('client', 'session', [{'move':{'X':index+1}} for index in range(4)])
+		self.assertEqual(len(self.transport.written), 2)
+		self.driver._on_ack_received()
+		self.driver._step_command_queue()
+		self.assertEqual(len(self.transport.written), 3)
+		unacknowledged = self.transport.written[1:]
+
+		self.driver.smoothie_transport = None
+		self.driver._on_connection_lost()
+		self.assertFalse(self.driver.state_dict['connected'])
+		self.assertEqual(self.driver.state_dict['in_flight'], 0)
+		self.assertEqual(len(self.driver.command_queue), 3)
+
+		self.transport = FakeTransport()
+		self.driver.smoothie_transport = self.transport
+		self.driver._on_connection_made()
+		self.assertTrue(self.driver.state_dict['connected'])
+		# where the axes are is asked first, then the unacknowledged lines are sent again
+		self.assertEqual(self.transport.written[0], b'M114\r\n')
+		self.assertEqual(self.transport.written[1:], unacknowledged[:1])
+		self.driver._on_ack_received()
+		self.driver._step_command_queue()
+		self.assertEqual(self.transport.written[1:], unacknowledged)
+		self.assertEqual(len(self.driver.command_queue), 1)
+
+	def test_endpoints_are_per_driver(self):
+		other = SmoothieDriver(simulate=False)
+		other.set_config('reconnect', False)
+		other.link_task = asyncio.Future()
+		other.connect('client', 'session', '10.0.0.2', '3335')
+		self.assertEqual((other.host, other.port), ('10.0.0.2', 3335))
+		self.assertIsNone(self.driver.host)
+		self.assertFalse(self.loop.is_running())
+
+	def test_optimizer_merges_queued_moves(self):
+		self.driver.set_config('optimize', True)
+		result = self.driver.send_commands('client', 'session', [{'move':{'X':1}}, {'move':{'X':1}}, {'move':{'X':1}}, {'move':{'Y':1}}])
+		# a batch is queued whole before anything is sent, so the three X moves go out as one
+		self.assertEqual(result, {'queued':4, 'queue_size':1, 'optimized':2})
+		self.assertEqual(self.transport.written, [b'G91 G0 X3.5\r\n'])
+		self.assertEqual(self.driver.command_queue.popleft()['command'], b'G91 G0 Y1.5\r\n')
+		self.assertEqual(self.driver.state_dict['optimized_lines'], 2)
+
+	def acknowledge(self, count):
+		for index in range(count):
+			self.driver._on_ack_received()
+			self.driver._step_command_queue()
+
+	def test_jog_is_compensated_from_the_lines_sent(self):
+		self.driver.send_commands('client', 'session', [{'move':{'X':1}}, {'move':{'X':1}}])
+		self.assertEqual(self.transport.written, [b'G91 G0 X1.5\r\n'])
+		# the jog goes ahead of the queued X1, straight after the X1.5 that was sent
+		self.driver.send_command('client', 'session', {'move':{'X':-1}}, 'interactive')
+		self.acknowledge(2)
+		self.assertEqual(self.transport.written, [b'G91 G0 X1.5\r\n', b'G91 G0 X-1.5\r\n', b'G91 G0 X1.5\r\n'])
+		self.assertEqual(self.driver.state_dict['direction']['X'], 1)
+		self.assertEqual(self.driver.planned_pos['X'], 1.0)
+
+	def test_jog_into_merged_moves(self):
+		self.driver.set_config('optimize', True)
+		self.driver.send_commands('client', 'session', [{'move':{'X':1}}, {'move':{'X':-1}}, {'move':{'X':-1}}])
+		self.driver.send_command('client', 'session', {'move':{'X':-1}}, 'interactive')
+		self.acknowledge(2)
+		self.assertEqual(self.transport.written, [b'G91 G0 X1.5\r\n', b'G91 G0 X-1.5\r\n', b'G91 G0 X-2\r\n'])
+		self.assertEqual(self.driver.planned_pos['X'], -2.0)
+
+	def test_clear_queue_plans_from_the_lines_sent(self):
+		self.driver.send_commands('client', 'session', [{'move':{'X':1}}, {'move':{'X':-1}}])
+		self.assertEqual(self.driver.state_dict['direction']['X'], 0)
+		self.driver.clear_queue()
+		self.assertEqual(self.driver.state_dict['direction']['X'], 1)
+		self.assertEqual(self.driver.planned_pos['X'], 1.0)
+		self.driver.send_command('client', 'session', {'move':{'X':1}})
+		self.acknowledge(1)
+		self.assertEqual(self.transport.written, [b'G91 G0 X1.5\r\n', b'G91 G0 X1\r\n'])
+
+	def test_reconnect_plans_from_the_lines_acknowledged(self):
+		self.driver.set_config('reconnect', False)
+		self.driver.send_commands('client', 'session', [{'move':{'X':1}}, {'move':{'X':-1}}])
+		self.assertEqual(self.transport.written, [b'G91 G0 X1.5\r\n'])
+		self.driver.smoothie_transport = None
+		self.driver._on_connection_lost()
+		# the X1.5 was never acknowledged, so the axes are where they were before it
+		self.driver.clear_queue()
+		self.assertEqual(self.driver.state_dict['direction']['X'], 0)
+		self.assertEqual(self.driver.planned_pos['X'], 0.0)
+
+		self.transport = FakeTransport()
+		self.driver.smoothie_transport = self.transport
+		self.driver._on_connection_made()
+		self.acknowledge(1)
+		self.driver.send_command('client', 'session', {'move':{'X':1}})
+		self.assertEqual(self.transport.written, [b'M114\r\n', b'G91 G0 X1.5\r\n'])
+
+	def test_run_stream(self):
+		progress = []
+		self.driver.set_meta_callback('on_progress', lambda from_, session_id, stream: progress.append(stream))
+		self.driver.set_config('file_read_ahead', 2)
+		self.driver.set_config('file_chunk_size', 8)
+		data = b'G0 X1 ; go\n\n; nothing\nG0 X2\nG0 X3\nG0 X4'
+		self.driver.run_stream('client', 'session', io.BytesIO(data), 'job', len(data))
+		for index in range(20):
+			self.loop.run_until_complete(asyncio.sleep(0))
+			# no more than file_read_ahead lines are held
+			self.assertLessEqual(len(self.driver.command_queue.lanes['normal']), 2)
+			self.acknowledge(1)
+		self.assertEqual(self.transport.written, [b'G0 X1\r\n', b'G0 X2\r\n', b'G0 X3\r\n', b'G0 X4\r\n'])
+		stream = self.driver.state_dict['stream']
+		self.assertEqual((stream['read_lines'], stream['read_bytes']), (6, len(data)))
+		# line numbers and offsets point into the file: the last line sent is line 6, ending at its end
+		self.assertEqual((stream['sent_lines'], stream['sent_bytes']), (6, len(data)))
+		self.assertTrue(stream['done'])
+		self.assertFalse(stream['active'])
+		self.assertTrue(progress[-1]['done'])
+
+	def test_run_stream_from_a_stream_reader(self):
+		reader = asyncio.StreamReader()
+		self.driver.run_stream('client', 'session', reader)
+		reader.feed_data(b'G0 X1\nG0 ')
+		self.loop.run_until_complete(asyncio.sleep(0))
+		self.assertEqual(self.transport.written, [b'G0 X1\r\n'])
+		reader.feed_data(b'X2\n')
+		reader.feed_eof()
+		self.acknowledge(1)
+		self.loop.run_until_complete(self.driver.stream_task)
+		self.acknowledge(1)
+		self.assertEqual(self.transport.written, [b'G0 X1\r\n', b'G0 X2\r\n'])
+		self.assertTrue(self.driver.state_dict['stream']['done'])
+
+	def test_clear_queue_stops_the_stream(self):
+		self.driver.set_config('file_read_ahead', 1)
+		self.driver.run_stream('client', 'session', io.BytesIO(b'G0 X1\n' * 10))
+		self.loop.run_until_complete(asyncio.sleep(0))
+		self.assertRaises(ValueError, self.driver.run_stream, 'client', 'session', io.BytesIO(b''))
+		self.driver.clear_queue()
+		self.loop.run_until_complete(asyncio.sleep(0))
+		stream = self.driver.state_dict['stream']
+		self.assertEqual(stream['error'], 'cancelled')
+		self.assertFalse(stream['active'])
+		self.assertEqual(len(self.driver.command_queue), 0)
+
+	def test_queue_full(self):
+		self.driver.set_config('max_queue_size', 3)
+		self.driver.set_config('queue_high_watermark', 0)
+		self.assertRaises(QueueFull, self.driver.send_commands, 'client', 'session', [{'move':{'X':1}}] * 5)
+		self.assertEqual(len(self.transport.written), 0)
+		# the first line goes out, the rest fill the queue
+		self.driver.send_commands('client', 'session', [{'move':{'X':1}}] * 3)
+		self.driver.send_command('client', 'session', {'move':{'X':1}})
+		self.assertEqual(len(self.driver.command_queue), 3)
+		self.assertRaises(QueueFull, self.driver.send_command, 'client', 'session', {'move':{'X':1}})
+		# the driver's own lines always get in
+		self.driver._on_connection_made()
+		self.assertEqual(len(self.driver.command_queue), 4)
+
+	def test_watermarks(self):
+		calls = []
+		self.driver.set_meta_callback('on_queue_high', lambda from_, session_id, size: calls.append(('high', from_, size)))
+		self.driver.set_meta_callback('on_queue_low', lambda from_, session_id, size: calls.append(('low', from_, size)))
+		self.driver.set_config('queue_high_watermark', 3)
+		self.driver.set_config('queue_low_watermark', 1)
+		self.driver.send_commands('client', 'session', [{'move':{'X':1}}, {'move':{'Y':1}}, {'move':{'Z':1}}])
+		self.assertEqual(calls, [])
+		self.driver.send_command('other', 'session', {'move':{'X':1}})
+		self.assertEqual(calls, [('high', 'other', 3)])
+		self.assertTrue(self.driver.state_dict['queue_high'])
+		self.acknowledge(1)
+		self.assertEqual(len(calls), 1)
+		self.acknowledge(1)
+		# the client that took the queue past the high watermark hears it is back down
+		self.assertEqual(calls, [('high', 'other', 3), ('low', 'other', 1)])
+		self.assertFalse(self.driver.state_dict['queue_high'])
+
+	def test_lockstep_with_feedback_on_the_simulator(self):
+		self.driver.smoothie_transport = None
+		self.driver.state_dict['connected'] = False
+		self.driver.set_config('reconnect', False)
+		self.driver.set_config('simulation_transport', 'loopback')
+		self.driver.set_config('simulator', {'rx_buffer_size':128, 'planner_size':32, 'time_scale':0.0})
+		self.driver.connect('client', 'session')
+		self.driver.send_commands('client', 'session', ['positions', 'feedback_on', {'move':{'X':1}}, 'feedback_off', 'positions'])
+		@asyncio.coroutine
+		def drained():
+			while len(self.driver.command_queue) > 0 or self.driver.state_dict['locked']:
+				yield from asyncio.sleep(0.001)
+		# lock-step waits for {"stat":0} after each line while feedback is on
+		self.loop.run_until_complete(asyncio.wait_for(drained(), 2))
+		self.assertEqual(self.driver.state_dict['smoothie_pos']['X'], 1.5)
+		self.assertFalse(self.driver.state_dict['feedback_on'])
+		self.driver.disconnect('client', 'session')
+		self.loop.run_until_complete(asyncio.sleep(0.01))
+
+	def simulate(self, transport):
+		self.driver.smoothie_transport = None
+		self.driver.state_dict['connected'] = False
+		self.driver.set_config('reconnect', False)
+		self.driver.set_config('simulation_transport', transport)
+		self.driver.set_config('simulator', {'time_scale':0.0})
+		self.driver.connect('client', 'session')
+		self.loop.run_until_complete(self.driver.link_task)
+		self.driver.send_command('client', 'session', {'move':{'X':1}})
+		@asyncio.coroutine
+		def drained():
+			while len(self.driver.command_queue) > 0 or self.driver.state_dict['locked']:
+				yield from asyncio.sleep(0.001)
+		self.loop.run_until_complete(asyncio.wait_for(drained(), 2))
+		self.assertTrue(self.driver.state_dict['connected'])
+
+	def close_simulation(self):
+		self.driver.disconnect('client', 'session')
+		self.loop.run_until_complete(asyncio.sleep(0.01))
+		self.assertFalse(self.driver.state_dict['connected'])
+		self.assertIsNone(self.driver.simulation_server)
+
+	def test_loopback_simulation(self):
+		self.simulate('loopback')
+		self.assertIsNone(self.driver.simulation_server)
+		self.close_simulation()
+
+	def test_unix_simulation_cleans_up(self):
+		if not hasattr(socket, 'AF_UNIX'):
+			self.skipTest('no unix sockets')
+		self.simulate('unix')
+		path = self.driver.simulation_path
+		self.assertTrue(os.path.exists(path))
+		self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 0o077, 0)
+		self.close_simulation()
+		self.assertFalse(os.path.exists(os.path.dirname(path)))
+		self.assertIsNone(self.driver.simulation_path)
+
+	def test_simulated_drivers_run_side_by_side(self):
+		self.simulate('tcp')
+		other = SmoothieDriver(simulate=True)
+		other.set_config('reconnect', False)
+		other.set_config('simulation_transport', 'tcp')
+		other.connect('client', 'session')
+		self.loop.run_until_complete(other.link_task)
+		self.assertTrue(other.state_dict['connected'])
+		self.assertNotEqual(other.simulation_server.sockets[0].getsockname(), self.driver.simulation_server.sockets[0].getsockname())
+		other.disconnect('client', 'session')
+		self.close_simulation()
+
+	def test_unknown_simulation_transport(self):
+		self.driver.smoothie_transport = None
+		self.driver.state_dict['connected'] = False
+		self.driver.set_config('simulation_transport', 'pigeon')
+		self.driver.connect('client', 'session')
+		self.loop.run_until_complete(self.driver.link_task)
+		self.assertFalse(self.driver.state_dict['connected'])
+
+
+
+if __name__ == '__main__':
+	unittest.main()